@@ -0,0 +1 @@
+"""Офлайн-бенчмарки и нагрузочные инструменты бота (не используются ботом в работе)"""
@@ -0,0 +1,57 @@
+"""
+Сравнение двух прогонов benchmarks.run.
+
+    python -m benchmarks.compare base.json new.json --threshold 10
+
+Код выхода 1, если p50 или p99 какого-либо бенчмарка выросли больше чем на threshold процентов.
+"""
+import sys
+import json
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+def load_results(path: str) -> Dict[Tuple[int, str], dict]:
+    with open(path, encoding='utf-8') as f:
+        report = json.load(f)
+    return {(row['size'], row['bench']): row for row in report['results']}
+
+def change(old: Optional[float], new: Optional[float]) -> Optional[float]:
+    """Изменение в процентах (None, если сравнивать не с чем)"""
+    if not old or new is None:
+        return None
+    return (new - old) / old * 100
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Сравнение результатов бенчмарков')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Допустимый рост задержки, %%')
+    args = parser.parse_args(argv)
+
+    base, new = load_results(args.base), load_results(args.new)
+    regressions = 0
+    print(f"{'size':>9} {'bench':<22} {'p50 base':>10} {'p50 new':>10} {'Δp50':>8} {'Δp99':>8} {'Δpeak':>8}")
+    for key in sorted(set(base) & set(new)):
+        old_row, new_row = base[key], new[key]
+        deltas = {
+            field: change(old_row.get(field), new_row.get(field))
+            for field in ('p50_ms', 'p99_ms', 'peak_alloc_mb')
+        }
+        regressed = any(deltas[field] is not None and deltas[field] > args.threshold
+                        for field in ('p50_ms', 'p99_ms'))
+        regressions += regressed
+        print(
+            f"{key[0]:>9} {key[1]:<22} {old_row['p50_ms']:>10.3f} {new_row['p50_ms']:>10.3f} "
+            + ' '.join(f"{'' if value is None else f'{value:+.1f}%':>8}" for value in deltas.values())
+            + ('  ⚠️' if regressed else '')
+        )
+
+    for key in sorted(set(base) ^ set(new)):
+        print(f"{key[0]:>9} {key[1]:<22} есть только в {'base' if key in base else 'new'}")
+
+    if regressions:
+        print(f"\nЗамедлились {regressions} бенчмарков (порог {args.threshold}%)", file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import random
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+
+# Словарь "чатового" русского: частые слова идут первыми и встречаются чаще (закон Ципфа)
+WORDS = (
+    "я ты он она мы вы они это то что как так вот ну да нет не ни же ли бы уже еще "
+    "просто очень тоже там тут здесь когда если потом сейчас сегодня завтра вчера "
+    "короче блин типа вообще кстати реально походу наверное конечно ладно давай "
+    "пойдем идем пошли сделал сделать думаю знаю видел смотрел скинь напиши позвони "
+    "работа дом город машина кофе пиво чай еда пицца погода дождь снег мороз лето "
+    "зима выходные пятница понедельник утро вечер ночь друг друзья брат мама папа "
+    "кот котик собака деньги зарплата отпуск море горы байкал ангара мост пробка "
+    "автобус маршрутка трамвай магазин тренировка игра фильм сериал музыка концерт "
+    "хороший плохой новый старый большой маленький быстрый медленный смешной странный "
+    "нормально хорошо плохо круто класс супер отлично ужас отстой жесть кринж имба "
+    "согласен понял принял спасибо пожалуйста привет пока здорово норм ок ахах "
+    "ахахах лол кек хах хм эх ох ого вау"
+).split()
+
+EMOJIS = ["😂", "🤣", "👍", "❤️", "🔥", "😊", "😄", "😢", "😠", "👎", "🙈", "🤔", "💩", "🍺", "☕️"]
+PUNCTUATION = ["", "", "", ".", "!", "?", "...", ")", "))", "!!"]
+MENTIONS = ["@vasya", "@petya", "@masha", "@bot"]
+
+# ID первого (самого активного) чата; остальные идут подряд вниз
+FIRST_CHAT_ID = -1000000000000
+
+class CorpusGenerator:
+    """
+    Синтетический корпус сообщений в духе русскоязычного группового чата.
+    Генерация детерминирована для одинакового seed
+    """
+
+    def __init__(self, seed: int = 42):
+        self.random = random.Random(seed)
+        self._weights = [1 / rank for rank in range(1, len(WORDS) + 1)]
+
+    @staticmethod
+    def hottest_chat_id() -> int:
+        """Чат, в который попадает больше всего сообщений корпуса"""
+        return FIRST_CHAT_ID
+
+    def _words(self, count: int) -> List[str]:
+        return self.random.choices(WORDS, weights=self._weights, k=count)
+
+    def message(self) -> str:
+        """Одно сообщение: короткие реплики частые, длинные - редкие"""
+        rnd = self.random
+        roll = rnd.random()
+        if roll < 0.03:
+            # Мусор, который отсекает is_valid_message
+            return rnd.choice(["))))", "ааааа", "https://example.com/" + str(rnd.randint(1, 10 ** 6)), "/start", "+"])
+        if roll < 0.08:
+            return rnd.choice(EMOJIS) * rnd.randint(1, 3)
+
+        length = max(1, min(40, int(rnd.lognormvariate(1.8, 0.6))))
+        words = self._words(length)
+        if rnd.random() < 0.15:
+            words.insert(rnd.randrange(len(words) + 1), rnd.choice(EMOJIS))
+        if rnd.random() < 0.05:
+            words.insert(0, rnd.choice(MENTIONS))
+        text = " ".join(words) + rnd.choice(PUNCTUATION)
+        return text[0].upper() + text[1:] if rnd.random() < 0.4 else text
+
+    def documents(self, count: int, chats: int = 10, days: int = 60,
+                  now: Optional[datetime] = None) -> Iterator[dict]:
+        """
+        Документы коллекции messages в хронологическом порядке
+
+        Args:
+            count: Количество сообщений
+            chats: На сколько чатов распределить сообщения (первый чат - самый активный)
+            days: За сколько последних дней распределить даты
+        """
+        now = now or datetime.utcnow()
+        start = now - timedelta(days=days)
+        step = timedelta(days=days) / max(count, 1)
+        chat_weights = [1 / rank for rank in range(1, chats + 1)]
+        chat_ids = [FIRST_CHAT_ID - i for i in range(chats)]
+        for i in range(count):
+            yield {
+                'chat_id': self.random.choices(chat_ids, weights=chat_weights)[0],
+                'text': self.message(),
+                'created_at': start + step * i,
+            }
+
+def parse_size(value: str) -> int:
+    """'1k' -> 1000, '100k' -> 100000, '1M' -> 1000000"""
+    value = value.strip()
+    multipliers = {'k': 1000, 'K': 1000, 'm': 1000000, 'M': 1000000}
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
@@ -0,0 +1,409 @@
+"""
+Нагрузочный прогон: поток апдейтов Telegram через настоящие обработчики main.build_application.
+
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.replay --updates 5000 --chats 200 --rate 0 --output replay.json
+    python -m benchmarks.replay --input recorded.jsonl --rate 50
+
+Bot API подменяется FakeRequest (вызовы только записываются), MongoDB - in-memory
+заменой из benchmarks.stand_in, модели пишутся во временную директорию.
+Поток апдейтов синтетический (текст, стикеры, команды по многим чатам) или записанный:
+JSONL, по одному объекту Update из getUpdates/webhook в строке.
+
+Отчет: устойчивая пропускная способность (апдейтов/с), задержка апдейта от постановки
+в очередь до конца обработки, задержки каждого обработчика, зависания event loop
+(насколько позже запланированного просыпалась контрольная корутина) и счетчики
+исходящих вызовов Bot API. С --debug-loop asyncio дополнительно пишет в лог
+каждый колбэк, блокирующий цикл дольше --slow-callback-ms.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import itertools
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Плановая рассылка погоды ходит во внешний API и в прогоне не нужна
+os.environ.setdefault('WEATHER_BROADCAST_INTERVAL', '0')
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from benchmarks.corpus import EMOJIS, FIRST_CHAT_ID, CorpusGenerator
+from benchmarks.run import git_revision, percentile
+from benchmarks.stand_in import make_client
+
+logger = logging.getLogger('benchmarks.replay')
+
+BOT_USER = {'id': 100000001, 'is_bot': True, 'first_name': 'Ebanez', 'username': 'ebanez_replay_bot'}
+
+# Команды синтетического потока. /clear, /rebuild и /weather по умолчанию не входят:
+# первые две разрушают состояние прогона, последняя ходит во внешний API
+DEFAULT_COMMANDS = ('gen', 'top', 'mood', 'stats', 'sticker', 'help')
+
+class FakeRequest(BaseRequest):
+    """Транспорт Bot API без сети: запоминает вызовы и отвечает правдоподобными объектами"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        body = {'ok': True, 'result': self._result(endpoint, params)}
+        return 200, json.dumps(body).encode()
+
+    def _message(self, params: dict, **fields) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': params.get('chat_id', 0), 'type': 'supergroup', 'title': 'replay'},
+            'from': BOT_USER,
+        }
+        message.update(fields)
+        return message
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == 'getMe':
+            return BOT_USER
+        if endpoint == 'sendMessage':
+            return self._message(params, text=params.get('text', ''))
+        if endpoint == 'sendSticker':
+            return self._message(params, sticker=_sticker(str(params.get('sticker', 'sticker'))))
+        if endpoint == 'getStickerSet':
+            name = params.get('name', 'set')
+            return {
+                'name': name, 'title': name, 'sticker_type': 'regular',
+                'is_animated': False, 'is_video': False,
+                'stickers': [_sticker(f'{name}_{i}', set_name=name) for i in range(20)],
+            }
+        return True
+
+def _sticker(file_id: str, set_name: Optional[str] = None) -> dict:
+    sticker = {
+        'file_id': file_id, 'file_unique_id': file_id, 'type': 'regular',
+        'width': 512, 'height': 512, 'is_animated': False, 'is_video': False,
+    }
+    if set_name:
+        sticker['set_name'] = set_name
+    return sticker
+
+class UpdateStream:
+    """Синтетический поток апдейтов групповых чатов: активность чатов убывает по Ципфу"""
+
+    def __init__(self, seed: int = 42, chats: int = 100, sticker_share: float = 0.1,
+                 command_share: float = 0.03, commands=DEFAULT_COMMANDS):
+        self.random = random.Random(seed)
+        self.corpus = CorpusGenerator(seed)
+        self.chat_ids = [FIRST_CHAT_ID - i for i in range(chats)]
+        self.chat_weights = [1 / rank for rank in range(1, chats + 1)]
+        self.sticker_share = sticker_share
+        self.command_share = command_share
+        self.commands = list(commands)
+
+    def _message(self, update_id: int) -> dict:
+        rnd = self.random
+        user_id = rnd.randint(1, 5000)
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': rnd.choices(self.chat_ids, weights=self.chat_weights)[0],
+                     'type': 'supergroup', 'title': 'replay'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        }
+        roll = rnd.random()
+        if roll < self.command_share and self.commands:
+            command = '/' + rnd.choice(self.commands)
+            message['text'] = command
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        elif roll < self.command_share + self.sticker_share:
+            pack = rnd.randrange(10)
+            message['sticker'] = dict(_sticker(f'pack{pack}_{rnd.randrange(20)}', set_name=f'pack{pack}'),
+                                      emoji=rnd.choice(EMOJIS))
+        else:
+            message['text'] = self.corpus.message()
+        return message
+
+    def updates(self, count: int) -> Iterator[dict]:
+        for update_id in range(1, count + 1):
+            yield {'update_id': update_id, 'message': self._message(update_id)}
+
+def read_updates(path: str, limit: Optional[int] = None) -> Iterator[dict]:
+    """Записанные апдейты: JSONL или JSON-массив (как в ответе getUpdates)"""
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            data = (json.loads(line) for line in f if line.strip())
+        else:
+            data = json.load(f)
+            data = data.get('result', []) if isinstance(data, dict) else data
+        yield from itertools.islice(data, limit)
+
+class LoopMonitor:
+    """Измеряет, насколько позже запланированного просыпается корутина: это время, когда цикл был занят"""
+
+    def __init__(self, interval: float = 0.01, stall_threshold: float = 0.05):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.lags: List[float] = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+
+    def report(self) -> dict:
+        lags = sorted(self.lags)
+        stalls = [lag for lag in lags if lag >= self.stall_threshold]
+        return {
+            'samples': len(lags),
+            'stall_threshold_ms': self.stall_threshold * 1000,
+            'stalls': len(stalls),
+            'stalled_seconds': round(sum(stalls), 3),
+            'lag_p50_ms': round(percentile(lags, 50) * 1000, 3),
+            'lag_p99_ms': round(percentile(lags, 99) * 1000, 3),
+            'lag_max_ms': round(lags[-1] * 1000, 3) if lags else 0.0,
+        }
+
+def latency_stats(values: List[float]) -> dict:
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p90_ms': round(percentile(values, 90) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+class HandlerTimings:
+    """Обертки колбэков зарегистрированных обработчиков с замером времени и ошибок"""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+
+    def instrument(self, application):
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                handler.callback = self._wrap(handler.callback)
+
+    def _wrap(self, callback):
+        name = getattr(callback, '__name__', repr(callback))
+
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.errors[name] += 1
+                raise
+            finally:
+                self.durations[name].append(time.perf_counter() - started)
+
+        return wrapper
+
+    def report(self) -> dict:
+        return {
+            name: dict(latency_stats(values), errors=self.errors[name])
+            for name, values in sorted(self.durations.items())
+        }
+
+def seed_history(services, stream: UpdateStream, history: int, seed: int) -> int:
+    """История сообщений чатов потока и модели для чатов с историей"""
+    if history <= 0:
+        return 0
+    docs = list(CorpusGenerator(seed + 1).documents(history, chats=len(stream.chat_ids)))
+    services.database.messages.insert_many(docs)
+    built = 0
+    for chat_id in {doc['chat_id'] for doc in docs}:
+        if services.markov_generator.rebuild_model(chat_id):
+            built += 1
+    return built
+
+async def replay(args) -> dict:
+    from main import build_application
+    from src.services.container import services
+
+    loop = asyncio.get_running_loop()
+    if args.debug_loop:
+        loop.set_debug(True)
+        loop.slow_callback_duration = args.slow_callback_ms / 1000
+
+    services._mongo_client = make_client()
+    models_dir = tempfile.TemporaryDirectory(prefix='ebanez-replay-')
+    services.markov_generator.models_dir = Path(models_dir.name)
+    services.markov_generator.init_storage()
+
+    stream = UpdateStream(args.seed, args.chats, args.sticker_share, args.command_share,
+                          [c for c in args.commands.split(',') if c])
+    if args.input:
+        raw_updates = list(read_updates(args.input, args.updates))
+        built = 0
+    else:
+        built = await asyncio.to_thread(seed_history, services, stream, args.history, args.seed)
+        raw_updates = list(stream.updates(args.updates))
+    print(f"Апдейтов: {len(raw_updates)}, моделей построено заранее: {built}", file=sys.stderr, flush=True)
+
+    request = FakeRequest(args.api_latency / 1000)
+    application = build_application('123456:REPLAY', updater=False, request=request)
+    timings = HandlerTimings()
+    timings.instrument(application)
+
+    # Время от постановки апдейта в очередь до конца его обработки
+    enqueued: Dict[int, float] = {}
+    update_latency: List[float] = []
+    all_done = asyncio.Event()
+    total = len(raw_updates)
+    process_update = application.process_update
+
+    async def timed_process_update(update):
+        try:
+            await process_update(update)
+        finally:
+            if isinstance(update, Update) and update.update_id in enqueued:
+                update_latency.append(time.perf_counter() - enqueued.pop(update.update_id))
+                if len(update_latency) >= total:
+                    all_done.set()
+
+    application.process_update = timed_process_update
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    monitor = LoopMonitor(args.monitor_interval / 1000, args.stall_ms / 1000)
+    monitor_task = loop.create_task(monitor.run())
+
+    updates = [Update.de_json(data, application.bot) for data in raw_updates]
+    started = time.perf_counter()
+    for i, update in enumerate(updates):
+        if args.rate > 0:
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        enqueued[update.update_id] = time.perf_counter()
+        await application.update_queue.put(update)
+    feed_seconds = time.perf_counter() - started
+
+    drained = True
+    if total:
+        try:
+            await asyncio.wait_for(all_done.wait(), args.drain_timeout)
+        except asyncio.TimeoutError:
+            drained = False
+            logger.warning(f"Не дождались обработки {len(enqueued)} апдейтов за {args.drain_timeout}s")
+    elapsed = time.perf_counter() - started
+
+    monitor_task.cancel()
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    models_dir.cleanup()
+
+    processed = len(update_latency)
+    return {
+        'summary': {
+            'updates': total,
+            'processed': processed,
+            'drained': drained,
+            'target_rate': args.rate or None,
+            'feed_seconds': round(feed_seconds, 3),
+            'seconds': round(elapsed, 3),
+            'updates_per_sec': round(processed / elapsed, 2) if elapsed else None,
+            'update_latency': latency_stats(update_latency),
+        },
+        'handlers': timings.report(),
+        'event_loop': monitor.report(),
+        'bot_api_calls': dict(request.calls.most_common()),
+    }
+
+def print_report(report: dict):
+    summary = report['summary']
+    latency = summary['update_latency']
+    loop_report = report['event_loop']
+    print(
+        f"Обработано {summary['processed']}/{summary['updates']} за {summary['seconds']}s: "
+        f"{summary['updates_per_sec']} апд/с, задержка p50={latency['p50_ms']}ms p99={latency['p99_ms']}ms",
+        file=sys.stderr
+    )
+    for name, stats in report['handlers'].items():
+        print(f"  {name:<28} n={stats['count']:<6} p50={stats['p50_ms']:>9.3f}ms "
+              f"p99={stats['p99_ms']:>9.3f}ms max={stats['max_ms']:>9.3f}ms errors={stats['errors']}",
+              file=sys.stderr)
+    print(
+        f"Event loop: {loop_report['stalls']} зависаний >= {loop_report['stall_threshold_ms']}ms "
+        f"(всего {loop_report['stalled_seconds']}s), max={loop_report['lag_max_ms']}ms",
+        file=sys.stderr
+    )
+    print(f"Bot API: {report['bot_api_calls']}", file=sys.stderr)
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Прогон потока апдейтов через обработчики бота')
+    parser.add_argument('--input', help='Записанные апдейты (JSONL или JSON-массив) вместо синтетических')
+    parser.add_argument('--updates', type=int, default=2000, help='Сколько апдейтов прогнать')
+    parser.add_argument('--chats', type=int, default=100, help='Количество чатов синтетического потока')
+    parser.add_argument('--history', type=int, default=20000, help='Сообщений истории до начала прогона')
+    parser.add_argument('--sticker-share', type=float, default=0.1)
+    parser.add_argument('--command-share', type=float, default=0.03)
+    parser.add_argument('--commands', default=','.join(DEFAULT_COMMANDS), help='Команды синтетического потока')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--rate', type=float, default=0, help='Апдейтов в секунду (0 - без ограничения)')
+    parser.add_argument('--api-latency', type=float, default=0, help='Задержка ответа Bot API, мс')
+    parser.add_argument('--drain-timeout', type=float, default=300, help='Сколько ждать обработки очереди, с')
+    parser.add_argument('--monitor-interval', type=float, default=10, help='Период проверки event loop, мс')
+    parser.add_argument('--stall-ms', type=float, default=50, help='С какой задержки считать цикл зависшим')
+    parser.add_argument('--debug-loop', action='store_true', help='Режим отладки asyncio с логом медленных колбэков')
+    parser.add_argument('--slow-callback-ms', type=float, default=100)
+    parser.add_argument('--output', default='-', help='Файл для JSON с результатами (- для stdout)')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    report = asyncio.run(replay(args))
+    report['meta'] = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': vars(args),
+    }
+    print_report(report)
+
+    body = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == '-':
+        print(body)
+    else:
+        Path(args.output).write_text(body, encoding='utf-8')
+        print(f"Результаты записаны в {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
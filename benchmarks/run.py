@@ -0,0 +1,209 @@
+"""
+Бенчмарки горячих путей бота на синтетическом корпусе и in-memory MongoDB.
+
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.run --sizes 1k,100k,1M --output bench.json
+    python -m benchmarks.compare old.json bench.json
+
+Для каждого размера корпуса измеряются задержки (p50/p90/p99/max), пропускная способность
+и пиковая память (отдельной итерацией под tracemalloc, чтобы трассировка не искажала задержки).
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.corpus import CorpusGenerator, parse_size
+from benchmarks.stand_in import make_client
+from src.services.database import Database
+from src.services.markov_chain import MarkovChainGenerator
+
+logger = logging.getLogger('benchmarks')
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Перцентиль по уже отсортированным значениям (ближайший ранг)"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+class BenchRunner:
+    """Повторяет операцию до лимита итераций или времени и собирает статистику"""
+
+    def __init__(self, max_seconds: float, max_iterations: int, trace_memory: bool = True):
+        self.max_seconds = max_seconds
+        self.max_iterations = max_iterations
+        self.trace_memory = trace_memory
+        self.results: List[dict] = []
+
+    def measure(self, size: int, name: str, func: Callable, setup: Optional[Callable] = None,
+                iterations: Optional[int] = None, **info) -> dict:
+        iterations = iterations or self.max_iterations
+        latencies = []
+        started = time.perf_counter()
+        while len(latencies) < iterations and (not latencies or time.perf_counter() - started < self.max_seconds):
+            if setup:
+                setup()
+            op_started = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - op_started)
+
+        peak = None
+        if self.trace_memory:
+            if setup:
+                setup()
+            tracemalloc.start()
+            try:
+                func()
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        latencies.sort()
+        total = sum(latencies)
+        result = {
+            'size': size,
+            'bench': name,
+            'ops': len(latencies),
+            'seconds': round(total, 4),
+            'ops_per_sec': round(len(latencies) / total, 2) if total else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p90_ms': round(percentile(latencies, 90) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+            'peak_alloc_mb': round(peak / (1024 * 1024), 2) if peak is not None else None,
+        }
+        result.update(info)
+        self.results.append(result)
+        print(
+            f"{size:>9} {name:<22} ops={result['ops']:<6} p50={result['p50_ms']:>10.3f}ms "
+            f"p99={result['p99_ms']:>10.3f}ms peak={result['peak_alloc_mb']}MB",
+            file=sys.stderr, flush=True
+        )
+        return result
+
+def load_corpus(db: Database, size: int, chats: int, seed: int, batch: int = 10000) -> int:
+    """Заливка синтетической истории прямо в коллекцию (быстрее, чем add_message)"""
+    docs = []
+    for doc in CorpusGenerator(seed).documents(size, chats=chats):
+        docs.append(doc)
+        if len(docs) >= batch:
+            db.messages.insert_many(docs)
+            docs = []
+    if docs:
+        db.messages.insert_many(docs)
+    return size
+
+def run_size(runner: BenchRunner, size: int, chats: int, seed: int, workdir: Path):
+    """Все бенчмарки для одного размера корпуса на свежей базе"""
+    db = Database(make_client())
+    db.init_db()
+    generator = MarkovChainGenerator(db=db)
+    generator.models_dir = workdir / f'models_{size}'
+    generator.init_storage()
+
+    load_started = time.perf_counter()
+    load_corpus(db, size, chats, seed)
+    # Самый активный чат корпуса
+    chat_id = CorpusGenerator.hottest_chat_id()
+    chat_messages = db.messages.count_documents({'chat_id': chat_id})
+    print(f"{size:>9} корпус загружен за {time.perf_counter() - load_started:.1f}s, "
+          f"в измеряемом чате {chat_messages} сообщений", file=sys.stderr, flush=True)
+    info = {'chat_messages': chat_messages}
+
+    runner.measure(size, 'corpus_load', lambda: generator.corpus.get_messages(chat_id),
+                   setup=lambda: generator.corpus.invalidate(chat_id), **info)
+    # Без отпечатка на диске пересборка и запись выполняются полностью
+    forget_fingerprint = lambda: generator.get_meta_path(chat_id).unlink(missing_ok=True)
+    runner.measure(size, 'rebuild_model', lambda: generator.rebuild_model(chat_id),
+                   setup=forget_fingerprint, iterations=min(runner.max_iterations, 20), **info)
+    if not generator.models.get(chat_id):
+        print(f"{size:>9} модель не построена, генерация пропущена", file=sys.stderr)
+    else:
+        generator.save_model(chat_id)
+        runner.measure(size, 'rebuild_unchanged', lambda: generator.rebuild_model(chat_id), **info)
+        runner.measure(size, 'save_model', lambda: generator.save_model(chat_id),
+                       setup=forget_fingerprint, **info)
+        runner.measure(size, 'load_model', lambda: generator.load_model(chat_id), **info)
+
+        runner.measure(size, 'generate_unseeded', lambda: generator.generate_response(chat_id), **info)
+        seeds = CorpusGenerator(seed + 1)
+        runner.measure(size, 'generate_seeded',
+                       lambda: generator.generate_response(chat_id, seeds.message() + ' ' + seeds.message()),
+                       **info)
+
+    # /top и /mood: разовый пересчет по истории и последующие запросы к счетчикам
+    word_stats, mood_stats = generator.word_stats, generator.mood_stats
+    runner.measure(size, 'top_backfill',
+                   lambda: word_stats.rebuild(chat_id, generator.corpus.iter_docs(chat_id)),
+                   iterations=1, **info)
+    runner.measure(size, 'top', lambda: word_stats.get_top(chat_id, limit=10), **info)
+    runner.measure(size, 'top_week', lambda: word_stats.get_top(chat_id, limit=10, days=7), **info)
+    runner.measure(size, 'mood_backfill',
+                   lambda: mood_stats.rebuild(chat_id, generator.corpus.iter_docs(chat_id)),
+                   iterations=1, **info)
+    runner.measure(size, 'mood', lambda: mood_stats.get_counts(chat_id), **info)
+    runner.measure(size, 'mood_day', lambda: mood_stats.get_counts(chat_id, hours=24), **info)
+
+    # add_message последним: он меняет историю. Модель он не перестраивает (только отмечает
+    # чат для планировщика пересборки), поэтому измеряется путь приема сообщения: отсев
+    # дубликатов, запись в базу, кэш корпуса и счетчики /top и /mood
+    incoming = CorpusGenerator(seed + 2)
+    runner.measure(size, 'add_message', lambda: generator.add_message(chat_id, incoming.message()), **info)
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Бенчмарки горячих путей бота')
+    parser.add_argument('--sizes', default='1k,100k,1M', help='Размеры корпуса через запятую')
+    parser.add_argument('--chats', type=int, default=10, help='На сколько чатов распределить корпус')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--max-seconds', type=float, default=10.0, help='Бюджет времени на один бенчмарк')
+    parser.add_argument('--max-iterations', type=int, default=200, help='Лимит итераций на один бенчмарк')
+    parser.add_argument('--no-memory', action='store_true', help='Не измерять пиковую память')
+    parser.add_argument('--output', default='-', help='Файл для JSON с результатами (- для stdout)')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    runner = BenchRunner(args.max_seconds, args.max_iterations, trace_memory=not args.no_memory)
+    with tempfile.TemporaryDirectory(prefix='ebanez-bench-') as workdir:
+        for size in (parse_size(value) for value in args.sizes.split(',')):
+            run_size(runner, size, args.chats, args.seed, Path(workdir))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args),
+        },
+        'results': runner.results,
+    }
+    body = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == '-':
+        print(body)
+    else:
+        Path(args.output).write_text(body, encoding='utf-8')
+        print(f"Результаты записаны в {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
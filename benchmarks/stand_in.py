@@ -0,0 +1,182 @@
+"""
+In-memory замена MongoDB для бенчмарков и нагрузочных прогонов.
+
+Используется mongomock (см. benchmarks/requirements.txt) с двумя доработками:
+
+- добавлен $strLenCP, который нужен Database.get_chat_stats;
+- индексы коллекций работают как hash-индексы по равенству. Без этого mongomock
+  на каждый find/upsert/проверку уникальности просматривает всю коллекцию, и на
+  корпусе в 1M сообщений бенчмарки измеряют mongomock, а не бота.
+
+Ограничения: TTL-индексы создаются без expireAfterSeconds (документы не устаревают),
+индекс ищется только по полям с точным равенством в фильтре, кандидаты все равно
+проверяются полным фильтром. Изменение индексируемых полей на месте ($set по
+полю индекса) индекс не отслеживает - в коде бота такого нет.
+"""
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+import mongomock
+from mongomock import aggregate, filtering, helpers, store
+from mongomock.collection import Collection
+
+_patched = False
+
+class _HashIndexes:
+    """Hash-индексы одной коллекции: поля -> значения полей -> _id документов"""
+
+    def __init__(self):
+        self.maps: Dict[Tuple[str, ...], Dict[tuple, dict]] = {}
+
+    @staticmethod
+    def _key(fields: Tuple[str, ...], doc: dict) -> Optional[tuple]:
+        values = []
+        for field in fields:
+            try:
+                value = helpers.get_value_by_dot(doc, field)
+            except KeyError:
+                value = None
+            if not _indexable(value):
+                return None
+            values.append(value)
+        return tuple(values)
+
+    def register(self, fields: Tuple[str, ...], documents):
+        if fields in self.maps:
+            return
+        self.maps[fields] = {}
+        for doc in documents:
+            self._add(fields, doc['_id'], doc)
+
+    def _add(self, fields: Tuple[str, ...], doc_id, doc: dict):
+        key = self._key(fields, doc)
+        if key is not None:
+            self.maps[fields].setdefault(key, {})[doc_id] = None
+
+    def add(self, doc_id, doc: dict):
+        for fields in self.maps:
+            self._add(fields, doc_id, doc)
+
+    def remove(self, doc_id, doc: dict):
+        for fields, values in self.maps.items():
+            key = self._key(fields, doc)
+            ids = values.get(key) if key is not None else None
+            if ids is not None:
+                ids.pop(doc_id, None)
+                if not ids:
+                    del values[key]
+
+    def lookup(self, query: dict) -> Optional[List]:
+        """_id кандидатов по самому подробному подходящему индексу или None, если индекс не подходит"""
+        best = None
+        for fields in self.maps:
+            if all(field in query and _indexable(query[field]) for field in fields):
+                if best is None or len(fields) > len(best):
+                    best = fields
+        if best is None:
+            return None
+        return list(self.maps[best].get(tuple(query[field] for field in best), ()))
+
+def _indexable(value) -> bool:
+    """Можно ли искать значение по хешу так же, как его сравнивает mongomock"""
+    if isinstance(value, (dict, list)):
+        return False
+    if isinstance(value, datetime.datetime):
+        # mongomock хранит даты с точностью до миллисекунд
+        return value.microsecond % 1000 == 0
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+def _install_strlencp():
+    original = aggregate._Parser._handle_string_operator
+
+    def _handle_string_operator(self, operator, values):
+        if operator == '$strLenCP':
+            value = self.parse(values)
+            return len(value) if isinstance(value, str) else 0
+        return original(self, operator, values)
+
+    aggregate._Parser._handle_string_operator = _handle_string_operator
+
+def _install_indexes():
+    store_setitem = store.CollectionStore.__setitem__
+    store_delitem = store.CollectionStore.__delitem__
+    store_drop = store.CollectionStore.drop
+    create_index = Collection.create_index
+    iter_documents = Collection._iter_documents
+
+    def __setitem__(self, key, val):
+        indexes = getattr(self, '_hash_indexes', None)
+        if indexes is not None:
+            previous = self._documents.get(key)
+            if previous is not None:
+                indexes.remove(key, previous)
+        store_setitem(self, key, val)
+        if indexes is not None:
+            indexes.add(key, val)
+
+    def __delitem__(self, key):
+        indexes = getattr(self, '_hash_indexes', None)
+        if indexes is not None and key in self._documents:
+            indexes.remove(key, self._documents[key])
+        store_delitem(self, key)
+
+    def drop(self):
+        store_drop(self)
+        indexes = getattr(self, '_hash_indexes', None)
+        if indexes is not None:
+            for values in indexes.maps.values():
+                values.clear()
+
+    def _create_index(self, key_or_list, cache_for=300, session=None, **kwargs):
+        kwargs.pop('expireAfterSeconds', None)
+        name = create_index(self, key_or_list, cache_for, session, **kwargs)
+        fields = tuple(field for field, _ in helpers.create_index_list(key_or_list))
+        indexes = self._store.__dict__.setdefault('_hash_indexes', _HashIndexes())
+        # Префикс по первому полю нужен запросам вида {'chat_id': ...};
+        # полный ключ - только для уникальных индексов (upsert и проверка уникальности)
+        indexes.register(fields[:1], list(self._store.documents))
+        if kwargs.get('unique'):
+            indexes.register(fields, list(self._store.documents))
+        return name
+
+    def _iter_documents(self, filter):
+        indexes = getattr(self._store, '_hash_indexes', None)
+        if indexes is not None and isinstance(filter, dict):
+            candidates = indexes.lookup(filter)
+            if candidates is not None:
+                documents = self._store._documents
+                return (documents[doc_id] for doc_id in candidates
+                        if doc_id in documents and filtering.filter_applies(filter, documents[doc_id]))
+        return iter_documents(self, filter)
+
+    def _aggregate(self, pipeline, session=None, **unused_kwargs):
+        # Ведущий $match выполняется через find, чтобы задействовать индекс
+        if pipeline and '$match' in pipeline[0]:
+            in_collection = list(self.find(pipeline[0]['$match']))
+            return aggregate.process_pipeline(in_collection, self.database, pipeline[1:], session)
+        return aggregate.process_pipeline(list(self.find()), self.database, pipeline, session)
+
+    store.CollectionStore.__setitem__ = __setitem__
+    store.CollectionStore.__delitem__ = __delitem__
+    store.CollectionStore.drop = drop
+    Collection.create_index = _create_index
+    Collection._iter_documents = _iter_documents
+    Collection.aggregate = _aggregate
+
+def install():
+    """Доработки mongomock; повторный вызов ничего не делает"""
+    global _patched
+    if _patched:
+        return
+    _install_strlencp()
+    _install_indexes()
+    _patched = True
+
+def make_client(database: str = 'ebanez') -> mongomock.MongoClient:
+    """Клиент in-memory MongoDB с базой по умолчанию, как у MONGODB_URI"""
+    install()
+    return mongomock.MongoClient(f'mongodb://localhost/{database}')
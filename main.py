@@ -1,68 +1,144 @@
+import time
+
+# Момент запуска процесса, от него считается время холодного старта
+PROCESS_STARTED = time.perf_counter()
+
 import os
+import asyncio
 import logging
 from dotenv import load_dotenv
+from typing import Optional
 from telegram.ext import Application, CommandHandler, MessageHandler, ChatMemberHandler, filters
+from telegram.request import BaseRequest
 
-from src.handlers.command_handlers import (
-    start_command,
-    help_command,
-    stats_command,
-    generate_command,
-    clear_command,
-    rebuild_command,
-    sticker_command,
-    top_command,
-    mood_command
-)
-from src.handlers.message_handlers import (
-    handle_message, 
-    handle_my_chat_member, 
-    handle_weather_command
-)
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+from src.services.update_processor import ChatOrderedUpdateProcessor
+from src.services.webhook_server import run_webhook
+from src.services.shard_router import build_router_application
+from src.log_config import setup_logging
+
+def build_application(token: str, updater: bool = True, request: Optional[BaseRequest] = None) -> Application:
+    """
+    Создание приложения со всеми обработчиками
+
+    request - свой транспорт для Bot API вместо HTTP-клиента по умолчанию
+    (используется нагрузочным прогоном benchmarks.replay)
+    """
+    # Фронт шардированного режима обработчики не использует и их не импортирует
+    from src.handlers.command_handlers import (
+        start_command,
+        help_command,
+        stats_command,
+        generate_command,
+        clear_command,
+        rebuild_command,
+        basemodel_command,
+        refresh_base_model,
+        retention_command,
+        compact_history,
+        sticker_command,
+        top_command,
+        mood_command,
+        profile_command,
+        import_command
+    )
+    from src.handlers.message_handlers import (
+        handle_message,
+        handle_my_chat_member,
+        handle_weather_command,
+        broadcast_weather
+    )
+    from src.services.container import services
+    from src.services.model_warmup import warm_up_models
+    from src.services.metrics import MetricsServer
+    from src.services.shard_router import current_shard
+
+    background_tasks = []
+    # Отдельный сервер метрик для polling (в режиме webhook /metrics отдает сам webhook-сервер)
+    metrics_server = None
+    if os.getenv('METRICS_PORT'):
+        shard_id, shards = current_shard()
+        # У каждого воркера шардированного режима свой порт: METRICS_PORT + 1 + номер шарда
+        metrics_server = MetricsServer(port=int(os.getenv('METRICS_PORT')) + (shard_id + 1 if shards > 1 else 0))
+
+    async def after_storage(job):
+        """Прогрев и планировщик пересборки читают индексы и состояние, восстановленные при старте"""
+        if not await services.storage_ready():
+            logging.warning("Хранилища не инициализированы, фоновая задача запускается без них")
+        await job()
+
+    async def on_init(application: Application):
+        """Старт сервисов и фоновых задач после проверки токена"""
+        await services.startup()
+        if metrics_server is not None:
+            await metrics_server.start()
+        background_tasks.append(asyncio.get_running_loop().create_task(after_storage(
+            lambda: warm_up_models(services.markov_generator, services.generation_pool))))
+        background_tasks.append(asyncio.get_running_loop().create_task(after_storage(
+            services.markov_generator.rebuilds.run)))
+        logging.info(f"Бот готов принимать апдейты через {time.perf_counter() - PROCESS_STARTED:.2f}s после запуска")
+
+    async def on_stop(application: Application):
+        """Отправка оставшихся исходящих действий перед остановкой"""
+        for task in background_tasks:
+            task.cancel()
+        await services.stop()
+
+    async def on_shutdown(application: Application):
+        """Освобождение ресурсов при остановке бота"""
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await services.shutdown()
 
-def main():
-    load_dotenv()    
-    token = os.getenv('BOT_TOKEN')
-    if not token:
-        raise ValueError("Не найден токен бота. Создайте файл .example.env с переменной BOT_TOKEN")
-    
-    logging.info(f"Token starts with: {token[:10]}...")
-    
     # Configure application with timeout settings
-    application = (
+    builder = (
         Application.builder()
         .token(token)
-        .connect_timeout(30.0)  # 30 seconds connection timeout
-        .read_timeout(30.0)     # 30 seconds read timeout
-        .write_timeout(30.0)    # 30 seconds write timeout
-        .pool_timeout(30.0)     # 30 seconds pool timeout
-        .build()
+        # Чаты обрабатываются параллельно, сообщения внутри чата - по порядку
+        .concurrent_updates(ChatOrderedUpdateProcessor(int(os.getenv('CONCURRENT_UPDATES', '32')),
+                                                       on_backlog=services.overload.set_backlog))
+        .post_init(on_init)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
     )
-    
+    if request is not None:
+        # Таймауты задаются самим транспортом
+        builder = builder.request(request)
+    else:
+        builder = (
+            builder
+            .connect_timeout(30.0)  # 30 seconds connection timeout
+            .read_timeout(30.0)     # 30 seconds read timeout
+            .write_timeout(30.0)    # 30 seconds write timeout
+            .pool_timeout(30.0)     # 30 seconds pool timeout
+        )
+    if not updater:
+        # Апдейты приходят не из Telegram напрямую, а через update_queue
+        builder = builder.updater(None)
+    application = builder.build()
+
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("gen", generate_command))
     application.add_handler(CommandHandler("clear", clear_command))
     application.add_handler(CommandHandler("rebuild", rebuild_command))
+    application.add_handler(CommandHandler("basemodel", basemodel_command))
+    application.add_handler(CommandHandler("retention", retention_command))
     application.add_handler(CommandHandler("sticker", sticker_command))
     application.add_handler(CommandHandler("top", top_command))
     application.add_handler(CommandHandler("mood", mood_command))
     application.add_handler(CommandHandler("weather", handle_weather_command))
-    
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("import", import_command))
+
     application.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
-    
+
     # Обработка текстовых сообщений и стикеров
     application.add_handler(MessageHandler(
         (filters.TEXT | filters.Sticker.ALL) & ~filters.COMMAND,
         handle_message
     ))
-    
+
     # Add error handler
     async def error_handler(update, context):
         logging.error(f"Exception while handling an update: {context.error}")
@@ -70,11 +146,55 @@ def main():
             await update.message.reply_text(
                 "⚠️ Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже."
             )
-    
+
     application.add_error_handler(error_handler)
-    
-    logging.info("Starting bot...")
-    application.run_polling()
+
+    # Плановая рассылка погоды (JobQueue есть только с python-telegram-bot[job-queue])
+    weather_interval = float(os.getenv('WEATHER_BROADCAST_INTERVAL', '10800'))
+    if application.job_queue is None:
+        logging.warning("JobQueue недоступна, рассылка погоды отключена")
+    elif weather_interval > 0:
+        application.job_queue.run_repeating(broadcast_weather, interval=weather_interval, name='weather_broadcast')
+
+    # Периодическая сборка общей модели (первая - вскоре после старта)
+    base_interval = float(os.getenv('BASE_MODEL_REBUILD_INTERVAL', '21600'))
+    if application.job_queue is not None and base_interval > 0:
+        application.job_queue.run_repeating(refresh_base_model, interval=base_interval,
+                                            first=60, name='base_model_refresh')
+
+    # Перенос старых сообщений в сжатый архив
+    retention_interval = float(os.getenv('RETENTION_INTERVAL', '3600'))
+    if application.job_queue is not None and retention_interval > 0:
+        application.job_queue.run_repeating(compact_history, interval=retention_interval,
+                                            first=600, name='history_compaction')
+    return application
+
+def main():
+    load_dotenv()
+    setup_logging()
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        raise ValueError("Не найден токен бота. Создайте файл .example.env с переменной BOT_TOKEN")
+
+    logging.info(f"Token starts with: {token[:10]}...")
+
+    # При BOT_WORKERS > 1 этот процесс только принимает апдейты
+    # и распределяет их по воркерам по chat_id
+    workers = int(os.getenv('BOT_WORKERS', '1'))
+    if workers > 1:
+        logging.info(f"Sharded mode: {workers} worker processes")
+        application = build_router_application(token, workers, build_application)
+    else:
+        application = build_application(token)
+
+    # Режим получения апдейтов: polling (по умолчанию) или webhook
+    mode = os.getenv('BOT_MODE', 'polling').lower()
+    if mode == 'webhook':
+        logging.info("Starting bot in webhook mode...")
+        run_webhook(application)
+    else:
+        logging.info("Starting bot...")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
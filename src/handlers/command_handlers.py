@@ -1,11 +1,24 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from .message_handlers import markov_generator, sticker_storage
+from ..services.container import services
+from ..services.profiling import profiler
+from ..services.shard_router import owns_chat
+import os
+import time
 import logging
 import random
+import asyncio
+import tempfile
 
 logger = logging.getLogger(__name__)
 
+# Telegram ID пользователей, которым доступны служебные команды
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+def is_admin(update: Update) -> bool:
+    """Отправитель апдейта - администратор бота"""
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     await update.message.reply_text(
@@ -25,11 +38,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "└─ /stats - Статистика обучения\n"
         "└─ /gen - Сгенерировать сообщение\n"
         "└─ /clear - Очистить память чата\n"
-        "└─ /rebuild - Пересобрать модель\n\n"
+        "└─ /rebuild - Пересобрать модель\n"
+        "└─ /basemodel [on|off] - Общая модель всех чатов\n"
+        "└─ /retention [дни|off] - Срок до переноса сообщений в архив\n\n"
         "*Развлечения:*\n"
         "└─ /sticker - Случайный стикер\n"
-        "└─ /top - Топ используемых слов\n"
-        "└─ /mood - Настроение чата\n\n"
+        "└─ /top [day|week|month] - Топ используемых слов\n"
+        "└─ /mood [hour|day|week] - Настроение чата\n"
+        "└─ /weather [on|off] - Погода и ее рассылка в чат\n"
+        "└─ /weather city <город> - Выбрать город для погоды\n\n"
         "❗️ Бот учится на ваших сообщениях.\n"
         "Первая модель создается после 20 сообщений.",
         parse_mode='Markdown'
@@ -38,7 +55,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статистику"""
     chat_id = update.effective_chat.id
-    stats = markov_generator.get_stats(chat_id)
+    # Для чата без загруженной модели статистика читает историю из MongoDB
+    stats = await asyncio.to_thread(services.markov_generator.get_stats, chat_id)
     await update.message.reply_text(stats)
 
 async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -55,7 +73,7 @@ async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Генерируем ответ с учетом контекста
-        response = markov_generator.generate_response(chat_id, input_text)
+        response = await services.generation_pool.generate_response(chat_id, input_text)
         
         if response:
             # Редактируем сообщение с результатом
@@ -81,7 +99,7 @@ async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Очистить память чата"""
     chat_id = update.effective_chat.id
-    if markov_generator.clear_memory(chat_id):
+    if await asyncio.to_thread(services.markov_generator.clear_memory, chat_id):
         await update.message.reply_text(
             "🧹 Память чата очищена!\n"
             "Бот начнет обучение заново."
@@ -96,7 +114,7 @@ async def rebuild_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем наличие сообщений
-    messages = markov_generator.db.get_messages(chat_id)
+    messages = await asyncio.to_thread(services.markov_generator.corpus.get_messages, chat_id)
     if not messages:
         await update.message.reply_text(
             "❌ Нет сообщений для построения модели!\n"
@@ -106,10 +124,10 @@ async def rebuild_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     # Проверяем количество валидных сообщений
     valid_messages = [msg for msg in messages if msg and len(msg.strip()) > 2]
-    if len(valid_messages) < markov_generator.min_messages:
+    if len(valid_messages) < services.markov_generator.min_messages:
         await update.message.reply_text(
             f"❌ Недостаточно сообщений для построения модели!\n"
-            f"Нужно минимум {markov_generator.min_messages} сообщений, "
+            f"Нужно минимум {services.markov_generator.min_messages} сообщений, "
             f"а у вас только {len(valid_messages)}."
         )
         return
@@ -118,7 +136,8 @@ async def rebuild_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status = await update.message.reply_text("🔄 Обновляю модель...")
     
     try:
-        if markov_generator.rebuild_model(chat_id):
+        # Через планировщик: пересборка в отдельном потоке, накопленные изменения сбрасываются
+        if await asyncio.to_thread(services.markov_generator.rebuilds.rebuild, chat_id):
             await status.edit_text("✅ Модель успешно обновлена!")
             logger.info(f"Модель для chat_id={chat_id} успешно обновлена")
         else:
@@ -129,13 +148,93 @@ async def rebuild_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(error_msg)
         await status.edit_text(error_msg)
 
+BASE_MODEL_TOGGLES = {'on': True, 'off': False}
+
+async def basemodel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Общая модель всех чатов, смешиваемая с моделью чата при генерации
+
+    /basemodel on|off - включить или выключить в чате (сообщения чата начнут или
+    перестанут попадать в общую модель при следующей сборке)
+    """
+    chat_id = update.effective_chat.id
+    base_model = services.base_model
+
+    if context.args and context.args[0].lower() in BASE_MODEL_TOGGLES:
+        enabled = BASE_MODEL_TOGGLES[context.args[0].lower()]
+        if await asyncio.to_thread(base_model.set_enabled, chat_id, enabled):
+            await update.message.reply_text(
+                "🌐 Общая модель включена: бот отвечает сразу, сообщения чата "
+                "попадут в общую модель при следующей сборке"
+                if enabled else "🌐 Общая модель отключена")
+            logger.info(f"Общая модель в чате {chat_id}: {'вкл' if enabled else 'выкл'}")
+        else:
+            await update.message.reply_text("❌ Не удалось сохранить настройку")
+        return
+
+    if base_model.is_enabled(chat_id):
+        status = "включена" if base_model.available() else "включена, еще не собрана"
+    else:
+        status = "выключена"
+    await update.message.reply_text(
+        f"🌐 Общая модель: {status}\n"
+        f"Ответы смешиваются из модели чата (вес {base_model.weight:.0%}) и общей модели, "
+        f"собранной по чатам, которые ее включили.\n"
+        f"Используйте /basemodel on или /basemodel off"
+    )
+
+async def refresh_base_model(context: ContextTypes.DEFAULT_TYPE):
+    """Плановая сборка (или перечитывание) общей модели"""
+    started = time.perf_counter()
+    if await asyncio.to_thread(services.base_model.refresh):
+        logger.info(f"Общая модель обновлена за {time.perf_counter() - started:.1f}s")
+
+async def retention_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Срок хранения сообщений в оперативной базе: более старые переносятся в сжатый архив
+    и продолжают использоваться для обучения
+
+    /retention <дни> - изменить срок, /retention off - не архивировать
+    """
+    chat_id = update.effective_chat.id
+    retention = services.retention
+
+    if context.args:
+        arg = context.args[0].lower()
+        try:
+            days = 0 if arg == 'off' else int(arg)
+            if days < 0:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("❌ Используйте: /retention <дни> или /retention off")
+            return
+        if await asyncio.to_thread(retention.set_retention_days, chat_id, days):
+            await update.message.reply_text(
+                f"🗄 Сообщения старше {days} дней будут переноситься в архив" if days
+                else "🗄 Архивация сообщений отключена")
+        else:
+            await update.message.reply_text("❌ Не удалось сохранить настройку")
+        return
+
+    days = await asyncio.to_thread(retention.retention_days, chat_id)
+    archive = await asyncio.to_thread(services.database.get_archive_stats, chat_id)
+    await update.message.reply_text(
+        f"🗄 Архивация: {f'старше {days} дней' if days else 'отключена'}\n"
+        f"└─ В архиве: {archive['messages']} сообщений ({archive['bytes'] // 1024}KB)\n"
+        f"Архивные сообщения по-прежнему используются для обучения"
+    )
+
+async def compact_history(context: ContextTypes.DEFAULT_TYPE):
+    """Плановый перенос старых сообщений в архив"""
+    await asyncio.to_thread(services.retention.run)
+
 async def sticker_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправить случайный стикер"""
     if not update.message:
         return
         
     chat_id = update.effective_chat.id
-    stickers = sticker_storage.get_stickers(chat_id)
+    stickers = services.sticker_storage.get_stickers(chat_id)
     
     if not stickers:
         await update.message.reply_text("❌ В этом чате пока нет сохраненных стикеров!")
@@ -148,54 +247,72 @@ async def sticker_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка при отправке стикера: {e}")
         await update.message.reply_text("❌ Не удалось отправить стикер")
 
+# Окна для /top: аргумент команды -> (дней, подпись)
+TOP_WINDOWS = {
+    'day': (1, 'за день'),
+    'week': (7, 'за неделю'),
+    'month': (30, 'за месяц'),
+}
+
 async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать топ используемых слов"""
     chat_id = update.effective_chat.id
-    messages = markov_generator.db.get_messages(chat_id)
-    
-    if not messages:
+    word_stats = services.markov_generator.word_stats
+
+    days, period = None, 'в чате'
+    if context.args:
+        window = TOP_WINDOWS.get(context.args[0].lower())
+        if not window:
+            await update.message.reply_text("❌ Используйте: /top [day|week|month]")
+            return
+        days, period = window
+
+    # Для чатов, которые писали до появления индекса, строим его один раз по истории
+    if not await asyncio.to_thread(word_stats.is_indexed, chat_id):
+        await asyncio.to_thread(
+            word_stats.rebuild, chat_id, services.markov_generator.corpus.iter_docs(chat_id))
+
+    top_words = await asyncio.to_thread(word_stats.get_top, chat_id, 10, days)
+    if not top_words:
         await update.message.reply_text("❌ История сообщений пуста")
         return
-        
-    # Собираем статистику слов
-    word_stats = {}
-    for msg in messages:
-        for word in msg.lower().split():
-            if len(word) > 2:  # Игнорируем короткие слова
-                word_stats[word] = word_stats.get(word, 0) + 1
-                
-    # Сортируем и берем топ-10
-    top_words = sorted(word_stats.items(), key=lambda x: x[1], reverse=True)[:10]
     
     # Форматируем ответ
-    response = "*📈 Топ-10 слов в чате:*\n\n"
+    response = f"*📈 Топ-10 слов {period}:*\n\n"
     for i, (word, count) in enumerate(top_words, 1):
         response += f"{i}. `{word}`: {count} раз\n"
         
     await update.message.reply_text(response, parse_mode='Markdown')
 
+# Окна для /mood: аргумент команды -> (часов, подпись)
+MOOD_WINDOWS = {
+    'hour': (1, 'за час'),
+    'day': (24, 'за день'),
+    'week': (24 * 7, 'за неделю'),
+}
+
 async def mood_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Анализ настроения чата"""
     chat_id = update.effective_chat.id
-    messages = markov_generator.db.get_messages(chat_id)
-    
-    if not messages:
-        await update.message.reply_text("❌ История сообщений пуста")
-        return
-        
+    mood_stats = services.markov_generator.mood_stats
+
+    hours, period = None, 'Текущее настроение'
+    if context.args:
+        window = MOOD_WINDOWS.get(context.args[0].lower())
+        if not window:
+            await update.message.reply_text("❌ Используйте: /mood [hour|day|week]")
+            return
+        hours, period = window[0], f"Настроение {window[1]}"
+
+    # Для чатов, которые писали до появления счетчиков, считаем их один раз по истории
+    if not await asyncio.to_thread(mood_stats.is_indexed, chat_id):
+        await asyncio.to_thread(
+            mood_stats.rebuild, chat_id, services.markov_generator.corpus.iter_docs(chat_id))
+
     # Простой анализ настроения по эмодзи и ключевым словам
-    positive = ['😊', '😄', '👍', '❤️', 'круто', 'класс', 'супер', 'отлично']
-    negative = ['😢', '😠', '👎', '💔', 'плохо', 'ужас', 'отстой']
-    
-    pos_count = 0
-    neg_count = 0
-    
-    for msg in messages:
-        msg_lower = msg.lower()
-        for word in positive:
-            pos_count += msg_lower.count(word)
-        for word in negative:
-            neg_count += msg_lower.count(word)
+    counts = await asyncio.to_thread(mood_stats.get_counts, chat_id, hours)
+    pos_count = counts['positive']
+    neg_count = counts['negative']
             
     total = pos_count + neg_count
     if total == 0:
@@ -217,7 +334,7 @@ async def mood_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     response = (
         f"*🎭 Анализ настроения чата*\n\n"
-        f"*Текущее настроение:* {mood}\n"
+        f"*{period}:* {mood}\n"
         f"*Настроение:* [{mood_bar}]\n\n"
         f"*Статистика:*\n"
         f"└─ Позитив: `{pos_count}`\n"
@@ -225,3 +342,113 @@ async def mood_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     await update.message.reply_text(response, parse_mode='Markdown')
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Профилирование следующих вызовов пересборки и генерации (только для администраторов)
+
+    /profile [N] [chat_id] - включить для N вызовов (по умолчанию 3) в этом или указанном чате
+    /profile off [chat_id] - выключить
+    """
+    if not is_admin(update):
+        await update.message.reply_text("❌ Команда доступна только администраторам бота")
+        return
+
+    args = list(context.args or [])
+    disable = bool(args) and args[0].lower() == 'off'
+    if disable:
+        args.pop(0)
+    try:
+        calls = 3 if disable or not args else int(args.pop(0))
+        chat_id = int(args[0]) if args else update.effective_chat.id
+    except ValueError:
+        await update.message.reply_text("❌ Используйте: /profile [N] [chat_id] или /profile off [chat_id]")
+        return
+
+    if not owns_chat(chat_id):
+        await update.message.reply_text(
+            "❌ Этот чат обслуживает другой воркер. Отправьте команду в самом чате")
+        return
+
+    if disable:
+        disabled = profiler.disarm(chat_id)
+        await update.message.reply_text(
+            "✅ Профилирование выключено" if disabled else "Профилирование для чата не было включено")
+        return
+
+    calls = profiler.arm(chat_id, calls)
+    await update.message.reply_text(
+        f"🔬 Профилирую следующие {calls} вызовов пересборки и генерации в чате `{chat_id}`.\n"
+        f"Отчеты: `{profiler.output_dir}`",
+        parse_mode='Markdown'
+    )
+
+# Больше 20 МБ бот скачать не может (ограничение Bot API getFile)
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Импорт истории чата из result.json Telegram Desktop (только для администраторов).
+    Команда отправляется ответом на сообщение с файлом экспорта
+    """
+    if not is_admin(update):
+        await update.message.reply_text("❌ Команда доступна только администраторам бота")
+        return
+
+    reply = update.message.reply_to_message
+    document = reply.document if reply else None
+    if not document:
+        await update.message.reply_text(
+            "❌ Отправьте result.json из экспорта Telegram Desktop и ответьте на него командой /import")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            "❌ Файл больше 20 МБ, бот не может его скачать.\n"
+            "Используйте `python -m src.tools.import_history result.json`",
+            parse_mode='Markdown'
+        )
+        return
+
+    chat_id = update.effective_chat.id
+    status = await update.message.reply_text("📥 Загружаю экспорт...")
+    loop = asyncio.get_running_loop()
+    last_report = [time.monotonic()]
+
+    async def report(text: str):
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.debug("Не удалось обновить статус импорта: %s", e)
+
+    def progress(stats: dict):
+        # Вызывается из потока импорта, статус обновляем не чаще раза в 10 секунд
+        if time.monotonic() - last_report[0] >= 10:
+            last_report[0] = time.monotonic()
+            asyncio.run_coroutine_threadsafe(
+                report(f"📥 Импортировано {stats['imported']} сообщений..."), loop)
+
+    with tempfile.TemporaryDirectory(prefix='ebanez-import-') as tmp:
+        path = os.path.join(tmp, 'result.json')
+        try:
+            file = await context.bot.get_file(document.file_id)
+            await file.download_to_drive(path)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке экспорта: {e}")
+            await report("❌ Не удалось скачать файл")
+            return
+
+        await report("📥 Импортирую сообщения...")
+        stats = await asyncio.to_thread(
+            services.history_importer.import_file, path, chat_id, progress)
+
+    text = (
+        f"{'⚠️' if stats['error'] else '✅'} Импорт завершен за {stats['seconds']}s\n"
+        f"└─ Импортировано: {stats['imported']}\n"
+        f"└─ Пропущено невалидных: {stats['invalid']}\n"
+        f"└─ Пропущено дубликатов: {stats['duplicates']}\n"
+        f"└─ Уже были импортированы: {stats['already_imported']}\n"
+        f"└─ Модель: {'построена' if stats['model_built'] else 'не построена'}"
+    )
+    if stats['error']:
+        text += f"\n\nОшибка: {stats['error']}"
+    await report(text)
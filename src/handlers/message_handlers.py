@@ -1,8 +1,13 @@
 from telegram import Update, ReactionTypeEmoji
+from telegram.error import BadRequest, Forbidden, NetworkError
 from telegram.ext import ContextTypes
-from ..services.markov_chain import MarkovChainGenerator
-from ..services.sticker_storage import StickerStorage
-from ..services.weather_service import WeatherService
+from ..services.container import services
+from ..services.outbound_queue import Priority
+from ..services.shard_router import owns_chat
+from ..services.metrics import timed
+from ..log_config import log_sampled
+import os
+import time
 import logging
 import random
 import asyncio
@@ -10,9 +15,6 @@ import asyncio
 # Настраиваем логирование
 logger = logging.getLogger(__name__)
 
-markov_generator = MarkovChainGenerator()
-sticker_storage = StickerStorage()
-weather_service = WeatherService()
 
 # Эмодзи для реакций
 REACTIONS = [
@@ -20,67 +22,74 @@ REACTIONS = [
     "🫡", "🗿", "🤨", "🥹", "🫢", "🤌", "💅", "🤡", "🥸", "🤪", "🍌", "🤡", "❤️", "💕", "🤣", "💩"
 ]
 
+# Аргументы /weather для включения и отключения рассылки
+WEATHER_TOGGLES = {'on': True, 'off': False}
 
+# Сколько чатов одновременно ждут отправки погоды и сколько попыток на чат
+WEATHER_BROADCAST_CONCURRENCY = int(os.getenv('WEATHER_BROADCAST_CONCURRENCY', '50'))
+WEATHER_BROADCAST_RETRIES = int(os.getenv('WEATHER_BROADCAST_RETRIES', '3'))
+
+
+@timed('handler')
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка входящего сообщения"""
+    with services.overload.track():
+        await _process_message(update, context)
+
+
+async def _process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сохранение сообщения и необязательная реакция бота на него"""
     chat_id = update.effective_chat.id
-    logger.info(f"Получено сообщение от chat_id={chat_id}")
 
     # Проверяем тип сообщения
     if not update.message:
-        logger.info("Сообщение пустое")
+        logger.debug("Сообщение пустое")
         return
 
-    logger.info(f"Тип сообщения: {type(update.message)}")
-    logger.info(
-        f"Атрибуты сообщения: text={update.message.text}, sticker={update.message.sticker}")
-
     # Сохраняем стикеры, если они есть в сообщении
     if update.message.sticker:
         sticker = update.message.sticker
-        logger.info(
-            f"Получен стикер: file_id={sticker.file_id}, set_name={sticker.set_name}")
+        log_sampled(logger, "Получен стикер: chat_id=%s, file_id=%s, set_name=%s",
+                    chat_id, sticker.file_id, sticker.set_name)
 
         try:
             # Сохраняем текущий стикер
-            if sticker_storage.add_sticker(chat_id, sticker.file_id):
-                logger.info(f"Стикер {sticker.file_id} успешно сохранен")
-            else:
-                logger.info(
-                    f"Стикер {sticker.file_id} уже существует или не удалось сохранить")
-
-            # Если есть набор стикеров, получаем его
-            if sticker.set_name:
+            services.sticker_storage.add_sticker(chat_id, sticker.file_id)
+
+            # Если есть набор стикеров, получаем его (при перегрузке пропускаем)
+            if sticker.set_name and not services.overload.should_shed('sticker_set'):
                 sticker_set = await context.bot.get_sticker_set(sticker.set_name)
-                logger.info(
-                    f"Получен набор стикеров {sticker_set.name} ({len(sticker_set.stickers)} стикеров)")
+                logger.debug("Получен набор стикеров %s (%d стикеров)",
+                             sticker_set.name, len(sticker_set.stickers))
 
                 # Сохраняем все стикеры из набора
                 saved_count = 0
                 for s in sticker_set.stickers:
-                    if sticker_storage.add_sticker(chat_id, s.file_id):
+                    if services.sticker_storage.add_sticker(chat_id, s.file_id):
                         saved_count += 1
-                logger.info(
-                    f"Сохранено {saved_count} новых стикеров из набора {sticker_set.name}")
+                if saved_count:
+                    logger.info("Сохранено %d новых стикеров из набора %s", saved_count, sticker_set.name)
 
-            # Проверяем количество сохраненных стикеров
-            saved_stickers = sticker_storage.get_stickers(chat_id)
-            logger.info(
-                f"Всего сохранено стикеров для чата {chat_id}: {len(saved_stickers)}")
+            if services.overload.should_shed('sticker_echo'):
+                return
 
             # Отправляем тот же стикер в ответ
-            await context.bot.send_sticker(chat_id=chat_id, sticker=sticker.file_id)
-            logger.info(f"Отправлен стикер {sticker.file_id} в ответ")
+            services.outbound.submit(
+                chat_id,
+                lambda: context.bot.send_sticker(chat_id=chat_id, sticker=sticker.file_id),
+                Priority.MEDIA,
+                coalesce_key=('sticker_echo', chat_id)
+            )
 
         except Exception as e:
-            logger.error(f"Ошибка при обработке стикера: {str(e)}")
+            logger.error("Ошибка при обработке стикера: %s", e)
         return
 
     if not update.message or not update.message.text:
         return
 
     message = update.message.text.strip()
-    logger.info(f"Получено сообщение от chat_id={chat_id}: {message}")
+    log_sampled(logger, "Получено сообщение от chat_id=%s: %.50s", chat_id, message)
 
     if message.startswith('/'):
         return
@@ -94,101 +103,147 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Добавляем сообщение в базу для обучения
-        message_added, is_valid = markov_generator.add_message(
+        message_added, is_valid = services.markov_generator.add_message(
             chat_id, message_text)
-        model_path = markov_generator.get_model_path(chat_id)
-
-        # Проверяем, нужно ли обновить модель
-        stats = markov_generator.db.get_chat_stats(chat_id)
-        total_messages = stats['total_messages'] if stats else 0
+        model_path = services.markov_generator.get_model_path(chat_id)
 
         # Реагируем на валидные сообщения
         if message_added and is_valid:
             try:
                 # Если модель еще не создана, показываем прогресс
                 if not model_path.exists():
+                    total_messages = services.markov_generator.db.get_message_count(chat_id)
                     progress = (total_messages / 50) * 100  # 50 - min_messages
                     progress = min(int(progress), 100)
                     progress_bar = "▓" * (progress // 10) + \
                         "░" * (10 - (progress // 10))
 
-                    if total_messages % 5 == 0:  # Каждые 5 сообщений
-                        await update.message.reply_text(
+                    if total_messages % 5 == 0 and not services.overload.should_shed('progress'):  # Каждые 5 сообщений
+                        # Если прогресс еще не отправлен, показываем только последний
+                        text = (
                             f"Собираю сообщения для обучения... {progress}%\n"
                             f"[{progress_bar}]\n"
                             f"Нужно еще {max(0, 50 - total_messages)} сообщений"
                         )
+                        services.outbound.submit(
+                            chat_id,
+                            lambda: update.message.reply_text(text),
+                            Priority.PROGRESS,
+                            coalesce_key=('progress', chat_id)
+                        )
                 else:
                     # Если модель уже есть, иногда реагируем эмодзи
                     if random.random() < 0.1:  # 10% шанс на реакцию
-                        await update.message.set_reaction([ReactionTypeEmoji(random.choice(REACTIONS))])
+                        submit_reaction(update)
 
             except Exception as e:
-                logger.error(f"Ошибка при обработке сообщения: {e}")
+                logger.error("Ошибка при обработке сообщения: %s", e)
 
-        # Отвечаем на сообщения только если модель существует
-        if model_path.exists():
+        # Отвечаем на сообщения только если есть своя или общая модель
+        if model_path.exists() or services.markov_generator.has_base_model(chat_id):
             # Определяем вероятность ответа на основе длины сообщения
             message_length = len(message_text.split())
             # 5-15% в зависимости от длины
             reply_chance = 0.05 + (0.01 * min(message_length, 10))
 
             # Увеличиваем шанс ответа, если бота упомянули
-            if update.message.entities and any(e.type == 'mention' for e in update.message.entities):
+            mentioned = bool(update.message.entities) and any(
+                e.type == 'mention' for e in update.message.entities)
+            if mentioned:
                 reply_chance = 1  # 100% шанс ответа при упоминании
 
+            # При перегрузке отвечаем только на упоминания
+            if not mentioned and services.overload.should_shed('auto_reply'):
+                return
+
             # Случайным образом решаем, отвечать ли на сообщение
-            if random.random() < reply_chance:
+            response_type = random.random()
+            if response_type < reply_chance:
                 # Показываем статус "печатает..."
-                status_msg = await update.message.reply_chat_action('typing')
+                services.outbound.submit(
+                    chat_id,
+                    lambda: update.message.reply_chat_action('typing'),
+                    Priority.TYPING,
+                    coalesce_key=('typing', chat_id),
+                    replace=False
+                )
 
                 try:
-                    # Генерируем ответ с учетом контекста сообщения
-                    response = markov_generator.generate_response(
-                        chat_id, message_text)
+                    # Генерируем ответ в пуле потоков, не блокируя event loop.
+                    # Случайные ответы пропускаем, если пул занят
+                    response = await services.generation_pool.generate_response(
+                        chat_id, message_text, block=mentioned)
 
                     if response:
-                        # Добавляем небольшую задержку для естественности
-                        await asyncio.sleep(1 + random.random() * 2)
-
-                        # Отвечаем на сообщение
-                        await update.message.reply_text(
-                            response,
-                            reply_to_message_id=update.message.message_id
+                        # Отвечаем с небольшой задержкой для естественности
+                        services.outbound.submit(
+                            chat_id,
+                            lambda: update.message.reply_text(
+                                response,
+                                reply_to_message_id=update.message.message_id
+                            ),
+                            Priority.REPLY,
+                            delay=1 + random.random() * 2
                         )
                 except Exception as e:
-                    logger.error(f"Ошибка при генерации ответа: {e}")
+                    logger.error("Ошибка при генерации ответа: %s", e)
 
             # 15% шанс добавить реакцию
-            elif response_type < 0.10:
-                try:
-                    reaction = random.choice(REACTIONS)
-                    await update.message.set_reaction([ReactionTypeEmoji(reaction)])
-                    logger.info(f"Добавлена реакция {reaction} к сообщению")
-                except Exception as e:
-                    logger.error(f"Ошибка при добавлении реакции: {e}")
+            elif response_type < reply_chance + 0.15:
+                submit_reaction(update)
 
             # 10% шанс отправить стикер
-            elif response_type < 0.10:
-                sticker_id = sticker_storage.get_random_sticker(chat_id)
+            elif response_type < reply_chance + 0.25:
+                sticker_id = services.sticker_storage.get_random_sticker(chat_id)
                 if sticker_id:
-                    try:
-                        await update.message.reply_sticker(sticker_id)
-                        logger.info(f"Отправлен стикер {sticker_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке стикера: {str(e)}")
-                else:
-                    logger.info(
-                        f"Нет доступных стикеров для chat_id={chat_id}")
+                    services.outbound.submit(
+                        chat_id,
+                        lambda: update.message.reply_sticker(sticker_id),
+                        Priority.MEDIA
+                    )
+                    log_sampled(logger, "Стикер %s поставлен в очередь на отправку", sticker_id)
+
+
+def submit_reaction(update: Update):
+    """Постановка случайной реакции на сообщение в очередь (одна на сообщение)"""
+    if services.overload.should_shed('reaction'):
+        return
+    reaction = random.choice(REACTIONS)
+    services.outbound.submit(
+        update.effective_chat.id,
+        lambda: update.message.set_reaction([ReactionTypeEmoji(reaction)]),
+        Priority.REACTION,
+        coalesce_key=('reaction', update.effective_chat.id, update.message.message_id)
+    )
+    log_sampled(logger, "Реакция %s поставлена в очередь", reaction)
 
 
 async def handle_weather_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /weather - отправляет информацию о погоде"""
+    """
+    Обработчик команды /weather - отправляет информацию о погоде в городе чата.
+    /weather on|off включает или отключает плановую рассылку погоды в чат,
+    /weather city <название> выбирает город
+    """
     chat_id = update.effective_chat.id
     logger.info(f"Получена команда /weather в чате {chat_id}")
 
+    if context.args and context.args[0].lower() in WEATHER_TOGGLES:
+        enabled = WEATHER_TOGGLES[context.args[0].lower()]
+        if await asyncio.to_thread(services.weather_service.set_weather_enabled, chat_id, enabled):
+            await update.message.reply_text(
+                "🌤 Рассылка погоды включена" if enabled else "🌤 Рассылка погоды отключена")
+            logger.info(f"Рассылка погоды в чате {chat_id}: {'вкл' if enabled else 'выкл'}")
+        else:
+            await update.message.reply_text("❌ Не удалось сохранить настройку")
+        return
+
+    if context.args and context.args[0].lower() == 'city':
+        await _set_weather_city(update, chat_id, ' '.join(context.args[1:]))
+        return
+
     try:
-        weather_message = await weather_service.get_weather_and_traffic()
+        location = await asyncio.to_thread(services.weather_service.get_location, chat_id)
+        weather_message = await services.weather_service.get_weather_and_traffic(location)
         await update.message.reply_text(weather_message)
         logger.info(f"Отправлена информация о погоде в чат {chat_id}")
     except Exception as e:
@@ -197,6 +252,34 @@ async def handle_weather_command(update: Update, context: ContextTypes.DEFAULT_T
         logger.error(f"Ошибка при обработке команды /weather: {e}")
 
 
+async def _set_weather_city(update: Update, chat_id: int, name: str):
+    """Выбор города для погоды в чате"""
+    if not name.strip():
+        location = await asyncio.to_thread(services.weather_service.get_location, chat_id)
+        await update.message.reply_text(
+            f"🏙 Текущий город: {location['city']}\n"
+            f"Чтобы сменить, напишите /weather city <название>"
+        )
+        return
+
+    try:
+        location = await services.weather_service.geocode(name)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске города {name}: {e}")
+        await update.message.reply_text("Не удалось найти город, попробуйте позже 😔")
+        return
+
+    if location is None:
+        await update.message.reply_text(f"🤷‍♂️ Город «{name}» не найден")
+        return
+
+    if await asyncio.to_thread(services.weather_service.set_location, chat_id, location):
+        await update.message.reply_text(f"🏙 Город для погоды: {location['city']}")
+        logger.info(f"Город для погоды в чате {chat_id}: {location['city']}")
+    else:
+        await update.message.reply_text("❌ Не удалось сохранить настройку")
+
+
 async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка добавления бота в чат"""
     if not update.my_chat_member or not update.my_chat_member.new_chat_member:
@@ -206,24 +289,8 @@ async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TY
     if update.my_chat_member.new_chat_member.status in ['member', 'administrator']:
         chat_id = update.effective_chat.id
         logger.info(f"Бот добавлен в чат {chat_id}")
-
-        # Получаем историю сообщений
-        messages = []
-        try:
-            chat = await context.bot.get_chat(chat_id)
-            # Note: get_messages is not directly available in python-telegram-bot
-            # This needs to be implemented using get_updates or another method
-            logger.warning("Получение истории сообщений не реализовано")
-        except Exception as e:
-            logger.error(f"Ошибка при получении истории: {e}")
-            logger.exception("Подробности ошибки:")
-
-        # Добавляем сообщения в базу
-        added_count = 0
-        for message in messages:
-            if markov_generator.add_message(chat_id, message.text):
-                added_count += 1
-        logger.info(f"Добавлено {added_count} сообщений в базу")
+        # Bot API не отдает историю чата: ее можно загрузить из экспорта
+        # Telegram Desktop командой /import или src.tools.import_history
 
         # Отправляем приветственное сообщение
         await context.bot.send_message(
@@ -238,32 +305,69 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     if query.data == 'option1':
-        response = markov_generator.generate_response()
+        response = services.markov_generator.generate_response()
         await query.message.reply_text(response)
     elif query.data == 'option2':
-        stats = markov_generator.get_stats()
+        stats = services.markov_generator.get_stats()
         await query.message.reply_text(stats)
 
 
-async def send_weather_updates(context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет обновления погоды в активированные группы"""
-    while True:
-        try:
-            weather_message = await weather_service.get_weather_and_traffic()
-
-            for chat_id in weather_service.weather_enabled_groups:
-                try:
-                    await context.bot.send_message(chat_id=chat_id, text=weather_message)
-                    logger.info(
-                        f"Отправлено сообщение о погоде в чат {chat_id}")
-                except Exception as e:
-                    logger.error(
-                        f"Ошибка при отправке погоды в чат {chat_id}: {e}")
+async def _send_weather(bot, chat_id: int, text: str, semaphore: asyncio.Semaphore) -> bool:
+    """Отправка погоды в один чат с повторами при сетевых ошибках"""
+    async with semaphore:
+        for attempt in range(1, WEATHER_BROADCAST_RETRIES + 1):
+            try:
+                # Лимиты Telegram и повторы после 429 соблюдает очередь исходящих действий
+                result = await services.outbound.submit(
+                    chat_id,
+                    lambda: bot.send_message(chat_id=chat_id, text=text),
+                    Priority.BROADCAST,
+                    raise_errors=True
+                )
+                return result is not None
+            except Forbidden as e:
+                # Бота удалили из чата - рассылать туда больше нечего
+                logger.warning(f"Рассылка погоды в чат {chat_id} отключена: {e}")
+                await asyncio.to_thread(services.weather_service.set_weather_enabled, chat_id, False)
+                return False
+            except BadRequest as e:
+                # BadRequest наследует NetworkError, но повтор тут не поможет
+                logger.error(f"Ошибка при отправке погоды в чат {chat_id}: {e}")
+                return False
+            except NetworkError as e:
+                if attempt == WEATHER_BROADCAST_RETRIES:
+                    logger.error(f"Ошибка при отправке погоды в чат {chat_id}: {e}")
+                    return False
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке погоды в чат {chat_id}: {e}")
+                return False
+    return False
+
+
+async def broadcast_weather(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Плановая рассылка погоды: прогноз для всех городов запрашивается одним пакетом
+    и отправляется во все включенные чаты
+    """
+    started = time.perf_counter()
+    targets = await asyncio.to_thread(services.weather_service.get_broadcast_targets)
+    # В шардированном режиме каждый воркер рассылает только в свои чаты
+    targets = {chat_id: location for chat_id, location in targets.items() if owns_chat(chat_id)}
+    if not targets:
+        return
 
-            # Ждем 3 часа перед следующим обновлением
-            await asyncio.sleep(10800)  # 3 часа в секундах
+    try:
+        messages = await services.weather_service.fetch_weather_messages(targets)
+    except Exception as e:
+        logger.error(f"Рассылка погоды пропущена, не удалось получить прогноз: {e}")
+        return
 
-        except Exception as e:
-            logger.error(f"Ошибка в цикле отправки погоды: {e}")
-            # Подождем 5 минут перед повторной попыткой
-            await asyncio.sleep(300)
+    semaphore = asyncio.Semaphore(WEATHER_BROADCAST_CONCURRENCY)
+    results = await asyncio.gather(*(
+        _send_weather(context.bot, chat_id, text, semaphore) for chat_id, text in messages.items()
+    ))
+    logger.info(
+        f"Рассылка погоды: отправлено {sum(results)}/{len(messages)} "
+        f"за {time.perf_counter() - started:.2f}s"
+    )
@@ -0,0 +1,113 @@
+import os
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from typing import Optional
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Стандартные атрибуты LogRecord; все остальное - поля из extra
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_sample_rate = 1.0
+_listener: Optional[logging.handlers.QueueListener] = None
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и поля из extra"""
+
+    def __init__(self, static_fields: Optional[dict] = None):
+        super().__init__()
+        self.static_fields = static_fields or {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        payload.update(self.static_fields)
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    В очередь кладется копия записи с уже подставленными аргументами
+    (они могут измениться после возврата из обработчика). Трейсбек хранится
+    отдельно от текста, чтобы JSON-формат мог вывести его отдельным полем
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_exception_formatter = logging.Formatter()
+
+def setup_logging(shard_id: Optional[int] = None):
+    """
+    Настройка логирования процесса
+
+    LOG_LEVEL - уровень, LOG_FORMAT - text или json, LOG_QUEUE=0 - писать синхронно.
+    По умолчанию обработчики пишут из фонового потока QueueListener, а
+    обработчики апдейтов только кладут запись в очередь.
+    LOG_SAMPLE_RATE - доля выводимых построчных DEBUG-записей о сообщениях.
+    """
+    global _sample_rate, _listener
+
+    _sample_rate = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))
+    level = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+    handler = logging.StreamHandler()
+    if os.getenv('LOG_FORMAT', 'text').lower() == 'json':
+        handler.setFormatter(JsonFormatter({'shard': shard_id} if shard_id is not None else None))
+    elif shard_id is not None:
+        handler.setFormatter(logging.Formatter(
+            f'%(asctime)s - shard-{shard_id} - %(name)s - %(levelname)s - %(message)s'))
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+
+    _stop_listener()
+
+    if os.getenv('LOG_QUEUE', '1') != '0':
+        log_queue = queue.SimpleQueue()
+        root.addHandler(_QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+        _listener.start()
+    else:
+        root.addHandler(handler)
+
+@atexit.register
+def _stop_listener():
+    """Дописываем оставшиеся в очереди записи при завершении процесса"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def log_sampled(logger: logging.Logger, msg: str, *args, level: int = logging.DEBUG):
+    """
+    Запись о конкретном сообщении с сэмплированием по LOG_SAMPLE_RATE.
+    Если уровень отключен или запись не попала в выборку, аргументы не форматируются
+    """
+    if logger.isEnabledFor(level) and (_sample_rate >= 1 or random.random() < _sample_rate):
+        logger.log(level, msg, *args, stacklevel=2)
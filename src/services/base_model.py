@@ -0,0 +1,233 @@
+import os
+import json
+import random
+import logging
+import threading
+import functools
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Set
+import markovify
+from markovify.chain import BEGIN
+from .chat_settings import ChatSettings
+from .markov_chain import MarkovChainGenerator, _atomic_write
+from .metrics import timed, MODEL_REBUILDS
+from .shard_router import current_shard
+
+logger = logging.getLogger(__name__)
+
+class LayeredChain(markovify.Chain):
+    """
+    Цепь-смесь общей модели и модели чата без слияния словарей переходов.
+
+    Следующее слово выбирается из модели чата с вероятностью weight и из общей
+    модели с вероятностью 1 - weight: P(w|s) = weight * P_чат(w|s) + (1 - weight) * P_общая(w|s).
+    Если состояния нет в одном из слоев, слово берется из другого
+    """
+
+    def __init__(self, base: markovify.Chain, overlay: Optional[markovify.Chain], weight: float):
+        # Конструктор родителя строит цепь по корпусу, здесь строить нечего
+        self.state_size = base.state_size
+        self.base = base
+        self.overlay = overlay
+        self.weight = weight
+        self.compiled = False
+
+    @property
+    def model(self):
+        return self.overlay.model if self.overlay is not None else self.base.model
+
+    def move(self, state):
+        overlay = self.overlay
+        if overlay is not None and state in overlay.model:
+            if random.random() < self.weight or state not in self.base.model:
+                return overlay.move(state)
+        return self.base.move(state)
+
+class LayeredText(markovify.Text):
+    """Генератор текста поверх LayeredChain (только генерация, без обучения)"""
+
+    def __init__(self, chain: LayeredChain, overlay: Optional[markovify.Text] = None):
+        self.state_size = chain.state_size
+        self.chain = chain
+        self.retain_original = False
+        self.well_formed = False
+        # Проверка на дословные повторы - только по сообщениям своего чата
+        if overlay is not None and getattr(overlay, 'rejoined_text', None):
+            self.retain_original = True
+            self.parsed_sentences = overlay.parsed_sentences
+            self.rejoined_text = overlay.rejoined_text
+
+    @functools.lru_cache(maxsize=1)
+    def find_init_states_from_chain(self, split):
+        """
+        Начальные состояния, содержащие split: полный перебор только по модели чата,
+        в общей модели (миллионы состояний) - только начала сообщений
+        """
+        states = []
+        if self.chain.overlay is not None:
+            states = [
+                key for key in self.chain.overlay.model.keys()
+                if tuple(word for word in key if word != BEGIN)[:len(split)] == split
+            ]
+        # Обучающие строки начинаются с маркера START (см. prepare_training_lines)
+        begin = (BEGIN,) * (self.state_size - len(split) - 1) + ('START',) + split
+        if begin not in states and (begin in self.chain.base.model or (
+                self.chain.overlay is not None and begin in self.chain.overlay.model)):
+            states.append(begin)
+        return states
+
+class SharedBaseModel:
+    """
+    Общая модель по сообщениям всех чатов, включивших /basemodel on.
+
+    При генерации она смешивается с моделью чата (слой чата с весом BASE_MODEL_WEIGHT),
+    поэтому новые чаты получают ответы сразу, а модель чата можно обучать только
+    на последних BASE_OVERLAY_MAX_MESSAGES сообщениях: общий словарь и частые обороты
+    уже есть в общей модели. Общая модель собирается периодически (refresh),
+    из каждого чата берется не больше BASE_MODEL_PER_CHAT последних сообщений,
+    чтобы один большой чат не задавал стиль остальным. В шардированном режиме модель
+    собирает только нулевой шард, остальные перечитывают файл
+    """
+
+    def __init__(self, generator: MarkovChainGenerator, settings: ChatSettings):
+        self.generator = generator
+        self.settings = settings
+        self.weight = float(os.getenv('BASE_MODEL_WEIGHT', '0.7'))
+        self.per_chat = int(os.getenv('BASE_MODEL_PER_CHAT', '20000'))
+        self.max_messages = int(os.getenv('BASE_MODEL_MAX_MESSAGES', '300000'))
+        self.overlay_max_messages = int(os.getenv('BASE_OVERLAY_MAX_MESSAGES', '5000'))
+        self.chats: Set[int] = set()
+        self.chain: Optional[markovify.Chain] = None
+        self._loaded_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Path:
+        return self.generator.models_dir / 'base_model.json'
+
+    @property
+    def meta_path(self) -> Path:
+        return self.generator.models_dir / 'base_model.meta.json'
+
+    def init_storage(self):
+        """Загрузка списка чатов, использующих общую модель"""
+        self.chats = {doc['chat_id'] for doc in self.settings.find(base_model=True)}
+        logger.info(f"Общую модель используют чатов: {len(self.chats)}")
+
+    def is_enabled(self, chat_id: int) -> bool:
+        return chat_id in self.chats
+
+    def set_enabled(self, chat_id: int, enabled: bool) -> bool:
+        """Включение или отключение общей модели в чате"""
+        if not self.settings.update(chat_id, base_model=enabled):
+            return False
+        if enabled:
+            self.chats.add(chat_id)
+        else:
+            self.chats.discard(chat_id)
+        return True
+
+    def available(self) -> bool:
+        return self.chain is not None or self.path.exists()
+
+    def get_chain(self) -> Optional[markovify.Chain]:
+        """Общая модель (загружается с диска при первом обращении)"""
+        if self.chain is None:
+            self.reload()
+        return self.chain
+
+    @timed('markov')
+    def reload(self) -> bool:
+        """Перечитать файл общей модели, если он изменился"""
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            return False
+        with self._lock:
+            if self.chain is not None and mtime == self._loaded_mtime:
+                return True
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    chain = markovify.Chain.from_json(f.read())
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке общей модели: {e}")
+                return False
+            if chain.state_size != self.generator.state_size:
+                logger.error(f"У общей модели state_size={chain.state_size}, "
+                             f"ожидался {self.generator.state_size}; модель не используется")
+                return False
+            self.chain = chain
+            self._loaded_mtime = mtime
+        logger.info(f"Общая модель загружена: {len(chain.model)} состояний")
+        return True
+
+    def layered(self, chat_id: int, overlay: Optional[markovify.Text]) -> Optional[markovify.Text]:
+        """Модель для генерации в чате: смесь общей модели и модели чата"""
+        if not self.is_enabled(chat_id):
+            return overlay
+        base = self.get_chain()
+        if base is None:
+            return overlay
+        overlay_chain = overlay.chain if overlay is not None else None
+        return LayeredText(LayeredChain(base, overlay_chain, self.weight), overlay)
+
+    def refresh(self) -> bool:
+        """Плановое обновление: сборка на нулевом шарде, перечитывание файла на остальных"""
+        shard_id, _ = current_shard()
+        return self.rebuild() if shard_id == 0 else self.reload()
+
+    def _training_lines(self):
+        """Подготовленные сообщения включивших общую модель чатов (свежие в первую очередь)"""
+        chat_ids = sorted(doc['chat_id'] for doc in self.settings.find(base_model=True))
+        total = 0
+        for chat_id in chat_ids:
+            # Архив тоже: иначе после архивации общая модель учится только на последних днях
+            messages = self.generator.db.get_messages(chat_id, limit=self.per_chat, include_archive=True)
+            for line in self.generator.prepare_training_lines(reversed(messages)):
+                yield line
+                total += 1
+                if total >= self.max_messages:
+                    return
+
+    @timed('markov')
+    def rebuild(self) -> bool:
+        """Сборка общей модели; пропускается, если обучающие данные не изменились"""
+        try:
+            lines = list(self._training_lines())
+            if len(lines) < self.generator.min_messages:
+                logger.info(f"Недостаточно сообщений для общей модели: {len(lines)}")
+                return False
+
+            text = "\n".join(lines)
+            fingerprint = self.generator._fingerprint(text)
+            meta = {}
+            try:
+                with open(self.meta_path, encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                pass
+            if meta.get('fingerprint') == fingerprint and self.path.exists():
+                MODEL_REBUILDS.inc(result='base_unchanged')
+                return self.reload()
+
+            # Исходные предложения общей модели не хранятся: проверка на повторы
+            # идет по сообщениям чата, а память занимает только цепь
+            model = markovify.NewlineText(text, state_size=self.generator.state_size,
+                                          well_formed=False, retain_original=False)
+            _atomic_write(self.path, model.chain.to_json())
+            _atomic_write(self.meta_path, json.dumps({
+                'fingerprint': fingerprint,
+                'messages': len(lines),
+                'saved_at': datetime.utcnow().isoformat(timespec='seconds'),
+            }))
+            with self._lock:
+                self.chain = model.chain
+                self._loaded_mtime = self.path.stat().st_mtime
+            MODEL_REBUILDS.inc(result='base_built')
+            logger.info(f"Общая модель собрана по {len(lines)} сообщениям: {len(model.chain.model)} состояний")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка при сборке общей модели: {e}", exc_info=True)
+            return False
@@ -0,0 +1,77 @@
+import os
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.database import Database as MongoDatabase
+
+logger = logging.getLogger(__name__)
+
+class ChatSettings:
+    """Настройки чатов (рассылка погоды, общая модель и т.п.), хранятся в MongoDB"""
+
+    def __init__(self, client: Optional[MongoClient] = None):
+        mongodb_uri = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/ebanez')
+        self.client = client or MongoClient(mongodb_uri)
+        self.db: MongoDatabase = self.client.get_database()
+        self.settings: Collection = self.db.chat_settings
+
+    def init_storage(self):
+        """Создание индексов и перенос чатов с погодой из WEATHER_CHATS"""
+        try:
+            self.settings.create_index('chat_id', unique=True)
+            self.settings.create_index('weather_enabled', sparse=True)
+            self.settings.create_index('base_model', sparse=True)
+
+            # Чаты из переменной окружения включаются только если для них еще нет настройки,
+            # чтобы /weather off не перезаписывался при каждом старте
+            for chat_id in self._parse_chat_ids(os.getenv('WEATHER_CHATS', '')):
+                self.settings.update_one(
+                    {'chat_id': chat_id},
+                    {'$setOnInsert': {'weather_enabled': True, 'updated_at': datetime.utcnow()}},
+                    upsert=True
+                )
+            logger.info("Хранилище настроек чатов инициализировано")
+
+        except Exception as e:
+            logger.error(f"Ошибка при инициализации настроек чатов: {e}")
+
+    @staticmethod
+    def _parse_chat_ids(value: str) -> List[int]:
+        chat_ids = []
+        for part in value.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                chat_ids.append(int(part))
+            except ValueError:
+                logger.warning(f"Некорректный chat_id в WEATHER_CHATS: {part}")
+        return chat_ids
+
+    def get(self, chat_id: int) -> Dict[str, Any]:
+        """Все настройки чата (пустой словарь, если их нет)"""
+        try:
+            return self.settings.find_one({'chat_id': chat_id}, {'_id': 0}) or {}
+        except Exception as e:
+            logger.error(f"Ошибка при получении настроек чата {chat_id}: {e}")
+            return {}
+
+    def update(self, chat_id: int, **fields) -> bool:
+        """Изменение настроек чата"""
+        try:
+            fields['updated_at'] = datetime.utcnow()
+            self.settings.update_one({'chat_id': chat_id}, {'$set': fields}, upsert=True)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении настроек чата {chat_id}: {e}")
+            return False
+
+    def find(self, **query) -> List[Dict[str, Any]]:
+        """Настройки всех чатов, подходящих под условие"""
+        try:
+            return list(self.settings.find(query, {'_id': 0}))
+        except Exception as e:
+            logger.error(f"Ошибка при поиске настроек чатов: {e}")
+            return []
@@ -0,0 +1,235 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Optional
+from pymongo import MongoClient
+from .database import Database
+from .markov_chain import MarkovChainGenerator
+from .base_model import SharedBaseModel
+from .sticker_storage import StickerStorage
+from .chat_settings import ChatSettings
+from .weather_service import WeatherService
+from .history_import import HistoryImporter
+from .retention import RetentionManager
+from .generation_pool import GenerationPool
+from .outbound_queue import OutboundScheduler
+from .overload import OverloadController
+from .metrics import registry, process_memory_bytes
+from .model_warmup import MODEL_MEMORY_FACTOR
+
+logger = logging.getLogger(__name__)
+
+class ServiceContainer:
+    """
+    Ленивый контейнер сервисов бота.
+
+    Сервисы создаются при первом обращении и не выполняют запросов в конструкторах.
+    Индексы и проверки базы выполняются в фоне на этапе startup(), уже после того,
+    как бот проверил токен и начал принимать апдейты. Фоновые задачи, которым нужно
+    восстановленное состояние, дожидаются storage_ready().
+    """
+
+    def __init__(self, mongo_client: Optional[MongoClient] = None):
+        self._mongo_client = mongo_client
+        self._database: Optional[Database] = None
+        self._markov_generator: Optional[MarkovChainGenerator] = None
+        self._sticker_storage: Optional[StickerStorage] = None
+        self._chat_settings: Optional[ChatSettings] = None
+        self._weather_service: Optional[WeatherService] = None
+        self._history_importer: Optional[HistoryImporter] = None
+        self._retention: Optional[RetentionManager] = None
+        self._generation_pool: Optional[GenerationPool] = None
+        self._outbound: Optional[OutboundScheduler] = None
+        self._overload: Optional[OverloadController] = None
+        self._startup_task: Optional[asyncio.Task] = None
+        # Сервисы могут впервые понадобиться и из потоков пула генерации
+        self._lock = threading.RLock()
+        registry.add_collector(self.collect_metrics)
+
+    @property
+    def mongo_client(self) -> MongoClient:
+        """Общий клиент MongoDB (подключение устанавливается при первом запросе)"""
+        with self._lock:
+            if self._mongo_client is None:
+                self._mongo_client = MongoClient(
+                    os.getenv('MONGODB_URI', 'mongodb://localhost:27017/ebanez'))
+            return self._mongo_client
+
+    @property
+    def database(self) -> Database:
+        with self._lock:
+            if self._database is None:
+                self._database = Database(self.mongo_client)
+            return self._database
+
+    @property
+    def markov_generator(self) -> MarkovChainGenerator:
+        with self._lock:
+            if self._markov_generator is None:
+                generator = MarkovChainGenerator(db=self.database)
+                generator.base_model = SharedBaseModel(generator, self.chat_settings)
+                self._markov_generator = generator
+            return self._markov_generator
+
+    @property
+    def base_model(self) -> SharedBaseModel:
+        return self.markov_generator.base_model
+
+    @property
+    def sticker_storage(self) -> StickerStorage:
+        with self._lock:
+            if self._sticker_storage is None:
+                self._sticker_storage = StickerStorage(self.mongo_client)
+            return self._sticker_storage
+
+    @property
+    def chat_settings(self) -> ChatSettings:
+        with self._lock:
+            if self._chat_settings is None:
+                self._chat_settings = ChatSettings(self.mongo_client)
+            return self._chat_settings
+
+    @property
+    def weather_service(self) -> WeatherService:
+        with self._lock:
+            if self._weather_service is None:
+                self._weather_service = WeatherService(self.chat_settings, self.mongo_client.get_database())
+            return self._weather_service
+
+    @property
+    def history_importer(self) -> HistoryImporter:
+        with self._lock:
+            if self._history_importer is None:
+                self._history_importer = HistoryImporter(self.markov_generator)
+            return self._history_importer
+
+    @property
+    def retention(self) -> RetentionManager:
+        with self._lock:
+            if self._retention is None:
+                self._retention = RetentionManager(self.database, self.chat_settings)
+            return self._retention
+
+    @property
+    def generation_pool(self) -> GenerationPool:
+        with self._lock:
+            if self._generation_pool is None:
+                self._generation_pool = GenerationPool(self.markov_generator)
+            return self._generation_pool
+
+    @property
+    def outbound(self) -> OutboundScheduler:
+        with self._lock:
+            if self._outbound is None:
+                self._outbound = OutboundScheduler()
+            return self._outbound
+
+    @property
+    def overload(self) -> OverloadController:
+        with self._lock:
+            if self._overload is None:
+                self._overload = OverloadController()
+            return self._overload
+
+    def collect_metrics(self):
+        """Метрики состояния уже созданных сервисов (новые сервисы ради метрик не создаются)"""
+        rss = process_memory_bytes()
+        if rss is not None:
+            yield 'process_resident_memory_bytes', 'gauge', 'Резидентная память процесса', [({}, rss)]
+
+        if self._markov_generator is not None:
+            generator = self._markov_generator
+            loaded = [chat_id for chat_id, model in list(generator.models.items()) if model]
+            model_bytes = 0
+            for chat_id in loaded:
+                try:
+                    model_bytes += generator.get_model_path(chat_id).stat().st_size * MODEL_MEMORY_FACTOR
+                except OSError:
+                    pass
+            yield 'ebanez_models_loaded', 'gauge', 'Загруженные модели', [({}, len(loaded))]
+            yield 'ebanez_models_memory_bytes', 'gauge', 'Оценка памяти загруженных моделей', [({}, model_bytes)]
+            yield 'ebanez_rebuild_dirty_chats', 'gauge', 'Чаты, ожидающие пересборки модели', [
+                ({}, generator.rebuilds.dirty_chats)]
+            corpus = generator.corpus
+            yield 'ebanez_corpus_cache_bytes', 'gauge', 'Объем кэша корпусов', [({}, corpus.size)]
+            yield 'ebanez_corpus_cache_requests_total', 'counter', 'Обращения к кэшу корпусов', [
+                ({'result': 'hit'}, corpus.hits), ({'result': 'miss'}, corpus.misses)]
+
+        if self._generation_pool is not None:
+            pool = self._generation_pool
+            yield 'ebanez_generation_pool_dropped_total', 'counter', 'Задачи пула без результата', [
+                ({'reason': 'timeout'}, pool.timeouts), ({'reason': 'rejected'}, pool.rejected)]
+
+        if self._outbound is not None:
+            outbound = self._outbound
+            yield 'ebanez_outbound_queue_depth', 'gauge', 'Действия в очереди исходящих', [({}, outbound.depth)]
+            yield 'ebanez_outbound_total', 'counter', 'Исходящие действия по результату', [
+                ({'result': name}, getattr(outbound, name))
+                for name in ('sent', 'coalesced', 'expired', 'failed', 'rate_limited')
+            ]
+
+        if self._overload is not None:
+            snapshot = self._overload.snapshot()
+            yield 'ebanez_overload_shedding', 'gauge', 'Включен ли сброс необязательной работы', [
+                ({}, int(snapshot['shedding']))]
+            yield 'ebanez_overload_latency_ewma_seconds', 'gauge', 'Сглаженная задержка обработки', [
+                ({}, snapshot['latency_ewma_ms'] / 1000)]
+            yield 'ebanez_overload_in_flight', 'gauge', 'Апдейты в обработке', [({}, snapshot['in_flight'])]
+            yield 'ebanez_overload_shed_total', 'counter', 'Пропущенные необязательные действия', [
+                ({'kind': kind}, n) for kind, n in snapshot['shed'].items()]
+
+        if self._weather_service is not None:
+            yield 'ebanez_weather_upstream_requests_total', 'counter', 'Запросы к API погоды', [
+                ({}, self._weather_service.upstream_requests)]
+
+    def _init_storage(self):
+        """Создание индексов и директорий (выполняется в отдельном потоке)"""
+        started = time.perf_counter()
+        self.markov_generator.init_storage()
+        self.sticker_storage.init_storage()
+        self.chat_settings.init_storage()
+        self.base_model.init_storage()
+        self.weather_service.init_storage()
+        self.history_importer.init_storage()
+        logger.info(f"Хранилища инициализированы за {time.perf_counter() - started:.2f}s")
+
+    async def startup(self):
+        """Асинхронный этап старта: инициализация хранилищ в фоне"""
+        if self._startup_task is None:
+            self._startup_task = asyncio.get_running_loop().create_task(
+                asyncio.to_thread(self._init_storage))
+            self._startup_task.add_done_callback(self._log_startup_error)
+
+    @staticmethod
+    def _log_startup_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Ошибка при инициализации хранилищ", exc_info=task.exception())
+
+    async def storage_ready(self) -> bool:
+        """Ожидание инициализации хранилищ; False, если она завершилась ошибкой"""
+        if self._startup_task is None:
+            await self.startup()
+        try:
+            await asyncio.shield(self._startup_task)
+            return True
+        except Exception:
+            return False
+
+    async def stop(self):
+        """Отправка оставшихся исходящих действий (пока бот еще может отправлять)"""
+        if self._outbound is not None:
+            await self._outbound.stop()
+
+    async def shutdown(self):
+        """Освобождение ресурсов"""
+        if self._weather_service is not None:
+            await self._weather_service.close()
+        if self._generation_pool is not None:
+            self._generation_pool.shutdown()
+        if self._mongo_client is not None:
+            self._mongo_client.close()
+        logger.info("Сервисы остановлены")
+
+services = ServiceContainer()
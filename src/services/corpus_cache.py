@@ -0,0 +1,191 @@
+import os
+import sys
+import logging
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from .database import Database, mongo_now
+
+logger = logging.getLogger(__name__)
+
+# Примерные накладные расходы на одно сообщение: слот в списках и datetime
+_MESSAGE_OVERHEAD = 64
+
+# Сколько раз перечитывать историю, если во время загрузки шла архивация
+_LOAD_ATTEMPTS = 3
+
+class _CorpusEntry:
+    """Материализованная история одного чата в хронологическом порядке"""
+
+    __slots__ = ('texts', 'dates', 'size', 'loaded_at')
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.dates: List[Optional[datetime]] = []
+        self.size = 0
+        # Время начала загрузки из MongoDB с точностью хранения в базе: импорт истории
+        # или архивация после него делают загруженную историю устаревшей
+        self.loaded_at = mongo_now()
+
+    def append(self, text: str, created_at: Optional[datetime]) -> int:
+        self.texts.append(text)
+        self.dates.append(created_at)
+        added = sys.getsizeof(text) + _MESSAGE_OVERHEAD
+        self.size += added
+        return added
+
+class CorpusCache:
+    """
+    LRU-кэш истории сообщений по чатам с ограничением по памяти.
+    Одновременные запросы одного чата разделяют одну загрузку из MongoDB.
+    """
+
+    def __init__(self, db: Database, max_bytes: Optional[int] = None):
+        self.db = db
+        self.max_bytes = max_bytes or int(os.getenv('CORPUS_CACHE_MB', '256')) * 1024 * 1024
+        self._entries: 'OrderedDict[int, _CorpusEntry]' = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load_locks: Dict[int, threading.Lock] = {}
+        # Сообщения, добавленные во время загрузки чата: курсор мог их уже пройти
+        self._pending: Dict[int, List[Tuple[str, datetime]]] = {}
+        # Счетчик инвалидаций: загрузка, пережившая очистку чата, не попадает в кэш
+        self._epochs: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+        logger.info(f"CorpusCache инициализирован: лимит {self.max_bytes // (1024 * 1024)}MB")
+
+    @property
+    def size(self) -> int:
+        """Текущий объем кэша в байтах"""
+        return self._size
+
+    def _get_entry(self, chat_id: int) -> _CorpusEntry:
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None:
+                self._entries.move_to_end(chat_id)
+                self.hits += 1
+                return entry
+            load_lock = self._load_locks.setdefault(chat_id, threading.Lock())
+
+        # Загрузка вне общего лока, чтобы не блокировать другие чаты
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(chat_id)
+                if entry is not None:
+                    self._entries.move_to_end(chat_id)
+                    self.hits += 1
+                    return entry
+                self.misses += 1
+                epoch = self._epochs.get(chat_id, 0)
+                self._pending[chat_id] = []
+
+            try:
+                for attempt in range(1, _LOAD_ATTEMPTS + 1):
+                    entry = _CorpusEntry()
+                    # Полная история для пересборок: архив старых сообщений и оперативная часть
+                    for doc in self.db.iter_messages(chat_id, include_archive=True):
+                        entry.append(doc.get('text') or '', doc.get('created_at'))
+                    # Пачка, перенесенная в архив между чтением архива и messages, не попала
+                    # ни в одно из чтений
+                    consistent = not self.db.archived_since(chat_id, entry.loaded_at)
+                    if consistent:
+                        break
+                    logger.info(f"Во время загрузки чата {chat_id} шла архивация, перечитываю ({attempt})")
+
+                with self._lock:
+                    self._merge_pending(entry, self._pending.pop(chat_id, []))
+                    if not consistent:
+                        logger.warning(f"История чата {chat_id} менялась при каждой загрузке, не кэширую")
+                    elif self._epochs.get(chat_id, 0) != epoch:
+                        logger.info(f"История чата {chat_id} очищена во время загрузки, не кэширую")
+                    elif entry.size <= self.max_bytes:
+                        self._entries[chat_id] = entry
+                        self._size += entry.size
+                        self._evict()
+                    else:
+                        logger.warning(f"История чата {chat_id} больше лимита кэша, не кэширую")
+            finally:
+                with self._lock:
+                    self._pending.pop(chat_id, None)
+                    self._load_locks.pop(chat_id, None)
+            logger.info(f"Загружено {len(entry.texts)} сообщений чата {chat_id} в кэш ({entry.size // 1024}KB)")
+            return entry
+
+    @staticmethod
+    def _merge_pending(entry: _CorpusEntry, pending: List[Tuple[str, datetime]]):
+        """Дописать сообщения, пришедшие во время загрузки и не прочитанные курсором"""
+        if not pending:
+            return
+        earliest = min(created_at for _, created_at in pending)
+        # Загруженные сообщения отсортированы по времени: кандидаты только в хвосте
+        loaded = Counter()
+        for text, created_at in zip(reversed(entry.texts), reversed(entry.dates)):
+            if created_at is None or created_at < earliest:
+                break
+            loaded[(text, created_at)] += 1
+        for text, created_at in pending:
+            if loaded[(text, created_at)]:
+                loaded[(text, created_at)] -= 1
+            else:
+                entry.append(text, created_at)
+
+    def _evict(self):
+        """Вытеснение давно не используемых чатов до укладывания в лимит"""
+        while self._size > self.max_bytes and self._entries:
+            chat_id, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+            logger.info(f"Чат {chat_id} вытеснен из кэша корпуса")
+
+    def get_messages(self, chat_id: int) -> List[str]:
+        """Тексты сообщений чата (от старых к новым)"""
+        return list(self._get_entry(chat_id).texts)
+
+    def iter_docs(self, chat_id: int) -> Iterator[dict]:
+        """Сообщения чата в виде документов с полями text и created_at"""
+        entry = self._get_entry(chat_id)
+        for text, created_at in zip(list(entry.texts), list(entry.dates)):
+            yield {'text': text, 'created_at': created_at}
+
+    def append(self, chat_id: int, text: str, created_at: Optional[datetime] = None):
+        """Добавление нового сообщения, если история чата уже в кэше"""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                pending = self._pending.get(chat_id)
+                if pending is not None:
+                    pending.append((text, created_at or datetime.utcnow()))
+                return
+            self._size += entry.append(text, created_at or datetime.utcnow())
+            self._evict()
+
+    def invalidate_if_imported(self, chat_id: int) -> bool:
+        """
+        Сброс истории чата, если после ее загрузки в чат импортировали историю.
+        Импорт из командной строки (src.tools.import_history) идет в другом процессе
+        и не может сбросить кэш бота сам
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+        if entry is None:
+            return False
+        try:
+            doc = self.db.db.history_imports.find_one({'chat_id': chat_id}, {'_id': 0, 'updated_at': 1})
+        except Exception as e:
+            logger.error(f"Ошибка при проверке импорта истории чата {chat_id}: {e}")
+            return False
+        if not doc or not doc.get('updated_at') or doc['updated_at'] < entry.loaded_at:
+            return False
+        logger.info(f"В чат {chat_id} импортирована история, перечитываю корпус")
+        self.invalidate(chat_id)
+        return True
+
+    def invalidate(self, chat_id: int):
+        """Удаление истории чата из кэша"""
+        with self._lock:
+            self._epochs[chat_id] = self._epochs.get(chat_id, 0) + 1
+            entry = self._entries.pop(chat_id, None)
+            if entry is not None:
+                self._size -= entry.size
@@ -1,110 +1,320 @@
 import os
-from typing import List, Optional
+import json
+import zlib
+from typing import Dict, Iterator, List, Optional
 import logging
 from datetime import datetime
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.database import Database as MongoDatabase
+from .metrics import timed
+from ..log_config import log_sampled
 
 logger = logging.getLogger(__name__)
 
-class Database:
-    def __init__(self):
+def _pack_messages(docs: List[dict]) -> bytes:
+    """Сжатие пачки сообщений для архива: JSON [[text, created_at], ...] + zlib"""
+    rows = [[doc.get('text') or '', doc['created_at'].isoformat() if doc.get('created_at') else None]
+            for doc in docs]
+    return zlib.compress(json.dumps(rows, ensure_ascii=False).encode('utf-8'), 6)
+
+def _unpack_messages(data: bytes) -> Iterator[dict]:
+    for text, created_at in json.loads(zlib.decompress(data)):
+        yield {'text': text, 'created_at': datetime.fromisoformat(created_at) if created_at else None}
+
+def mongo_now() -> datetime:
+    """Текущее время UTC с точностью хранения MongoDB (миллисекунды)"""
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
 
+class Database:
+    def __init__(self, client: Optional[MongoClient] = None):
+        """
+        Подключение к MongoDB. Клиент подключается лениво, поэтому конструктор
+        не выполняет запросов; индексы создаются в init_db() на этапе старта
+        """
         mongodb_uri = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/ebanez')
-        self.client = MongoClient(mongodb_uri)
+        self.client = client or MongoClient(mongodb_uri)
         self.db: MongoDatabase = self.client.get_database()
         self.messages: Collection = self.db.messages
-        self.init_db()
-        logger.info(f"База данных MongoDB инициализирована: {mongodb_uri}")
+        # Старые сообщения, сжатые пачками (см. RetentionManager)
+        self.archive: Collection = self.db.message_archive
 
     def init_db(self):
         """Инициализация базы данных"""
         try:
 
             self.messages.create_index('chat_id')
+            self.messages.create_index([('chat_id', 1), ('created_at', -1)])
+            self.archive.create_index([('chat_id', 1), ('first_at', 1)])
+            self.archive.create_index('pending', sparse=True)
+            self.archive.create_index([('chat_id', 1), ('archived_at', 1)])
             
 
             self.db.command('ping')
             
 
-            count = self.messages.count_documents({})
-            logger.info(f"В коллекции messages {count} документов")
+            # Полный подсчет документов дорогой на больших коллекциях, считаем только для отладки
+            if logger.isEnabledFor(logging.DEBUG):
+                count = self.messages.estimated_document_count()
+                logger.debug(f"В коллекции messages ~{count} документов")
             logger.info("База данных MongoDB успешно инициализирована")
             
         except Exception as e:
             logger.error(f"Ошибка при инициализации базы данных: {e}")
 
-    def add_message(self, chat_id: int, text: str) -> bool:
+    @timed('database')
+    def add_message(self, chat_id: int, text: str, created_at: Optional[datetime] = None) -> bool:
         """Добавить новое сообщение"""
         try:
             result = self.messages.insert_one({
                 'chat_id': chat_id,
                 'text': text,
-                'created_at': datetime.utcnow()
+                'created_at': created_at or mongo_now()
             })
-            logger.info(f"Сообщение успешно добавлено в базу: chat_id={chat_id}, text={text[:20]}...")
+            log_sampled(logger, "Сообщение добавлено в базу: chat_id=%s, text=%.20s...", chat_id, text)
             return bool(result.inserted_id)
         except Exception as e:
             logger.error(f"Ошибка при добавлении сообщения: {e}")
             return False
 
-    def get_messages(self, chat_id: int, limit: Optional[int] = None) -> List[str]:
-        """Получить список сообщений для чата"""
+    @timed('database')
+    def add_messages(self, docs: List[dict]) -> int:
+        """Пакетная вставка документов (chat_id, text, created_at). Возвращает число вставленных"""
+        if not docs:
+            return 0
+        try:
+            result = self.messages.insert_many(docs, ordered=False)
+            return len(result.inserted_ids)
+        except Exception as e:
+            logger.error(f"Ошибка при пакетной вставке сообщений: {e}")
+            return 0
+
+    @timed('database')
+    def get_messages(self, chat_id: int, limit: Optional[int] = None,
+                     include_archive: bool = False) -> List[str]:
+        """
+        Получить список сообщений для чата (от новых к старым).
+        С include_archive недостающие до limit сообщения добираются из архива
+        """
         try:
-            query = {'chat_id': chat_id}
+            query = self._hot_query(chat_id) if include_archive else {'chat_id': chat_id}
             cursor = self.messages.find(query).sort('created_at', -1)
             
             if limit:
                 cursor = cursor.limit(limit)
             
             messages = [doc['text'] for doc in cursor]
-            logger.info(f"Получено {len(messages)} сообщений для chat_id={chat_id}")
+            if include_archive and (not limit or len(messages) < limit):
+                for chunk in self.archive.find({'chat_id': chat_id}, {'data': 1}).sort('first_at', -1):
+                    texts = [doc['text'] for doc in _unpack_messages(chunk['data'])]
+                    messages.extend(reversed(texts))
+                    if limit and len(messages) >= limit:
+                        del messages[limit:]
+                        break
+            logger.debug("Получено %d сообщений для chat_id=%s", len(messages), chat_id)
             return messages
             
         except Exception as e:
             logger.error(f"Ошибка при получении сообщений: {e}")
             return []
 
+    @timed('database')
+    def iter_messages(self, chat_id: int, since: Optional[datetime] = None,
+                      include_archive: bool = False) -> Iterator[dict]:
+        """
+        Потоковый обход сообщений чата (text, created_at) без загрузки в память.
+        С include_archive сначала отдаются архивные сообщения (они старше оперативных)
+        """
+        archived_ids = []
+        if include_archive:
+            archive_query = {'chat_id': chat_id}
+            if since:
+                archive_query['last_at'] = {'$gte': since}
+            for chunk in self.archive.find(archive_query, {'data': 1, 'ids': 1}).sort('first_at', 1):
+                # Сообщения недоперенесенной пачки еще могут лежать и в messages
+                archived_ids.extend(chunk.get('ids', ()))
+                for doc in _unpack_messages(chunk['data']):
+                    if not since or (doc['created_at'] and doc['created_at'] >= since):
+                        yield doc
+
+        query = {'chat_id': chat_id}
+        if since:
+            query['created_at'] = {'$gte': since}
+        if archived_ids:
+            query['_id'] = {'$nin': archived_ids}
+        # Импортированная история вставляется позже новых сообщений, поэтому порядок
+        # задается явно (индекс chat_id + created_at обходится в обратную сторону)
+        cursor = self.messages.find(query, {'_id': 0, 'text': 1, 'created_at': 1}).sort('created_at', 1)
+        for doc in cursor:
+            yield doc
+
+    @timed('database')
+    def archive_messages(self, chat_id: int, before: datetime, limit: int) -> int:
+        """
+        Перенос до limit самых старых сообщений чата, созданных раньше before,
+        в один сжатый документ архива. Возвращает число перенесенных сообщений.
+
+        Пачка записывается с флагом pending и списком _id перенесенных сообщений,
+        флаг снимается после удаления их из messages. Если удаление не прошло или
+        прервалось, следующий перенос сначала доудаляет сообщения такой пачки, а не
+        собирает их в новую; до этого читатели пропускают их копии в messages
+        """
+        try:
+            self._finish_pending(chat_id)
+            docs = list(
+                self.messages.find({'chat_id': chat_id, 'created_at': {'$lt': before}},
+                                   {'text': 1, 'created_at': 1})
+                .sort('created_at', 1).limit(limit)
+            )
+            if not docs:
+                return 0
+            ids = [doc['_id'] for doc in docs]
+            chunk_id = f"{chat_id}:{ids[0]}"
+            data = _pack_messages(docs)
+            self.archive.replace_one({'_id': chunk_id}, {
+                'chat_id': chat_id,
+                'first_at': docs[0]['created_at'],
+                'last_at': docs[-1]['created_at'],
+                'count': len(docs),
+                'chars': sum(len(doc.get('text') or '') for doc in docs),
+                'bytes': len(data),
+                'data': data,
+                'archived_at': datetime.utcnow(),
+                'ids': ids,
+                'pending': True,
+            }, upsert=True)
+            self.messages.delete_many({'_id': {'$in': ids}})
+            self.archive.update_one({'_id': chunk_id}, {'$unset': {'ids': '', 'pending': ''}})
+            return len(docs)
+        except Exception as e:
+            logger.error(f"Ошибка при архивации сообщений чата {chat_id}: {e}")
+            return 0
+
+    @timed('database')
+    def archived_since(self, chat_id: int, since: datetime) -> bool:
+        """Переносились ли сообщения чата в архив начиная с since"""
+        try:
+            return self.archive.find_one({'chat_id': chat_id, 'archived_at': {'$gte': since}}, {'_id': 1}) is not None
+        except Exception as e:
+            logger.error(f"Ошибка при проверке архивации чата {chat_id}: {e}")
+            return False
+
+    def _finish_pending(self, chat_id: int):
+        """Завершение переноса пачек, у которых не удалились сообщения из messages"""
+        for chunk in self.archive.find({'chat_id': chat_id, 'pending': True}, {'ids': 1}):
+            deleted = self.messages.delete_many({'_id': {'$in': chunk['ids']}}).deleted_count
+            self.archive.update_one({'_id': chunk['_id']}, {'$unset': {'ids': '', 'pending': ''}})
+            logger.info(f"Завершен прерванный перенос пачки {chunk['_id']}: удалено {deleted} сообщений")
+
+    def _hot_query(self, chat_id: int) -> dict:
+        """Фильтр оперативных сообщений чата без копий из недоперенесенных пачек архива"""
+        query = {'chat_id': chat_id}
+        archived_ids = [doc_id for chunk in self.archive.find({'chat_id': chat_id, 'pending': True}, {'ids': 1})
+                        for doc_id in chunk['ids']]
+        if archived_ids:
+            query['_id'] = {'$nin': archived_ids}
+        return query
+
+    @timed('database')
+    def get_archive_stats(self, chat_id: int) -> dict:
+        """Число сообщений, их суммарная длина и объем архива чата"""
+        stats = {'messages': 0, 'chars': 0, 'chunks': 0, 'bytes': 0}
+        try:
+            for chunk in self.archive.find({'chat_id': chat_id}, {'count': 1, 'chars': 1, 'bytes': 1}):
+                stats['messages'] += chunk.get('count', 0)
+                stats['chars'] += chunk.get('chars', 0)
+                stats['chunks'] += 1
+                stats['bytes'] += chunk.get('bytes', 0)
+        except Exception as e:
+            logger.error(f"Ошибка при получении статистики архива: {e}")
+        return stats
+
+    @timed('database')
+    def get_recent_chat_ids(self, limit: int) -> List[int]:
+        """Получить ID чатов, отсортированные по времени последнего сообщения"""
+        try:
+            # $sort по индексу (chat_id, created_at) и $first позволяют MongoDB выполнить
+            # группировку DISTINCT_SCAN по индексу, по одному ключу на чат, без обхода коллекции
+            pipeline = [
+                {'$sort': {'chat_id': 1, 'created_at': -1}},
+                {'$group': {'_id': '$chat_id', 'last_message_at': {'$first': '$created_at'}}},
+                {'$sort': {'last_message_at': -1}},
+                {'$limit': limit}
+            ]
+            chat_ids = [doc['_id'] for doc in self.messages.aggregate(pipeline)]
+            logger.info(f"Найдено {len(chat_ids)} недавно активных чатов")
+            return chat_ids
+        except Exception as e:
+            logger.error(f"Ошибка при получении активных чатов: {e}")
+            return []
+
+    @timed('database')
     def get_chat_stats(self, chat_id: int) -> dict:
-        """Получить статистику чата"""
+        """Получить статистику чата (вместе с архивом)"""
         try:
             pipeline = [
-                {'$match': {'chat_id': chat_id}},
+                {'$match': self._hot_query(chat_id)},
                 {'$group': {
                     '_id': None,
                     'total_messages': {'$sum': 1},
-                    'avg_message_length': {'$avg': {'$strLenCP': '$text'}}
+                    'total_chars': {'$sum': {'$strLenCP': '$text'}}
                 }}
             ]
             
             result = list(self.messages.aggregate(pipeline))
-            
-            if result:
-                stats = {
-                    'total_messages': result[0]['total_messages'],
-                    'avg_message_length': round(result[0]['avg_message_length'], 1)
-                }
-            else:
-                stats = {'total_messages': 0, 'avg_message_length': 0}
+            hot_messages = result[0]['total_messages'] if result else 0
+            hot_chars = result[0]['total_chars'] if result else 0
+            archive = self.get_archive_stats(chat_id)
+
+            total = hot_messages + archive['messages']
+            stats = {
+                'total_messages': total,
+                'archived_messages': archive['messages'],
+                'archive_bytes': archive['bytes'],
+                'avg_message_length': round((hot_chars + archive['chars']) / total, 1) if total else 0
+            }
                 
-            logger.info(f"Получена статистика для chat_id={chat_id}: {stats}")
+            logger.debug("Получена статистика для chat_id=%s: %s", chat_id, stats)
             return stats
             
         except Exception as e:
             logger.error(f"Ошибка при получении статистики: {e}")
-            return {'total_messages': 0, 'avg_message_length': 0}
+            return {'total_messages': 0, 'archived_messages': 0, 'archive_bytes': 0, 'avg_message_length': 0}
 
+    @timed('database')
     def get_message_count(self, chat_id: int) -> int:
-        """Получить количество сообщений в чате"""
+        """Получить количество сообщений в чате (вместе с архивом)"""
         try:
-            count = self.messages.count_documents({'chat_id': chat_id})
-            logger.info(f"Найдено {count} сообщений для chat_id={chat_id}")
+            count = self.messages.count_documents(self._hot_query(chat_id))
+            pipeline = [{'$match': {'chat_id': chat_id}},
+                        {'$group': {'_id': None, 'count': {'$sum': '$count'}}}]
+            count += sum(doc['count'] for doc in self.archive.aggregate(pipeline))
+            logger.debug("Найдено %d сообщений для chat_id=%s", count, chat_id)
             return count
         except Exception as e:
             logger.error(f"Ошибка при подсчете сообщений: {e}")
             return 0
 
+    @timed('database')
+    def get_message_counts(self) -> Dict[int, int]:
+        """Количество сообщений по всем чатам вместе с архивом (для обслуживающих задач)"""
+        try:
+            pipeline = [{'$group': {'_id': '$chat_id', 'count': {'$sum': 1}}}]
+            counts = {doc['_id']: doc['count'] for doc in self.messages.aggregate(pipeline, allowDiskUse=True)}
+            # Чат, у которого все сообщения в архиве, тоже должен попасть в список
+            archive_pipeline = [{'$group': {'_id': '$chat_id', 'count': {'$sum': '$count'}}}]
+            for doc in self.archive.aggregate(archive_pipeline, allowDiskUse=True):
+                counts[doc['_id']] = counts.get(doc['_id'], 0) + doc['count']
+            # Недоперенесенные пачки учтены дважды: в архиве и в messages
+            for chunk in self.archive.find({'pending': True}, {'chat_id': 1, 'ids': 1}):
+                counts[chunk['chat_id']] -= self.messages.count_documents({'_id': {'$in': chunk['ids']}})
+            return counts
+        except Exception as e:
+            logger.error(f"Ошибка при подсчете сообщений по чатам: {e}")
+            return {}
+
+    @timed('database')
     def get_database_size(self) -> int:
         """Получить размер базы данных в байтах"""
         try:
@@ -116,12 +326,14 @@ class Database:
             logger.error(f"Ошибка при получении размера базы данных: {e}")
             return 0
 
+    @timed('database')
     def clear_chat_history(self, chat_id: int) -> bool:
         """Очистка истории конкретного чата"""
         try:
             result = self.messages.delete_many({'chat_id': chat_id})
             deleted_count = result.deleted_count
-            logger.info(f"Удалено {deleted_count} сообщений для chat_id={chat_id}")
+            archived = self.archive.delete_many({'chat_id': chat_id}).deleted_count
+            logger.info(f"Удалено {deleted_count} сообщений и {archived} пачек архива для chat_id={chat_id}")
             return True
         except Exception as e:
             logger.error(f"Ошибка при очистке истории чата: {e}")
@@ -0,0 +1,146 @@
+import os
+import re
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from .metrics import DEDUP_MESSAGES, DEDUP_BYTES
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'\w+')
+_MASK64 = (1 << 64) - 1
+
+# Число хеш-функций MinHash и разбиение подписи на полосы для поиска кандидатов (LSH)
+SIGNATURE_SIZE = 16
+BANDS = 4
+_ROWS = SIGNATURE_SIZE // BANDS
+_SEEDS = [random.Random(0x5eed + i).getrandbits(64) for i in range(SIGNATURE_SIZE)]
+
+Signature = Tuple[int, ...]
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def minhash(normalized: str) -> Signature:
+    """
+    MinHash-подпись по символьным триграммам: доля совпавших позиций двух подписей
+    оценивает коэффициент Жаккара множеств триграмм. Триграммы устойчивее слов
+    для коротких сообщений, где замена одного слова или цифры меняет заметную долю слов
+    """
+    text = f" {normalized} "
+    # hash() строк зависит от PYTHONHASHSEED, но подписи живут только в памяти процесса
+    shingles = {hash(text[i:i + 3]) & _MASK64 for i in range(len(text) - 2)}
+    return tuple(min([shingle ^ seed for shingle in shingles]) for seed in _SEEDS)
+
+def _bands(signature: Signature) -> List[Tuple[int, Signature]]:
+    return [(band, signature[band * _ROWS:(band + 1) * _ROWS]) for band in range(BANDS)]
+
+class _ChatWindow:
+    """Отпечатки последних сообщений одного чата"""
+
+    __slots__ = ('entries', 'exact', 'buckets')
+
+    def __init__(self):
+        # (точный хеш, подпись) в порядке поступления
+        self.entries: Deque[Tuple[int, Signature]] = deque()
+        # точный хеш -> сколько раз он есть в окне
+        self.exact: Dict[int, int] = {}
+        # полоса подписи -> подписи окна с такой полосой
+        self.buckets: Dict[Tuple[int, Signature], List[Signature]] = {}
+
+    def candidates(self, signature: Signature):
+        for key in _bands(signature):
+            yield from self.buckets.get(key, ())
+
+    def add(self, exact: int, signature: Signature, window: int):
+        self.entries.append((exact, signature))
+        self.exact[exact] = self.exact.get(exact, 0) + 1
+        for key in _bands(signature):
+            self.buckets.setdefault(key, []).append(signature)
+
+        if len(self.entries) > window:
+            old_exact, old_signature = self.entries.popleft()
+            if self.exact[old_exact] > 1:
+                self.exact[old_exact] -= 1
+            else:
+                del self.exact[old_exact]
+            for key in _bands(old_signature):
+                bucket = self.buckets[key]
+                bucket.remove(old_signature)
+                if not bucket:
+                    del self.buckets[key]
+
+class NearDuplicateFilter:
+    """
+    Отсев копипасты и повторяющегося спама до записи в базу.
+
+    Для каждого чата хранится окно из последних DEDUP_WINDOW сообщений: точный хеш
+    нормализованного текста (регистр, пунктуация и пробелы не учитываются) и MinHash-подпись
+    по символьным триграммам. Сообщение считается дубликатом, если точный хеш уже есть
+    в окне или оценка сходства с одним из сохраненных не ниже DEDUP_SIMILARITY.
+    Кандидаты для сравнения ищутся по полосам подписи (LSH), а не перебором окна.
+    Короткие реплики ("да", "ахах") в чатах повторяются естественно, поэтому
+    проверяются только сообщения от DEDUP_MIN_WORDS слов. Число чатов ограничено
+    DEDUP_MAX_CHATS (давно молчавшие вытесняются).
+    """
+
+    def __init__(self, window: Optional[int] = None, max_chats: Optional[int] = None,
+                 similarity: Optional[float] = None, min_words: Optional[int] = None):
+        self.enabled = os.getenv('DEDUP_ENABLED', '1') != '0'
+        self.window = window or int(os.getenv('DEDUP_WINDOW', '100'))
+        self.max_chats = max_chats or int(os.getenv('DEDUP_MAX_CHATS', '5000'))
+        similarity = similarity if similarity is not None else float(os.getenv('DEDUP_SIMILARITY', '0.8'))
+        # Сколько позиций подписи должно совпасть
+        self.min_matches = max(1, round(similarity * SIGNATURE_SIZE))
+        self.min_words = min_words or int(os.getenv('DEDUP_MIN_WORDS', '4'))
+        self._chats: 'OrderedDict[int, _ChatWindow]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, chat_id: int, text: str) -> Optional[str]:
+        """
+        Проверка сообщения и запоминание его отпечатка
+
+        Returns:
+            None для нового сообщения, 'exact' или 'near' для дубликата
+        """
+        if not self.enabled:
+            return None
+        words = _WORD_RE.findall(text.lower())
+        if len(words) < self.min_words:
+            return None
+
+        normalized = ' '.join(words)
+        exact = _hash64(normalized)
+        signature = minhash(normalized)
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _ChatWindow()
+                if len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_id)
+
+            if exact in chat.exact:
+                result = 'exact'
+            elif any(sum(map(int.__eq__, signature, other)) >= self.min_matches
+                     for other in chat.candidates(signature)):
+                result = 'near'
+            else:
+                result = None
+            # Дубликат тоже продлевает жизнь отпечатка в окне: непрекращающийся спам не "протухает"
+            chat.add(exact, signature, self.window)
+
+        DEDUP_MESSAGES.inc(result=result or 'unique')
+        if result:
+            DEDUP_BYTES.inc(len(text.encode('utf-8')))
+            logger.debug("Дубликат в чате %s (%s): %.50s", chat_id, result, text)
+        return result
+
+    def forget(self, chat_id: int):
+        """Сброс окна чата (например, после очистки истории)"""
+        with self._lock:
+            self._chats.pop(chat_id, None)
@@ -0,0 +1,93 @@
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from .metrics import GENERATIONS
+
+logger = logging.getLogger(__name__)
+
+class GenerationPool:
+    """Пул потоков для генерации ответов вне event loop"""
+
+    def __init__(self, generator, max_workers: Optional[int] = None,
+                 max_pending: Optional[int] = None, timeout: Optional[float] = None):
+        self.generator = generator
+        self.max_workers = max_workers or int(os.getenv('GENERATION_WORKERS', '2'))
+        # Сколько генераций может ждать или выполняться одновременно
+        self.max_pending = max_pending or int(os.getenv('GENERATION_MAX_PENDING', '16'))
+        self.timeout = timeout or float(os.getenv('GENERATION_TIMEOUT', '20'))
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='markov-gen'
+        )
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.timeouts = 0
+        self.rejected = 0
+        logger.info(
+            f"GenerationPool инициализирован: workers={self.max_workers}, "
+            f"max_pending={self.max_pending}, timeout={self.timeout}s"
+        )
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        # Семафор создается лениво, чтобы привязаться к работающему event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._slots
+
+    @property
+    def busy(self) -> bool:
+        """Все слоты пула заняты"""
+        return self._slots is not None and self._slots.locked()
+
+    async def run(self, func: Callable, *args, timeout: Optional[float] = None,
+                  block: bool = True, cancel_event: Optional[threading.Event] = None):
+        """
+        Выполнение функции в пуле потоков
+
+        Args:
+            func: Синхронная функция
+            timeout: Максимальное время ожидания результата
+            block: Ждать свободный слот или сразу вернуть None, если пул занят
+            cancel_event: Событие, которое выставляется при отмене или таймауте
+
+        Returns:
+            Результат функции или None, если пул занят или истек таймаут
+        """
+        slots = self._get_slots()
+        if not block and slots.locked():
+            logger.info("Пул генерации занят, задача пропущена")
+            self.rejected += 1
+            return None
+
+        async with slots:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, func, *args)
+            try:
+                return await asyncio.wait_for(future, timeout or self.timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Превышено время выполнения {func.__name__} ({timeout or self.timeout}s)")
+                self.timeouts += 1
+                return None
+            finally:
+                # Поток нельзя прервать, поэтому просим функцию остановиться сама.
+                # Если функция уже завершилась, событие ни на что не влияет
+                if cancel_event is not None:
+                    cancel_event.set()
+
+    async def generate_response(self, chat_id: int, input_text: str = None,
+                                timeout: Optional[float] = None, block: bool = True) -> Optional[str]:
+        """Асинхронная генерация ответа с поддержкой отмены"""
+        cancel_event = threading.Event()
+        response = await self.run(
+            self.generator.generate_response, chat_id, input_text, cancel_event,
+            timeout=timeout, block=block, cancel_event=cancel_event
+        )
+        GENERATIONS.inc(result='success' if response else 'failure')
+        return response
+
+    def shutdown(self):
+        """Остановка пула"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        logger.info("GenerationPool остановлен")
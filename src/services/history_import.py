@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import logging
+from datetime import datetime
+from typing import Callable, Iterator, Optional, TextIO
+from pymongo.collection import Collection
+from .markov_chain import MarkovChainGenerator
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = ' \t\n\r'
+
+# Типы чатов экспорта, у которых в Bot API идентификатор с префиксом -100
+_SUPERGROUP_TYPES = {'public_supergroup', 'private_supergroup', 'public_channel', 'private_channel'}
+
+class ExportReader:
+    """
+    Потоковый разбор result.json из Telegram Desktop ("Экспорт истории чата", формат JSON).
+
+    Файл читается кусками, сообщения из массива messages декодируются по одному через
+    JSONDecoder.raw_decode, поэтому в памяти находится только текущий кусок файла.
+    Поля экспорта до messages (name, type, id) собираются в header.
+    """
+
+    def __init__(self, f: TextIO, chunk_size: int = 1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.header: dict = {}
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """Дочитать следующий кусок; False, если файл закончился"""
+        if self._eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """Следующий значимый символ (пробелы пропускаются), '' в конце файла"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, char: str):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Некорректный экспорт: ожидался '{char}', найдено '{found}'")
+        self._pos += 1
+
+    def _value(self):
+        """Следующее JSON-значение; при обрыве на границе куска дочитывает файл"""
+        while True:
+            self._peek()
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # Число в самом конце куска может быть обрезано
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def messages(self) -> Iterator[dict]:
+        """Сообщения экспорта по порядку"""
+        self._expect('{')
+        found = False
+        while self._peek() not in ('}', ''):
+            if self._peek() == ',':
+                self._pos += 1
+                continue
+            key = self._value()
+            self._expect(':')
+            if key != 'messages':
+                self.header[key] = self._value()
+                continue
+
+            found = True
+            self._expect('[')
+            while True:
+                char = self._peek()
+                if char == ']':
+                    self._pos += 1
+                    break
+                if char == ',':
+                    self._pos += 1
+                    continue
+                if not char:
+                    raise ValueError("Некорректный экспорт: файл оборвался внутри messages")
+                yield self._value()
+
+        if not found:
+            raise ValueError("В файле нет списка messages: нужен экспорт одного чата (result.json)")
+
+def export_chat_id(header: dict) -> Optional[int]:
+    """Идентификатор чата в Bot API по полям type и id экспорта"""
+    chat_id = header.get('id')
+    if not isinstance(chat_id, int):
+        return None
+    chat_type = header.get('type', '')
+    if chat_type in _SUPERGROUP_TYPES:
+        return int(f"-100{chat_id}")
+    if chat_type == 'private_group':
+        return -chat_id
+    return chat_id
+
+def export_text(text) -> str:
+    """Текст сообщения: строка или список фрагментов (строки и объекты с разметкой)"""
+    if isinstance(text, str):
+        return text
+    if isinstance(text, list):
+        return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return ''
+
+def export_date(message: dict) -> datetime:
+    """Время сообщения в UTC (как у сообщений, сохраненных ботом)"""
+    if message.get('date_unixtime'):
+        return datetime.utcfromtimestamp(int(message['date_unixtime']))
+    if message.get('date'):
+        # В старых экспортах есть только локальное время без зоны
+        return datetime.fromisoformat(message['date'])
+    return datetime.utcnow()
+
+class HistoryImporter:
+    """
+    Импорт истории чата из экспорта Telegram Desktop.
+
+    Сообщения проходят ту же валидацию и отсев дубликатов, что и в add_message, вставляются пакетами
+    с исходными датами. После вставки один раз пересчитываются /top и /mood
+    и строится модель. Номер последнего импортированного сообщения хранится
+    в коллекции history_imports, поэтому повторный или прерванный импорт того же
+    экспорта не создает дублей и продолжается с места остановки.
+    """
+
+    def __init__(self, generator: MarkovChainGenerator, batch_size: Optional[int] = None):
+        self.generator = generator
+        self.db = generator.db
+        self.batch_size = batch_size or int(os.getenv('IMPORT_BATCH_SIZE', '10000'))
+        self.imports: Collection = self.db.db.history_imports
+
+    def init_storage(self):
+        """Создание индексов"""
+        try:
+            self.imports.create_index('chat_id', unique=True)
+        except Exception as e:
+            logger.error(f"Ошибка при создании индексов импорта истории: {e}")
+
+    def _last_imported_id(self, chat_id: int) -> int:
+        doc = self.imports.find_one({'chat_id': chat_id})
+        return doc.get('last_message_id', 0) if doc else 0
+
+    def _flush(self, chat_id: int, batch: list, last_message_id: int) -> bool:
+        inserted = self.db.add_messages(batch)
+        if inserted != len(batch):
+            return False
+        self.imports.update_one(
+            {'chat_id': chat_id},
+            {'$set': {'last_message_id': last_message_id, 'updated_at': datetime.utcnow()},
+             '$inc': {'imported': inserted}},
+            upsert=True
+        )
+        return True
+
+    def import_file(self, path: str, chat_id: Optional[int] = None,
+                    progress: Optional[Callable[[dict], None]] = None) -> dict:
+        """
+        Импорт result.json
+
+        Args:
+            path: Путь к result.json
+            chat_id: Чат, в который импортировать (по умолчанию - чат из экспорта)
+            progress: Вызывается после каждого пакета со статистикой импорта
+
+        Returns:
+            Статистика: read, imported, invalid, duplicates, skipped (служебные сообщения),
+            already_imported, model_built, error
+        """
+        started = time.perf_counter()
+        stats = {'chat_id': chat_id, 'read': 0, 'imported': 0, 'invalid': 0, 'duplicates': 0,
+                 'skipped': 0, 'already_imported': 0, 'model_built': False, 'error': None}
+        batch = []
+        last_imported = last_id = 0
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                reader = ExportReader(f)
+                for message in reader.messages():
+                    if stats['chat_id'] is None:
+                        stats['chat_id'] = export_chat_id(reader.header)
+                        if stats['chat_id'] is None:
+                            raise ValueError("Не удалось определить чат экспорта, укажите chat_id явно")
+                    if not stats['read']:
+                        last_imported = self._last_imported_id(stats['chat_id'])
+                    stats['read'] += 1
+
+                    message_id = message.get('id') if isinstance(message.get('id'), int) else 0
+                    if message.get('type') != 'message':
+                        stats['skipped'] += 1
+                        continue
+                    if message_id and message_id <= last_imported:
+                        stats['already_imported'] += 1
+                        continue
+
+                    text = export_text(message.get('text')).strip()
+                    if not self.generator.is_valid_message(text):
+                        stats['invalid'] += 1
+                        continue
+                    if self.generator.dedup.check(stats['chat_id'], text):
+                        stats['duplicates'] += 1
+                        continue
+
+                    batch.append({'chat_id': stats['chat_id'], 'text': text, 'created_at': export_date(message)})
+                    last_id = max(last_id, message_id)
+                    if len(batch) >= self.batch_size:
+                        if not self._flush(stats['chat_id'], batch, last_id):
+                            raise RuntimeError("Не удалось записать пакет сообщений")
+                        stats['imported'] += len(batch)
+                        batch = []
+                        if progress:
+                            progress(stats)
+
+            if batch:
+                if not self._flush(stats['chat_id'], batch, last_id):
+                    raise RuntimeError("Не удалось записать пакет сообщений")
+                stats['imported'] += len(batch)
+
+        except Exception as e:
+            logger.error(f"Ошибка при импорте истории из {path}: {e}")
+            stats['error'] = str(e)
+
+        # Даже после ошибки уже вставленные пакеты учитываются в статистике и модели
+        if stats['imported']:
+            self._reindex(stats['chat_id'])
+            stats['model_built'] = self.generator.rebuild_model(stats['chat_id'])
+
+        stats['seconds'] = round(time.perf_counter() - started, 1)
+        logger.info(f"Импорт истории для чата {stats['chat_id']}: {stats}")
+        return stats
+
+    def _reindex(self, chat_id: int):
+        """Пересчет /top и /mood по всей истории чата (один проход по кэшу корпуса)"""
+        generator = self.generator
+        generator.corpus.invalidate(chat_id)
+        generator.word_stats.rebuild(chat_id, generator.corpus.iter_docs(chat_id))
+        generator.mood_stats.rebuild(chat_id, generator.corpus.iter_docs(chat_id))
@@ -1,30 +1,92 @@
 import markovify
 import os
+import json
+import hashlib
+import random
+import tempfile
+import threading
 from pathlib import Path
-from .database import Database
+from datetime import datetime
+from .database import Database, mongo_now
+from .word_stats import WordStats
+from .mood_stats import MoodStats
+from .corpus_cache import CorpusCache
+from .dedup import NearDuplicateFilter
+from .rebuild_scheduler import RebuildScheduler
+from .metrics import timed, MODEL_REBUILDS
+from .profiling import profiled
+from ..log_config import log_sampled
 import logging
-from typing import Dict
+from typing import Dict, Iterable, Iterator, Optional
 
 logger = logging.getLogger(__name__)
 
+# Версия подготовки обучающих данных: увеличить при изменении фильтрации сообщений,
+# чтобы отпечатки старых моделей перестали совпадать и модели пересобрались
+TRAINING_VERSION = 1
+
+def _atomic_write(path: Path, text: str):
+    """Запись во временный файл и подмена целиком: читатель не увидит недописанный файл"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 class MarkovChainGenerator:
-    def __init__(self, state_size=3, min_messages=50):
-        """Инициализация генератора"""
-        self.db = Database()
+    def __init__(self, state_size=3, min_messages=50, db: Optional[Database] = None):
+        """Инициализация генератора (без обращений к базе и диску)"""
+        self.db = db or Database()
+        self.word_stats = WordStats(self.db.db)
+        self.mood_stats = MoodStats(self.db.db)
+        self.corpus = CorpusCache(self.db)
+        self.dedup = NearDuplicateFilter()
         self.state_size = state_size
         self.min_messages = min_messages  # Минимум сообщений для первой модели
-        self.rebuild_every = 10  # Перестраивать каждые N сообщений после создания
         self.models: Dict[int, markovify.Text] = {}  # Словарь моделей для каждого чата
+        # Отпечатки обучающих данных загруженных моделей
+        self.fingerprints: Dict[int, Optional[str]] = {}
         self.models_dir = Path(__file__).parent.parent.parent / 'data' / 'models'
+        # Пересборка после накопления новых сообщений или паузы в чате
+        self.rebuilds = RebuildScheduler(self)
+        # Общая модель для чатов с /basemodel on (SharedBaseModel, подключается контейнером сервисов)
+        self.base_model = None
+
+    def init_storage(self):
+        """Создание индексов и директорий. Вызывается на этапе старта бота"""
         self.models_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"Директория для моделей: {self.models_dir}")
+        self.db.init_db()
+        self.word_stats.init_indexes()
+        self.mood_stats.init_indexes()
+        self.rebuilds.init_storage()
         logger.info("MarkovChainGenerator инициализирован")
 
     def get_model_path(self, chat_id: int) -> Path:
         """Получение пути к файлу модели для конкретного чата"""
-        model_path = self.models_dir / f"model_{chat_id}.json"
-        logger.info(f"Путь к модели: {model_path}")
-        return model_path
+        return self.models_dir / f"model_{chat_id}.json"
+
+    def get_meta_path(self, chat_id: int) -> Path:
+        """Файл с отпечатком обучающих данных рядом с моделью"""
+        return self.models_dir / f"model_{chat_id}.meta.json"
+
+    def _read_meta(self, chat_id: int) -> dict:
+        try:
+            with open(self.get_meta_path(chat_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _fingerprint(self, text: str) -> str:
+        """Отпечаток обучающего текста и параметров, влияющих на модель"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{TRAINING_VERSION}:{self.state_size}:{markovify.__version__}\n".encode())
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
 
     def is_valid_message(self, message: str) -> bool:
         """Проверка валидности сообщения для обучения"""
@@ -57,40 +119,48 @@ class MarkovChainGenerator:
             
         return True
 
+    def prepare_training_lines(self, messages: Iterable[str]) -> Iterator[str]:
+        """Отбор и очистка сообщений для обучения модели"""
+        for msg in messages:
+            if self.is_valid_message(msg):
+                # Очищаем и форматируем сообщение
+                msg = msg.strip()
+                # Удаляем упоминания и команды
+                msg = ' '.join(word for word in msg.split() 
+                             if not (word.startswith('@') or word.startswith('/')))
+                if len(msg) > 1:  # Проверяем, что осталось что-то осмысленное
+                    # Добавляем маркеры начала и конца предложения
+                    yield f"START {msg} END"
+
     def add_message(self, chat_id: int, message: str) -> tuple[bool, bool]:
         """
-        Добавление нового сообщения и обновление модели при необходимости
+        Добавление нового сообщения и отметка чата для пересборки модели
         Возвращает: (сообщение_добавлено, сообщение_валидно)
         """
         try:
             if not self.is_valid_message(message):
-                logger.info("Сообщение не прошло валидацию")
+                log_sampled(logger, "Сообщение не прошло валидацию: chat_id=%s", chat_id)
                 return False, False
 
+            # Копипаста и спам не попадают в корпус и счетчики
+            if self.dedup.check(chat_id, message):
+                return False, True
+
             # Добавляем сообщение в базу
-            if not self.db.add_message(chat_id, message):
+            # Одно и то же время в базе, кэше корпуса и счетчиках: по нему кэш узнает
+            # сообщение, которое уже прочитал при загрузке, а пересчет /top и /mood -
+            # сообщение, которое уже учел по истории
+            created_at = mongo_now()
+            if not self.db.add_message(chat_id, message, created_at):
                 return False, True
+            # Сначала корпус: пересчет счетчиков берет историю из него
+            self.corpus.append(chat_id, message, created_at)
+            self.word_stats.add_message(chat_id, message, created_at)
+            self.mood_stats.add_message(chat_id, message, created_at)
 
-            stats = self.db.get_chat_stats(chat_id)
-            total_messages = stats['total_messages']
-            model_exists = self.get_model_path(chat_id).exists()
-
-            if not model_exists:
-                # Модель еще не создана
-                if total_messages >= self.min_messages:
-                    logger.info(f"Достигнуто {total_messages} сообщений, создаю первую модель...")
-                    if self.rebuild_model(chat_id):
-                        logger.info("Первая модель успешно создана")
-                    else:
-                        logger.error("Не удалось создать первую модель")
-            else:
-                # Модель уже существует, проверяем необходимость перестройки
-                if total_messages % self.rebuild_every == 0:
-                    logger.info(f"Достигнуто {total_messages} сообщений, обновляю модель...")
-                    if self.rebuild_model(chat_id):
-                        logger.info("Модель успешно обновлена")
-                    else:
-                        logger.error("Не удалось обновить модель")
+            # Модель пересоберет планировщик: сразу после накопления
+            # изменений или после паузы в чате
+            self.rebuilds.mark_dirty(chat_id)
 
             return True, True
 
@@ -98,6 +168,8 @@ class MarkovChainGenerator:
             logger.error(f"Ошибка при добавлении сообщения: {e}")
             return False, False
 
+    @timed('markov')
+    @profiled()
     def rebuild_model(self, chat_id: int):
         """
         Перестройка модели на основе всех сообщений чата
@@ -111,8 +183,10 @@ class MarkovChainGenerator:
         try:
             logger.info(f"Начало перестройки модели для чата {chat_id}")
             
-            # Получаем сообщения из базы
-            messages = self.db.get_messages(chat_id)
+            # Получаем сообщения из кэша корпуса (или из базы при промахе);
+            # после импорта истории другим процессом кэш перечитывается
+            self.corpus.invalidate_if_imported(chat_id)
+            messages = self.corpus.get_messages(chat_id)
             logger.info(f"Получено {len(messages)} сообщений для построения модели")
             
             if not messages:
@@ -121,19 +195,13 @@ class MarkovChainGenerator:
                 self.save_model(chat_id)  # Сохраняем пустую модель
                 return False
 
+            # С общей моделью чату достаточно последних сообщений: общий словарь
+            # и частые обороты берутся из нее
+            if self.base_model is not None and self.base_model.is_enabled(chat_id):
+                messages = messages[-self.base_model.overlay_max_messages:]
+
             # Фильтруем и подготавливаем сообщения
-            valid_messages = []
-            for msg in messages:
-                if self.is_valid_message(msg):
-                    # Очищаем и форматируем сообщение
-                    msg = msg.strip()
-                    # Удаляем упоминания и команды
-                    msg = ' '.join(word for word in msg.split() 
-                                 if not (word.startswith('@') or word.startswith('/')))
-                    if len(msg) > 1:  # Проверяем, что осталось что-то осмысленное
-                        # Добавляем маркеры начала и конца предложения
-                        processed_msg = f"START {msg} END"
-                        valid_messages.append(processed_msg)
+            valid_messages = list(self.prepare_training_lines(messages))
                     
             logger.info(f"Валидных сообщений после фильтрации: {len(valid_messages)}")
             
@@ -145,24 +213,34 @@ class MarkovChainGenerator:
 
             # Объединяем сообщения, добавляя перенос строки между ними
             text = "\n".join(valid_messages)
-            
+
+            # Если обучающие данные не изменились (повторный /rebuild или все новые
+            # сообщения отфильтрованы), сохраненная модель уже актуальна
+            fingerprint = self._fingerprint(text)
+            if (fingerprint == self._read_meta(chat_id).get('fingerprint')
+                    and self.get_model_path(chat_id).exists()
+                    and ((self.fingerprints.get(chat_id) == fingerprint and self.models.get(chat_id) is not None)
+                         or self.load_model(chat_id))):
+                self.fingerprints[chat_id] = fingerprint
+                MODEL_REBUILDS.inc(result='unchanged')
+                logger.info(f"Обучающие данные чата {chat_id} не изменились, пересборка пропущена")
+                return True
+
             # Сохраняем сырой текст для отладки
             debug_path = self.models_dir / f"debug_{chat_id}.txt"
-            with open(debug_path, 'w', encoding='utf-8') as f:
-                f.write(text)
+            _atomic_write(debug_path, text)
             logger.info(f"Сохранен отладочный файл: {debug_path}")
 
             try:
                 logger.info(f"Создаю модель с state_size={self.state_size}")
                 
                 # Создаем модель с настройками для лучшей генерации
+                # Ограничения перекрытия задаются при генерации (make_sentence)
                 model = markovify.NewlineText(
                     text, 
                     state_size=self.state_size,
                     well_formed=False,  # Отключаем строгую проверку для большей гибкости
-                    retain_original=True,  # Сохраняем оригинальные предложения
-                    max_overlap_ratio=0.7,  # Разрешаем большее перекрытие
-                    max_overlap_total=15    # Увеличиваем максимальное перекрытие
+                    retain_original=True  # Сохраняем оригинальные предложения
                 )
                 
                 # Тестируем модель
@@ -199,10 +277,12 @@ class MarkovChainGenerator:
                 
                 # Сохраняем модель
                 self.models[chat_id] = model
+                self.fingerprints[chat_id] = fingerprint
                 if not self.save_model(chat_id):
                     logger.error("Не удалось сохранить модель")
                     return False
                 
+                MODEL_REBUILDS.inc(result='built')
                 logger.info(f"Модель успешно перестроена и сохранена для чата {chat_id}")
                 return True
                 
@@ -218,6 +298,7 @@ class MarkovChainGenerator:
             self.save_model(chat_id)
             return False
 
+    @timed('markov')
     def save_model(self, chat_id: int) -> bool:
         """Сохранение модели в файл"""
         if chat_id not in self.models or not self.models[chat_id]:
@@ -229,13 +310,32 @@ class MarkovChainGenerator:
             # Создаем директорию, если её нет
             model_path.parent.mkdir(parents=True, exist_ok=True)
             
+            # Модель с тем же отпечатком уже на диске
+            fingerprint = self.fingerprints.get(chat_id)
+            meta_path = self.get_meta_path(chat_id)
+            if fingerprint and model_path.exists() and self._read_meta(chat_id).get('fingerprint') == fingerprint:
+                logger.debug("Модель чата %s не изменилась, запись пропущена", chat_id)
+                return True
+
             model_json = self.models[chat_id].to_json()
             if not model_json:
                 logger.error("Failed to convert model to JSON")
                 return False
-                
-            with open(model_path, 'w', encoding='utf-8') as f:
-                f.write(model_json)
+
+            # Модель и отпечаток подменяются атомарно: читатель никогда не увидит
+            # недописанный файл, даже если пишут одновременно бот и rebuild_all.
+            # Отпечаток пишется после модели, поэтому сбой между записями приведет
+            # только к лишней пересборке
+            _atomic_write(model_path, model_json)
+            if fingerprint:
+                _atomic_write(meta_path, json.dumps({
+                    'fingerprint': fingerprint,
+                    'state_size': self.state_size,
+                    'training_version': TRAINING_VERSION,
+                    'saved_at': datetime.utcnow().isoformat(timespec='seconds'),
+                }))
+            elif meta_path.exists():
+                meta_path.unlink()
             logger.info(f"Model saved to {model_path}")
             return True
             
@@ -243,6 +343,7 @@ class MarkovChainGenerator:
             logger.error(f"Error saving model: {e}")
             return False
 
+    @timed('markov')
     def load_model(self, chat_id: int) -> bool:
         """Загрузка модели для конкретного чата"""
         try:
@@ -258,6 +359,7 @@ class MarkovChainGenerator:
                     if not self.models[chat_id]:
                         logger.error("Failed to load model from JSON")
                         return False
+                    self.fingerprints[chat_id] = self._read_meta(chat_id).get('fingerprint')
                         
                     logger.info(f"Model loaded from {model_path}")
                     return True
@@ -269,21 +371,39 @@ class MarkovChainGenerator:
             self.models[chat_id] = None
             return False
 
-    def generate_response(self, chat_id: int, input_text: str = None) -> str:
+    def has_base_model(self, chat_id: int) -> bool:
+        """Может ли чат генерировать по общей модели"""
+        return (self.base_model is not None and self.base_model.is_enabled(chat_id)
+                and self.base_model.available())
+
+    @timed('markov')
+    @profiled()
+    def generate_response(self, chat_id: int, input_text: str = None,
+                          cancel_event: Optional[threading.Event] = None) -> str:
         """
         Генерация ответа на основе модели
         
         Args:
             chat_id: ID чата
             input_text: Опциональный текст для контекста генерации
+            cancel_event: Событие отмены, проверяется между попытками генерации
             
         Returns:
             str: Сгенерированный ответ или None в случае ошибки
         """
         try:
             if chat_id not in self.models or not self.models[chat_id]:
-                if not self.load_model(chat_id):
-                    return None
+                layered = self.has_base_model(chat_id)
+                # Чат с общей моделью отвечает по ней и до появления своей
+                if not layered or self.get_model_path(chat_id).exists():
+                    if not self.load_model(chat_id) and not layered:
+                        return None
+
+            model = self.models.get(chat_id)
+            if self.base_model is not None:
+                model = self.base_model.layered(chat_id, model)
+            if model is None:
+                return None
             
             # Пробуем разные стратегии генерации
             strategies = [
@@ -323,7 +443,7 @@ class MarkovChainGenerator:
                     keywords = [word for word in input_text.split() if len(word) > 3][:3]
                     if keywords:
                         start = random.choice(keywords)
-                        response = self.models[chat_id].make_sentence_with_start(
+                        response = model.make_sentence_with_start(
                             start,
                             strict=False,
                             max_words=30,
@@ -342,8 +462,11 @@ class MarkovChainGenerator:
             # Пробуем разные стратегии генерации
             for strategy in strategies:
                 for _ in range(3):  # Пробуем каждую стратегию несколько раз
+                    if cancel_event is not None and cancel_event.is_set():
+                        logger.info(f"Генерация для чата {chat_id} отменена")
+                        return None
                     try:
-                        response = self.models[chat_id].make_sentence(
+                        response = model.make_sentence(
                             max_words=strategy['max_words'],
                             min_words=strategy['min_words'],
                             tries=strategy['tries'],
@@ -385,7 +508,7 @@ class MarkovChainGenerator:
         
         # Проверяем статус модели
         if not model_exists:
-            valid_messages = len([msg for msg in self.db.get_messages(chat_id) if self.is_valid_message(msg)])
+            valid_messages = len([msg for msg in self.corpus.get_messages(chat_id) if self.is_valid_message(msg)])
             model_status = f"⏳ Сбор сообщений ({valid_messages}/{self.min_messages})"
             progress = (valid_messages / self.min_messages) * 100
             progress_bar = "▓" * int(progress/10) + "░" * (10 - int(progress/10))
@@ -396,15 +519,23 @@ class MarkovChainGenerator:
         messages_until_action = (
             self.min_messages - stats['total_messages'] 
             if not model_exists 
-            else self.rebuild_every - (stats['total_messages'] % self.rebuild_every)
+            else max(0, self.rebuilds.every - self.rebuilds.pending(chat_id))
         )
         
         action_type = "создания" if not model_exists else "обновления"
+
+        if self.base_model is None or not self.base_model.is_enabled(chat_id):
+            base_status = "выключена (/basemodel on)"
+        elif self.base_model.available():
+            base_status = "включена"
+        else:
+            base_status = "включена, еще не собрана"
         
         return (
             f"📊 *Статистика чата*\n\n"
             f"*Сообщения:*\n"
             f"└─ Всего в базе: `{stats['total_messages']}`\n"
+            f"└─ Из них в архиве: `{stats['archived_messages']}` (`{stats['archive_bytes'] // 1024}KB`)\n"
             f"└─ Средняя длина: `{stats['avg_message_length']:.1f}` символов\n\n"
             f"*Хранилище:*\n"
             f"└─ База данных: `{self.db.get_database_size() // 1024}KB`\n"
@@ -412,7 +543,8 @@ class MarkovChainGenerator:
             f"*Состояние модели:*\n"
             f"└─ Статус: {model_status}\n"
             f"└─ Прогресс: [{progress_bar}]\n"
-            f"└─ До {action_type}: `{messages_until_action}` сообщений"
+            f"└─ До {action_type}: `{messages_until_action}` сообщений\n"
+            f"└─ Общая модель: {base_status}"
         )
 
     def clear_memory(self, chat_id: int) -> bool:
@@ -422,13 +554,20 @@ class MarkovChainGenerator:
             if chat_id in self.models:
                 del self.models[chat_id]
             
-            # Удаляем файл модели
-            model_path = self.get_model_path(chat_id)
-            if model_path.exists():
-                model_path.unlink()
+            self.fingerprints.pop(chat_id, None)
+            self.dedup.forget(chat_id)
+            self.rebuilds.forget(chat_id)
+
+            # Удаляем файл модели и ее отпечаток
+            for path in (self.get_model_path(chat_id), self.get_meta_path(chat_id)):
+                if path.exists():
+                    path.unlink()
                 
             # Очищаем сообщения в базе данных
             self.db.clear_chat_history(chat_id)
+            self.word_stats.clear(chat_id)
+            self.mood_stats.clear(chat_id)
+            self.corpus.invalidate(chat_id)
             
             logger.info(f"Память чата {chat_id} очищена")
             return True
@@ -0,0 +1,273 @@
+import os
+import time
+import bisect
+import asyncio
+import inspect
+import logging
+import functools
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах: от быстрых запросов к базе до пересборки модели
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    """Базовая метрика с метками; значения меняются из разных потоков"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in items]
+
+class Gauge(Counter):
+    """Значение, которое может расти и падать"""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    """Гистограмма длительностей с фиксированными корзинами"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: счетчики по корзинам (последняя - +Inf), сумма
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            state[0][index] += 1
+            state[1][0] += value
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return sum(state[0]) if state else 0
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+# Сборщик возвращает значения, которые вычисляются в момент запроса /metrics:
+# (имя, тип, описание, [(метки, значение), ...])
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+class MetricsRegistry:
+    """Реестр метрик процесса и вывод в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Collector] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Collector):
+        """Регистрация функции, вычисляющей значения при каждом запросе метрик"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                for name, kind, documentation, samples in collector():
+                    lines.append(f'# HELP {name} {documentation}')
+                    lines.append(f'# TYPE {name} {kind}')
+                    for labels, value in samples:
+                        lines.append(f'{name}{_format_labels(list(labels), list(labels.values()))} '
+                                     f'{_format_value(value)}')
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрик: {e}")
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+# Длительность вызовов на горячем пути: обработчики, генерация, модели, хранилища
+CALL_DURATION = registry.histogram(
+    'ebanez_call_duration_seconds', 'Длительность вызовов по компонентам', ('component', 'method'))
+GENERATIONS = registry.counter(
+    'ebanez_generations_total', 'Результаты генерации ответов', ('result',))
+MODEL_REBUILDS = registry.counter(
+    'ebanez_model_rebuilds_total', 'Пересборки моделей по результату', ('result',))
+DEDUP_MESSAGES = registry.counter(
+    'ebanez_dedup_messages_total', 'Проверенные на дубликаты сообщения по результату', ('result',))
+DEDUP_BYTES = registry.counter(
+    'ebanez_dedup_bytes_saved_total', 'Объем текста дубликатов, не попавших в корпус')
+ARCHIVED_MESSAGES = registry.counter(
+    'ebanez_archived_messages_total', 'Сообщения, перенесенные из messages в сжатый архив')
+
+def timed(component: str, method: Optional[str] = None):
+    """
+    Декоратор: записывает длительность вызова в ebanez_call_duration_seconds.
+    Поддерживает обычные функции, корутины и генераторы (для генератора
+    измеряется весь проход по результатам)
+    """
+    def decorator(func):
+        labels = {'component': component, 'method': method or func.__name__}
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    CALL_DURATION.observe(time.perf_counter() - started, **labels)
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def gen_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    yield from func(*args, **kwargs)
+                finally:
+                    CALL_DURATION.observe(time.perf_counter() - started, **labels)
+            return gen_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                CALL_DURATION.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+def process_memory_bytes() -> Optional[int]:
+    """Текущий RSS процесса (Linux), None если недоступно"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """HTTP-обработчик /metrics для aiohttp"""
+    body = await asyncio.to_thread(registry.render)
+    return web.Response(text=body, content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+class MetricsServer:
+    """Отдельный HTTP-сервер метрик для режима polling"""
+
+    def __init__(self, host: Optional[str] = None, port: Optional[int] = None):
+        self.host = host or os.getenv('METRICS_HOST', '0.0.0.0')
+        self.port = port or int(os.getenv('METRICS_PORT', '9090'))
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Метрики доступны на {self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,81 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+from .markov_chain import MarkovChainGenerator
+from .generation_pool import GenerationPool
+from .shard_router import current_shard, owns_chat
+
+logger = logging.getLogger(__name__)
+
+# Загруженная модель markovify занимает в памяти примерно в несколько раз больше JSON-файла
+MODEL_MEMORY_FACTOR = 3
+
+async def warm_up_models(generator: MarkovChainGenerator, pool: GenerationPool,
+                         max_chats: Optional[int] = None, time_budget: Optional[float] = None,
+                         memory_budget_mb: Optional[int] = None, delay: float = 1.0) -> dict:
+    """
+    Фоновая предзагрузка моделей недавно активных чатов после старта бота
+
+    Args:
+        generator: Генератор, в который загружаются модели
+        pool: Пул, в котором выполняется загрузка (не блокирует event loop)
+        max_chats: Сколько самых активных чатов прогревать (0 - отключить)
+        time_budget: Максимальная длительность прогрева в секундах
+        memory_budget_mb: Примерный лимит памяти под загруженные модели
+        delay: Пауза перед началом, чтобы бот успел начать принимать апдейты
+
+    Returns:
+        dict: Итоги прогрева
+    """
+    max_chats = max_chats if max_chats is not None else int(os.getenv('WARMUP_MAX_CHATS', '50'))
+    time_budget = time_budget or float(os.getenv('WARMUP_TIME_BUDGET', '120'))
+    memory_budget = (memory_budget_mb or int(os.getenv('WARMUP_MEMORY_MB', '512'))) * 1024 * 1024
+    summary = {'loaded': 0, 'failed': 0, 'skipped': 0, 'memory_mb': 0.0, 'elapsed': 0.0}
+    if max_chats <= 0:
+        logger.info("Прогрев моделей отключен")
+        return summary
+
+    await asyncio.sleep(delay)
+    started = time.perf_counter()
+
+    # В шардированном режиме каждый воркер прогревает только свои чаты
+    _, shards = current_shard()
+    chat_ids = await asyncio.to_thread(generator.db.get_recent_chat_ids, max_chats * shards)
+    chat_ids = [chat_id for chat_id in chat_ids if owns_chat(chat_id)][:max_chats]
+    logger.info(f"Прогрев моделей: {len(chat_ids)} чатов, бюджет {time_budget:.0f}s / "
+                f"{memory_budget // (1024 * 1024)}MB")
+
+    memory_used = 0
+    for i, chat_id in enumerate(chat_ids, 1):
+        remaining = time_budget - (time.perf_counter() - started)
+        if remaining <= 0:
+            logger.info("Прогрев остановлен: исчерпан бюджет времени")
+            break
+        if memory_used >= memory_budget:
+            logger.info("Прогрев остановлен: исчерпан бюджет памяти")
+            break
+        # Чаты без файла модели не прогреваем: load_model запустил бы полную пересборку
+        # (а чаты меньше min_messages пересобирались бы при каждом старте)
+        model_path = generator.get_model_path(chat_id)
+        if generator.models.get(chat_id) or not model_path.exists():
+            summary['skipped'] += 1
+            continue
+
+        chat_started = time.perf_counter()
+        loaded = await pool.run(generator.load_model, chat_id, timeout=remaining)
+        if loaded and model_path.exists():
+            memory_used += model_path.stat().st_size * MODEL_MEMORY_FACTOR
+            summary['loaded'] += 1
+        else:
+            summary['failed'] += 1
+        logger.info(
+            f"Прогрев {i}/{len(chat_ids)}: чат {chat_id} "
+            f"{'загружен' if loaded else 'без модели'} за {time.perf_counter() - chat_started:.2f}s"
+        )
+
+    summary['memory_mb'] = round(memory_used / (1024 * 1024), 1)
+    summary['elapsed'] = round(time.perf_counter() - started, 2)
+    logger.info(f"Прогрев моделей завершен: {summary}")
+    return summary
@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from pymongo.collection import Collection
+from pymongo.database import Database as MongoDatabase
+
+logger = logging.getLogger(__name__)
+
+# Базовый словарь настроения: эмодзи и ключевые слова
+DEFAULT_LEXICON = {
+    'positive': ['😊', '😄', '👍', '❤️', 'круто', 'класс', 'супер', 'отлично'],
+    'negative': ['😢', '😠', '👎', '💔', 'плохо', 'ужас', 'отстой'],
+}
+
+class MoodStats:
+    """Потоковые счетчики настроения чата для команды /mood"""
+
+    def __init__(self, db: MongoDatabase, lexicon: Optional[Dict[str, List[str]]] = None):
+        self.lexicon = lexicon or self._load_lexicon()
+        self._pattern, self._polarity = self._compile(self.lexicon)
+        # Сколько дней хранить почасовые счетчики
+        self.bucket_retention_days = int(os.getenv('MOOD_STATS_DAYS', '7'))
+        self.totals: Collection = db.mood_totals
+        self.hourly: Collection = db.mood_hourly
+        self.state: Collection = db.analytics_state
+        # Счетчики сообщений, пришедших во время пересчета чата: применяются после него
+        self._journals: Dict[int, List[Tuple[datetime, Dict[str, int]]]] = {}
+        self._chat_locks: Dict[int, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load_lexicon() -> Dict[str, List[str]]:
+        """Базовый словарь, дополненный словами из MOOD_LEXICON_PATH"""
+        lexicon = {key: list(words) for key, words in DEFAULT_LEXICON.items()}
+        path = os.getenv('MOOD_LEXICON_PATH')
+        if path:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    extra = json.load(f)
+                for key in lexicon:
+                    lexicon[key].extend(word.lower() for word in extra.get(key, []))
+                logger.info(f"Загружен словарь настроения из {path}")
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке словаря настроения: {e}")
+        return lexicon
+
+    @staticmethod
+    def _compile(lexicon: Dict[str, List[str]]) -> Tuple[re.Pattern, Dict[str, str]]:
+        """Сборка одного регулярного выражения для всех ключевых слов"""
+        polarity = {}
+        for key, words in lexicon.items():
+            for word in words:
+                polarity[word] = key
+        # Длинные слова первыми, чтобы альтернация не обрезала совпадения
+        alternation = '|'.join(re.escape(word) for word in sorted(polarity, key=len, reverse=True))
+        return re.compile(alternation), polarity
+
+    def init_indexes(self):
+        """Создание индексов для счетчиков"""
+        try:
+            self.totals.create_index('chat_id', unique=True)
+            self.hourly.create_index([('chat_id', 1), ('hour', 1)], unique=True)
+            # Старые почасовые счетчики удаляются самой MongoDB
+            self.hourly.create_index(
+                'hour', expireAfterSeconds=self.bucket_retention_days * 86400)
+            self.state.create_index([('chat_id', 1), ('kind', 1)], unique=True)
+        except Exception as e:
+            logger.error(f"Ошибка при создании индексов MoodStats: {e}")
+
+    def score(self, text: str) -> Dict[str, int]:
+        """Подсчет совпадений за один проход по сообщению"""
+        counts = {key: 0 for key in self.lexicon}
+        for match in self._pattern.finditer(text.lower()):
+            counts[self._polarity[match.group()]] += 1
+        return counts
+
+    @staticmethod
+    def _hour_start(moment: datetime) -> datetime:
+        return moment.replace(minute=0, second=0, microsecond=0)
+
+    def _chat_lock(self, chat_id: int) -> threading.Lock:
+        with self._lock:
+            return self._chat_locks.setdefault(chat_id, threading.Lock())
+
+    def add_message(self, chat_id: int, text: str, created_at: Optional[datetime] = None) -> bool:
+        """Учет настроения нового сообщения"""
+        counts = self.score(text)
+        if not any(counts.values()):
+            return True
+
+        created_at = created_at or datetime.utcnow()
+        with self._chat_lock(chat_id):
+            journal = self._journals.get(chat_id)
+            if journal is not None:
+                journal.append((created_at, counts))
+                return True
+            return self._inc(chat_id, counts, created_at)
+
+    def _inc(self, chat_id: int, counts: Dict[str, int], created_at: datetime) -> bool:
+        hour = self._hour_start(created_at)
+        try:
+            self.totals.update_one({'chat_id': chat_id}, {'$inc': counts}, upsert=True)
+            self.hourly.update_one({'chat_id': chat_id, 'hour': hour}, {'$inc': counts}, upsert=True)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении счетчиков настроения: {e}")
+            return False
+
+    def get_counts(self, chat_id: int, hours: Optional[int] = None) -> Dict[str, int]:
+        """
+        Счетчики настроения чата
+
+        Args:
+            chat_id: ID чата
+            hours: Окно в часах (None - за все время)
+        """
+        counts = {key: 0 for key in self.lexicon}
+        try:
+            if hours is None:
+                docs = [self.totals.find_one({'chat_id': chat_id}) or {}]
+            else:
+                since = self._hour_start(datetime.utcnow()) - timedelta(hours=hours - 1)
+                docs = self.hourly.find({'chat_id': chat_id, 'hour': {'$gte': since}})
+            for doc in docs:
+                for key in counts:
+                    counts[key] += doc.get(key, 0)
+        except Exception as e:
+            logger.error(f"Ошибка при получении счетчиков настроения: {e}")
+        return counts
+
+    def is_indexed(self, chat_id: int) -> bool:
+        """Посчитано ли настроение по истории чата"""
+        try:
+            return self.state.find_one({'chat_id': chat_id, 'kind': 'mood'}) is not None
+        except Exception as e:
+            logger.error(f"Ошибка при проверке счетчиков настроения: {e}")
+            return False
+
+    def rebuild(self, chat_id: int, messages: Iterable[dict]) -> bool:
+        """
+        Полный пересчет настроения по истории чата.
+        Счетчики перезаписываются, поэтому повторный вызов безопасен.
+        Сообщения, пришедшие во время пересчета, копятся в журнале и добавляются
+        после записи, если их не было в переданной истории
+
+        Args:
+            messages: Документы с полями text и created_at (от старых к новым)
+        """
+        with self._chat_lock(chat_id):
+            self._journals[chat_id] = []
+        try:
+            since = self._hour_start(datetime.utcnow()) - timedelta(days=self.bucket_retention_days)
+            totals = {key: 0 for key in self.lexicon}
+            hourly: Dict[datetime, Dict[str, int]] = {}
+            last = None
+            for doc in messages:
+                created_at = doc.get('created_at')
+                if created_at:
+                    last = created_at
+                counts = self.score(doc.get('text') or '')
+                if not any(counts.values()):
+                    continue
+                bucket = None
+                if created_at and created_at >= since:
+                    bucket = hourly.setdefault(self._hour_start(created_at), {key: 0 for key in self.lexicon})
+                for key, n in counts.items():
+                    totals[key] += n
+                    if bucket is not None:
+                        bucket[key] += n
+
+            self.hourly.delete_many({'chat_id': chat_id})
+            self.totals.update_one({'chat_id': chat_id}, {'$set': totals}, upsert=True)
+            for hour, counts in hourly.items():
+                self.hourly.update_one({'chat_id': chat_id, 'hour': hour}, {'$set': counts}, upsert=True)
+
+            # История идет по порядку, поэтому сообщения не позже последнего в ней уже учтены
+            with self._chat_lock(chat_id):
+                journal = self._journals.pop(chat_id, [])
+            for created_at, counts in journal:
+                if last is None or created_at > last:
+                    self._inc(chat_id, counts, created_at)
+
+            self.state.update_one(
+                {'chat_id': chat_id, 'kind': 'mood'},
+                {'$set': {'indexed_at': datetime.utcnow()}},
+                upsert=True
+            )
+            logger.info(f"Настроение для chat_id={chat_id} пересчитано: {totals}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка при пересчете настроения: {e}")
+            return False
+        finally:
+            with self._chat_lock(chat_id):
+                self._journals.pop(chat_id, None)
+
+    def clear(self, chat_id: int) -> bool:
+        """Удаление счетчиков чата"""
+        try:
+            self.totals.delete_one({'chat_id': chat_id})
+            self.hourly.delete_many({'chat_id': chat_id})
+            self.state.delete_one({'chat_id': chat_id, 'kind': 'mood'})
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при очистке счетчиков настроения: {e}")
+            return False
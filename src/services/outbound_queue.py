@@ -0,0 +1,331 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+from enum import IntEnum
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    """Приоритет исходящих действий: меньше - важнее"""
+    REPLY = 0
+    MEDIA = 1
+    BROADCAST = 2
+    PROGRESS = 3
+    REACTION = 4
+    TYPING = 5
+
+# Сколько секунд косметическое действие остается актуальным
+DEFAULT_TTL = {
+    Priority.PROGRESS: 60.0,
+    Priority.REACTION: 30.0,
+    Priority.TYPING: 5.0,
+}
+
+class _TokenBucket:
+    """Простой token bucket: rate токенов в секунду, не больше burst"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        """Обнуление токенов на время (например, после 429)"""
+        self._refill(now)
+        self.tokens = -seconds * self.rate
+
+class _Job:
+    __slots__ = ('chat_id', 'factory', 'priority', 'coalesce_key', 'future',
+                 'not_before', 'deadline', 'attempts', 'seq', 'raise_errors')
+
+    def __init__(self, chat_id, factory, priority, coalesce_key, future, not_before, deadline,
+                 raise_errors=False):
+        self.chat_id = chat_id
+        self.factory = factory
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.future = future
+        self.not_before = not_before
+        self.deadline = deadline
+        self.attempts = 0
+        self.seq = 0
+        self.raise_errors = raise_errors
+
+    def __lt__(self, other: '_Job') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundScheduler:
+    """
+    Центральная очередь исходящих вызовов Telegram API.
+
+    Соблюдает глобальный лимит и лимит на чат, объединяет повторяющиеся
+    действия (прогресс, "печатает...") и отправляет ответы раньше реакций.
+
+    В общей куче лежат только действия, которые можно отправить сразу. Отложенные
+    (delay, повтор после 429) ждут в куче по времени, а упершиеся в лимит чата -
+    в очереди своего чата, из которой по таймеру чата в общую кучу возвращается
+    одно действие. Поэтому отправка не перебирает очередь целиком, даже когда
+    в ней тысячи действий для чатов, исчерпавших лимит.
+    """
+
+    def __init__(self, global_rate: Optional[float] = None, chat_rate: Optional[float] = None,
+                 chat_burst: Optional[float] = None, max_retries: int = 3):
+        self.global_rate = global_rate or float(os.getenv('OUTBOUND_GLOBAL_RATE', '25'))
+        # Лимит Telegram для групп - около 20 сообщений в минуту
+        self.chat_rate = chat_rate or float(os.getenv('OUTBOUND_CHAT_RATE', '20')) / 60
+        self.chat_burst = chat_burst or float(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+        self.max_retries = max_retries
+        self._global = _TokenBucket(self.global_rate, self.global_rate)
+        self._chats: Dict[int, _TokenBucket] = {}
+        self._heap: List[_Job] = []
+        # (not_before, seq, действие) для действий, которые еще рано отправлять
+        self._delayed: List[Tuple[float, int, _Job]] = []
+        # Действия чатов, исчерпавших лимит, и таймеры (время, chat_id) их возврата
+        self._parked: Dict[int, List[_Job]] = {}
+        self._parked_count = 0
+        self._chat_timers: List[Tuple[float, int]] = []
+        self._armed: Set[int] = set()
+        self._pending: Dict[Hashable, _Job] = {}
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: set = set()
+        self.sent = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    @property
+    def depth(self) -> int:
+        """Количество действий в очереди"""
+        return len(self._heap) + len(self._delayed) + self._parked_count
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run(), name='outbound-scheduler')
+
+    def submit(self, chat_id: int, factory: Callable[[], Awaitable], priority: Priority = Priority.REPLY,
+               coalesce_key: Optional[Hashable] = None, replace: bool = True,
+               delay: float = 0.0, ttl: Optional[float] = None,
+               raise_errors: bool = False) -> asyncio.Future:
+        """
+        Постановка действия в очередь
+
+        Args:
+            chat_id: ID чата, к которому относится действие
+            factory: Функция без аргументов, возвращающая корутину вызова API
+            priority: Приоритет действия
+            coalesce_key: Ключ объединения. Пока действие с таким ключом ждет в очереди,
+                новое либо заменяет его (replace=True), либо отбрасывается (replace=False)
+            delay: Не отправлять раньше, чем через delay секунд
+            ttl: Через сколько секунд ожидания действие теряет смысл и отбрасывается
+            raise_errors: Передавать ошибку вызова в Future вместо None
+                (нужно, если вызывающему важно отличить, например, удаление бота из чата)
+
+        Returns:
+            Future с результатом вызова (None, если действие отброшено или не удалось)
+        """
+        self._ensure_worker()
+        now = time.monotonic()
+
+        if coalesce_key is not None and coalesce_key in self._pending:
+            job = self._pending[coalesce_key]
+            self.coalesced += 1
+            if replace:
+                job.factory = factory
+                job.not_before = max(job.not_before, now + delay)
+            return job.future
+
+        if ttl is None:
+            ttl = DEFAULT_TTL.get(priority)
+        job = _Job(
+            chat_id, factory, priority, coalesce_key,
+            asyncio.get_running_loop().create_future(),
+            now + delay,
+            now + delay + ttl if ttl else None,
+            raise_errors
+        )
+        if coalesce_key is not None:
+            self._pending[coalesce_key] = job
+        self._push(job)
+        return job.future
+
+    def _push(self, job: _Job):
+        self._seq += 1
+        job.seq = self._seq
+        heapq.heappush(self._heap, job)
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id: int) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = _TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _park(self, job: _Job, ready_at: float):
+        """Действие ждет лимита своего чата"""
+        heapq.heappush(self._parked.setdefault(job.chat_id, []), job)
+        self._parked_count += 1
+        self._arm(job.chat_id, ready_at)
+
+    def _arm(self, chat_id: int, ready_at: float):
+        if chat_id not in self._armed:
+            self._armed.add(chat_id)
+            heapq.heappush(self._chat_timers, (ready_at, chat_id))
+
+    def _release(self, chat_id: int):
+        """Возврат самого приоритетного ожидающего действия чата в общую кучу"""
+        parked = self._parked.get(chat_id)
+        if not parked:
+            return
+        heapq.heappush(self._heap, heapq.heappop(parked))
+        self._parked_count -= 1
+        if not parked:
+            del self._parked[chat_id]
+
+    def _next_ready(self, now: float):
+        """Самое приоритетное действие, которое можно отправить сейчас, и время до следующего"""
+        while self._delayed and self._delayed[0][0] <= now:
+            heapq.heappush(self._heap, heapq.heappop(self._delayed)[2])
+        while self._chat_timers and self._chat_timers[0][0] <= now:
+            _, chat_id = heapq.heappop(self._chat_timers)
+            self._armed.discard(chat_id)
+            self._release(chat_id)
+
+        ready = None
+        while self._heap:
+            job = heapq.heappop(self._heap)
+            if job.deadline is not None and now > job.deadline:
+                self._finish(job, None)
+                self.expired += 1
+                # Следующее действие чата не должно ждать таймера, которого нет
+                if job.chat_id not in self._armed:
+                    self._release(job.chat_id)
+                continue
+            if job.not_before > now:
+                heapq.heappush(self._delayed, (job.not_before, job.seq, job))
+                continue
+            # "Печатает..." не считается сообщением и не тратит лимит чата
+            if job.priority != Priority.TYPING:
+                delay = self._chat_bucket(job.chat_id).wait_time(now)
+                if delay > 0:
+                    self._park(job, now + delay)
+                    continue
+            ready = job
+            break
+
+        wake_times = []
+        if self._delayed:
+            wake_times.append(self._delayed[0][0])
+        if self._chat_timers:
+            wake_times.append(self._chat_timers[0][0])
+        return ready, max(min(wake_times) - now, 0.0) if wake_times else None
+
+    def _finish(self, job: _Job, result):
+        if job.coalesce_key is not None and self._pending.get(job.coalesce_key) is job:
+            del self._pending[job.coalesce_key]
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _fail(self, job: _Job, error: Exception):
+        if job.raise_errors and not job.future.done():
+            job.future.set_exception(error)
+        self._finish(job, None)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            job, wait = self._next_ready(now)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._global.take(now)
+            if job.priority != Priority.TYPING:
+                bucket = self._chat_bucket(job.chat_id)
+                bucket.take(now)
+                # Остальные действия чата вернутся, когда появится следующий токен
+                if job.chat_id in self._parked:
+                    self._arm(job.chat_id, now + bucket.wait_time(now))
+            # Действие перестает быть "ожидающим": новые с тем же ключом встанут в очередь
+            if job.coalesce_key is not None and self._pending.get(job.coalesce_key) is job:
+                del self._pending[job.coalesce_key]
+            task = asyncio.create_task(self._send(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, job: _Job):
+        job.attempts += 1
+        try:
+            result = await job.factory()
+            self.sent += 1
+            self._finish(job, result)
+        except RetryAfter as e:
+            self.rate_limited += 1
+            retry_after = float(e.retry_after.total_seconds()
+                                if hasattr(e.retry_after, 'total_seconds') else e.retry_after)
+            logger.warning(f"Flood limit в чате {job.chat_id}, повтор через {retry_after}s")
+            now = time.monotonic()
+            self._chat_bucket(job.chat_id).pause(now, retry_after)
+            if job.attempts <= self.max_retries:
+                job.not_before = now + retry_after
+                if job.deadline is not None:
+                    job.deadline = max(job.deadline, job.not_before + 1)
+                self._push(job)
+            else:
+                self.failed += 1
+                self._fail(job, e)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка исходящего вызова для чата {job.chat_id}: {e}")
+            self._fail(job, e)
+
+    async def stop(self, timeout: float = 10.0):
+        """Отправка оставшихся действий и остановка"""
+        if self._worker is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self._worker.cancel()
+        for job in self._heap + [job for _, _, job in self._delayed] + [
+                job for parked in self._parked.values() for job in parked]:
+            self._finish(job, None)
+        self._heap.clear()
+        self._delayed.clear()
+        self._parked.clear()
+        self._parked_count = 0
+        self._chat_timers.clear()
+        self._armed.clear()
+        logger.info(f"OutboundScheduler остановлен: отправлено {self.sent}, объединено {self.coalesced}")
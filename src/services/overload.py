@@ -0,0 +1,106 @@
+import os
+import time
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+class _Tracker:
+    """Контекст замера одного обработчика"""
+
+    __slots__ = ('controller', 'started')
+
+    def __init__(self, controller: 'OverloadController'):
+        self.controller = controller
+
+    def __enter__(self):
+        self.controller.in_flight += 1
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.controller.in_flight -= 1
+        self.controller.observe_latency(time.perf_counter() - self.started)
+        return False
+
+class OverloadController:
+    """
+    Контроль перегрузки: при росте очереди апдейтов или времени обработки
+    отключает необязательную работу (реакции, эхо стикеров, случайные ответы).
+    Сохранение сообщений и явные команды не отключаются никогда.
+    """
+
+    def __init__(self, max_queue_depth: int = None, max_latency: float = None):
+        self.max_queue_depth = max_queue_depth or int(os.getenv('OVERLOAD_QUEUE_DEPTH', '100'))
+        self.max_latency = max_latency or float(os.getenv('OVERLOAD_LATENCY_MS', '2000')) / 1000
+        # Выход из перегрузки при падении ниже этой доли порогов (гистерезис)
+        self.recover_ratio = float(os.getenv('OVERLOAD_RECOVER_RATIO', '0.5'))
+        self.alpha = 0.2  # Коэффициент сглаживания EWMA
+        self.latency_ewma = 0.0
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.shedding = False
+        self.shedding_since = None
+        self.transitions = 0
+        self.shed_counts = Counter()
+        logger.info(
+            f"OverloadController: очередь > {self.max_queue_depth} "
+            f"или задержка > {self.max_latency * 1000:.0f}ms"
+        )
+
+    def set_backlog(self, queue_depth: int):
+        """Число принятых и еще не обработанных апдейтов (сообщает ChatOrderedUpdateProcessor)"""
+        self.queue_depth = queue_depth
+        self._update_state()
+
+    def track(self) -> _Tracker:
+        """Замер обработчика: with overload.track(): ..."""
+        return _Tracker(self)
+
+    def observe_latency(self, seconds: float):
+        self.latency_ewma += self.alpha * (seconds - self.latency_ewma)
+        self._update_state()
+
+    @property
+    def load(self) -> int:
+        """Апдейты, ожидающие обработки, вместе с обрабатываемыми прямо сейчас"""
+        return self.queue_depth
+
+    def _update_state(self):
+        if not self.shedding:
+            if self.load > self.max_queue_depth or self.latency_ewma > self.max_latency:
+                self.shedding = True
+                self.shedding_since = time.monotonic()
+                self.transitions += 1
+                logger.warning(
+                    f"Перегрузка: очередь={self.load}, задержка={self.latency_ewma * 1000:.0f}ms. "
+                    f"Отключаю необязательную работу"
+                )
+        elif (self.load < self.max_queue_depth * self.recover_ratio
+              and self.latency_ewma < self.max_latency * self.recover_ratio):
+            duration = time.monotonic() - self.shedding_since
+            self.shedding = False
+            self.shedding_since = None
+            self.transitions += 1
+            logger.warning(
+                f"Нагрузка нормализовалась через {duration:.1f}s. "
+                f"Пропущено действий: {dict(self.shed_counts)}"
+            )
+
+    def should_shed(self, kind: str) -> bool:
+        """Нужно ли пропустить необязательное действие kind"""
+        if self.shedding:
+            self.shed_counts[kind] += 1
+            return True
+        return False
+
+    def snapshot(self) -> dict:
+        """Текущее состояние для метрик"""
+        return {
+            'shedding': self.shedding,
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'latency_ewma_ms': round(self.latency_ewma * 1000, 1),
+            'transitions': self.transitions,
+            'shed': dict(self.shed_counts),
+        }
@@ -0,0 +1,128 @@
+import os
+import io
+import time
+import pstats
+import cProfile
+import logging
+import functools
+import threading
+import tracemalloc
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class ProfilingManager:
+    """
+    Профилирование по запросу: cProfile и tracemalloc для следующих N вызовов
+    пересборки модели и генерации в заданном чате.
+
+    По умолчанию ничего не включено, и обернутый вызов стоит одну проверку словаря.
+    Результаты (дамп pstats и текстовый отчет с топом функций и мест аллокаций)
+    пишутся в PROFILE_DIR (по умолчанию data/profiles).
+    """
+
+    def __init__(self, output_dir: Optional[Path] = None):
+        self.output_dir = output_dir or Path(
+            os.getenv('PROFILE_DIR', Path(__file__).parent.parent.parent / 'data' / 'profiles'))
+        self.top_functions = int(os.getenv('PROFILE_TOP', '40'))
+        self.max_calls = int(os.getenv('PROFILE_MAX_CALLS', '20'))
+        # chat_id -> сколько вызовов еще профилировать
+        self._armed: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        # tracemalloc глобален для процесса, поэтому одновременно идет только один захват
+        self._capture_lock = threading.Lock()
+
+    def arm(self, chat_id: int, calls: int = 1) -> int:
+        """Профилировать следующие calls вызовов для чата. Возвращает итоговое число"""
+        calls = max(1, min(calls, self.max_calls))
+        with self._lock:
+            self._armed[chat_id] = calls
+        logger.info(f"Профилирование включено для чата {chat_id}: {calls} вызовов")
+        return calls
+
+    def disarm(self, chat_id: int) -> bool:
+        with self._lock:
+            return self._armed.pop(chat_id, None) is not None
+
+    def remaining(self, chat_id: int) -> int:
+        return self._armed.get(chat_id, 0)
+
+    def _take(self, chat_id: int) -> bool:
+        """Списывает один вызов, если чат отмечен и сейчас не идет другой захват"""
+        with self._lock:
+            left = self._armed.get(chat_id)
+            if not left or not self._capture_lock.acquire(blocking=False):
+                return False
+            if left > 1:
+                self._armed[chat_id] = left - 1
+            else:
+                del self._armed[chat_id]
+            return True
+
+    def run(self, operation: str, chat_id: int, func, *args, **kwargs):
+        """Выполнение func под профилировщиком (если чат отмечен) или как есть"""
+        if not self._armed or not self._take(chat_id):
+            return func(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start(int(os.getenv('PROFILE_TRACEBACK_DEPTH', '1')))
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                elapsed = time.perf_counter() - started
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                if not tracing:
+                    tracemalloc.stop()
+                self._write(operation, chat_id, profiler, snapshot, peak, elapsed)
+        finally:
+            self._capture_lock.release()
+
+    def _write(self, operation: str, chat_id: int, profiler: cProfile.Profile,
+               snapshot: tracemalloc.Snapshot, peak: int, elapsed: float):
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            base = self.output_dir / f"{operation}_{chat_id}_{time.strftime('%Y%m%d-%H%M%S')}_{time.time_ns() % 10**6}"
+            profiler.dump_stats(f"{base}.prof")
+
+            report = io.StringIO()
+            report.write(f"{operation} chat_id={chat_id}: {elapsed:.3f}s, пик памяти {peak / 1024 / 1024:.2f} MB\n\n")
+            report.write("Места аллокаций (живые объекты на конец вызова):\n")
+            snapshot = snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ))
+            for stat in snapshot.statistics('lineno')[:self.top_functions]:
+                report.write(f"  {stat}\n")
+            report.write("\nФункции по накопленному времени:\n")
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(self.top_functions)
+            Path(f"{base}.txt").write_text(report.getvalue(), encoding='utf-8')
+            logger.info(f"Профиль {operation} для чата {chat_id} записан в {base}.txt ({elapsed:.3f}s)")
+        except Exception as e:
+            logger.error(f"Не удалось записать профиль {operation} для чата {chat_id}: {e}")
+
+profiler = ProfilingManager()
+
+def profiled(operation: Optional[str] = None):
+    """
+    Декоратор метода с первым аргументом chat_id: вызов профилируется,
+    если чат отмечен через profiler.arm()
+    """
+    def decorator(func):
+        name = operation or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(self, chat_id, *args, **kwargs):
+            if not profiler._armed:
+                return func(self, chat_id, *args, **kwargs)
+            return profiler.run(name, chat_id, func, self, chat_id, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,174 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+from pymongo.collection import Collection
+from .shard_router import owns_chat
+
+logger = logging.getLogger(__name__)
+
+class _DirtyChat:
+    """Изменения чата, еще не попавшие в модель"""
+
+    __slots__ = ('pending', 'last_message', 'too_small')
+
+    def __init__(self, last_message: float):
+        self.pending = 0
+        self.last_message = last_message
+        # Сообщений меньше минимума для первой модели: проверяется снова после нового сообщения
+        self.too_small = False
+
+class RebuildScheduler:
+    """
+    Отложенная пересборка моделей по факту изменения корпуса.
+
+    add_message помечает чат как измененный, а фоновый цикл (run) пересобирает
+    модель, когда накопилось REBUILD_EVERY новых сообщений или чат молчит
+    REBUILD_QUIET_SECONDS. Всплеск сообщений дает одну пересборку вместо пересборки
+    на каждом кратном числе, а пропущенное кратное не теряет пересборку.
+
+    Счетчики новых сообщений хранятся в памяти. В коллекцию rebuild_state пишется
+    только переход чата в "грязное" состояние и обратно (одна запись на всплеск),
+    поэтому после перезапуска недостроенные чаты пересобираются по таймеру тишины.
+    В шардированном режиме каждый воркер отвечает только за свои чаты
+    """
+
+    def __init__(self, generator, every: Optional[int] = None, quiet_seconds: Optional[float] = None):
+        self.generator = generator
+        self.every = every or int(os.getenv('REBUILD_EVERY', '10'))
+        self.quiet_seconds = quiet_seconds if quiet_seconds is not None else float(
+            os.getenv('REBUILD_QUIET_SECONDS', '120'))
+        self.interval = float(os.getenv('REBUILD_CHECK_INTERVAL', '5'))
+        self.state: Collection = generator.db.db.rebuild_state
+        self._dirty: Dict[int, _DirtyChat] = {}
+        self._running: Set[int] = set()
+        # Плановая и ручная (/rebuild) пересборки одного чата не идут одновременно
+        self._chat_locks: Dict[int, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def init_storage(self):
+        """Создание индексов и загрузка чатов, не пересобранных до перезапуска"""
+        try:
+            self.state.create_index('chat_id', unique=True)
+            self.state.create_index('dirty', sparse=True)
+            now = time.monotonic()
+            restored = 0
+            for doc in self.state.find({'dirty': True}, {'_id': 0, 'chat_id': 1}):
+                if not owns_chat(doc['chat_id']):
+                    continue
+                with self._lock:
+                    self._dirty.setdefault(doc['chat_id'], _DirtyChat(now))
+                restored += 1
+            logger.info(f"Чатов, ожидающих пересборки модели: {restored}")
+        except Exception as e:
+            logger.error(f"Ошибка при инициализации планировщика пересборки: {e}")
+
+    def _persist(self, chat_id: int, dirty: bool):
+        fields = {'dirty': True, 'dirty_since': datetime.utcnow()} if dirty else {
+            'dirty': False, 'rebuilt_at': datetime.utcnow()}
+        try:
+            self.state.update_one({'chat_id': chat_id}, {'$set': fields}, upsert=True)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении состояния пересборки чата {chat_id}: {e}")
+
+    def mark_dirty(self, chat_id: int):
+        """Новое сообщение чата попало в корпус"""
+        with self._lock:
+            entry = self._dirty.get(chat_id)
+            became_dirty = entry is None
+            if became_dirty:
+                entry = self._dirty[chat_id] = _DirtyChat(time.monotonic())
+            entry.pending += 1
+            entry.last_message = time.monotonic()
+            entry.too_small = False
+        if became_dirty:
+            self._persist(chat_id, True)
+
+    def pending(self, chat_id: int) -> int:
+        """Сколько сообщений чата еще не попало в модель"""
+        with self._lock:
+            entry = self._dirty.get(chat_id)
+            return entry.pending if entry else 0
+
+    def due(self) -> List[int]:
+        """Чаты, которым пора пересобрать модель (сначала с наибольшим числом изменений)"""
+        now = time.monotonic()
+        with self._lock:
+            ready = [
+                (entry.pending, chat_id) for chat_id, entry in self._dirty.items()
+                if chat_id not in self._running and not entry.too_small
+                and (entry.pending >= self.every or now - entry.last_message >= self.quiet_seconds)
+            ]
+        return [chat_id for _, chat_id in sorted(ready, reverse=True)]
+
+    def rebuild(self, chat_id: int) -> bool:
+        """Пересборка модели чата с учетом накопленных изменений"""
+        with self._lock:
+            chat_lock = self._chat_locks.setdefault(chat_id, threading.Lock())
+        with chat_lock:
+            return self._rebuild(chat_id)
+
+    def _rebuild(self, chat_id: int) -> bool:
+        with self._lock:
+            entry = self._dirty.get(chat_id)
+            taken = entry.pending if entry else 0
+            self._running.add(chat_id)
+
+        generator = self.generator
+        ok = False
+        too_small = False
+        try:
+            # Первую модель нет смысла строить, пока сообщений меньше минимума
+            too_small = (not generator.get_model_path(chat_id).exists()
+                         and generator.db.get_message_count(chat_id) < generator.min_messages)
+            if not too_small:
+                logger.info(f"Накоплено изменений чата {chat_id}: {taken}, пересобираю модель...")
+                ok = generator.rebuild_model(chat_id)
+        finally:
+            # Сообщения, пришедшие во время пересборки, оставляют чат "грязным"
+            with self._lock:
+                self._running.discard(chat_id)
+                entry = self._dirty.get(chat_id)
+                clean = entry is not None and entry.pending <= taken and not too_small
+                if too_small:
+                    # Изменения сохраняются до первой модели; пересборка без новых сообщений
+                    # ничего не даст, поэтому чат ждет следующего сообщения
+                    if entry is not None and entry.pending <= taken:
+                        entry.too_small = True
+                elif clean:
+                    del self._dirty[chat_id]
+                elif entry is not None:
+                    entry.pending -= taken
+            if clean:
+                self._persist(chat_id, False)
+        return ok
+
+    def run_due(self) -> int:
+        """Пересборка всех чатов, которым пора; возвращает число пересобранных"""
+        rebuilt = 0
+        for chat_id in self.due():
+            rebuilt += bool(self.rebuild(chat_id))
+        return rebuilt
+
+    def forget(self, chat_id: int):
+        """Сброс изменений чата (например, после очистки истории)"""
+        with self._lock:
+            removed = self._dirty.pop(chat_id, None) is not None
+        if removed:
+            self._persist(chat_id, False)
+
+    @property
+    def dirty_chats(self) -> int:
+        return len(self._dirty)
+
+    async def run(self):
+        """Фоновый цикл: пересборки выполняются в отдельном потоке по одной"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.run_due)
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике пересборки моделей: {e}")
@@ -0,0 +1,81 @@
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from .database import Database
+from .chat_settings import ChatSettings
+from .metrics import ARCHIVED_MESSAGES
+from .shard_router import owns_chat
+
+logger = logging.getLogger(__name__)
+
+class RetentionManager:
+    """
+    Перенос старых сообщений из коллекции messages в сжатый архив (message_archive).
+
+    В messages остаются сообщения за последние RETENTION_DAYS дней (для чата срок
+    можно изменить командой /retention), более старые переносятся пачками по
+    ARCHIVE_CHUNK_SIZE сообщений в сжатые документы. Пересборки моделей, /top и /mood
+    читают историю через кэш корпуса вместе с архивом, поэтому архивация не меняет
+    моделей, а размер messages и стоимость запросов к ней перестают расти.
+    За один запуск переносится не больше RETENTION_MAX_CHUNKS пачек, остаток
+    доделывается при следующем
+    """
+
+    def __init__(self, db: Database, settings: ChatSettings):
+        self.db = db
+        self.settings = settings
+        self.default_days = int(os.getenv('RETENTION_DAYS', '90'))
+        self.chunk_size = int(os.getenv('ARCHIVE_CHUNK_SIZE', '1000'))
+        self.max_chunks = int(os.getenv('RETENTION_MAX_CHUNKS', '500'))
+
+    def retention_days(self, chat_id: int) -> int:
+        """Срок хранения сообщений чата в оперативной коллекции (0 - без архивации)"""
+        return self.settings.get(chat_id).get('retention_days', self.default_days)
+
+    def set_retention_days(self, chat_id: int, days: int) -> bool:
+        return self.settings.update(chat_id, retention_days=days)
+
+    def compact_chat(self, chat_id: int, days: int, max_chunks: Optional[int] = None) -> int:
+        """Архивация сообщений чата старше days дней; возвращает число перенесенных"""
+        if days <= 0:
+            return 0
+        before = datetime.utcnow() - timedelta(days=days)
+        moved = 0
+        for _ in range(max_chunks or self.max_chunks):
+            archived = self.db.archive_messages(chat_id, before, self.chunk_size)
+            moved += archived
+            if archived < self.chunk_size:
+                break
+        if moved:
+            ARCHIVED_MESSAGES.inc(moved)
+            logger.info(f"В архив перенесено {moved} сообщений чата {chat_id} старше {days} дней")
+        return moved
+
+    def run(self) -> Dict[str, int]:
+        """Архивация по всем чатам текущего процесса с учетом лимита пачек на запуск"""
+        started = time.perf_counter()
+        summary = {'chats': 0, 'messages': 0}
+        try:
+            chat_ids = [chat_id for chat_id in self.db.messages.distinct('chat_id') if owns_chat(chat_id)]
+            overrides = {doc['chat_id']: doc['retention_days']
+                         for doc in self.settings.find(retention_days={'$exists': True})}
+        except Exception as e:
+            logger.error(f"Ошибка при получении чатов для архивации: {e}")
+            return summary
+
+        budget = self.max_chunks
+        for chat_id in chat_ids:
+            if budget <= 0:
+                logger.info("Лимит архивации на запуск исчерпан, продолжу при следующем")
+                break
+            moved = self.compact_chat(chat_id, overrides.get(chat_id, self.default_days), budget)
+            if moved:
+                summary['chats'] += 1
+                summary['messages'] += moved
+                budget -= -(-moved // self.chunk_size)
+
+        logger.info(f"Архивация: {summary['messages']} сообщений из {summary['chats']} чатов "
+                    f"за {time.perf_counter() - started:.1f}s")
+        return summary
@@ -0,0 +1,138 @@
+import os
+import signal
+import asyncio
+import logging
+import multiprocessing
+from typing import Callable, List, Optional
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+from ..log_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+def shard_for(chat_id: Optional[int], shards: int) -> int:
+    """Номер шарда для чата. Апдейты без чата уходят в нулевой шард"""
+    if chat_id is None:
+        return 0
+    return chat_id % shards
+
+def current_shard() -> tuple[int, int]:
+    """(номер шарда, всего шардов) текущего процесса"""
+    return int(os.getenv('SHARD_ID', '0')), int(os.getenv('SHARD_COUNT', '1'))
+
+def owns_chat(chat_id: int) -> bool:
+    """Обслуживает ли текущий процесс данный чат"""
+    shard_id, shards = current_shard()
+    return shards <= 1 or shard_for(chat_id, shards) == shard_id
+
+def _worker_main(shard_id: int, shards: int, token: str, factory: Callable, queue):
+    """Точка входа процесса-воркера"""
+    # Останавливаемся только по сигналу от фронта, а не по Ctrl+C в группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ['SHARD_ID'] = str(shard_id)
+    os.environ['SHARD_COUNT'] = str(shards)
+    # Глобальный лимит исходящих сообщений делится между воркерами
+    global_rate = float(os.getenv('OUTBOUND_GLOBAL_RATE', '25'))
+    os.environ['OUTBOUND_GLOBAL_RATE'] = str(global_rate / shards)
+
+    setup_logging(shard_id)
+    application = factory(token, updater=False)
+    asyncio.run(_worker_loop(shard_id, application, queue))
+
+async def _worker_loop(shard_id: int, application: Application, queue):
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Воркер шарда {shard_id} запущен (pid={os.getpid()})")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        # Дообрабатываем уже полученные апдейты и останавливаемся
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info(f"Воркер шарда {shard_id} остановлен")
+
+class ShardRouter:
+    """
+    Распределение апдейтов по процессам-воркерам по хэшу chat_id.
+    Каждый воркер держит модели и кэши только своих чатов, а апдейты
+    одного чата всегда попадают в один и тот же воркер в исходном порядке.
+    """
+
+    def __init__(self, token: str, shards: int, factory: Callable):
+        self.token = token
+        self.shards = shards
+        self.factory = factory
+        self.stop_timeout = float(os.getenv('SHARD_STOP_TIMEOUT', '60'))
+        # spawn: воркеры не наследуют клиентов MongoDB и потоки родителя
+        self._ctx = multiprocessing.get_context('spawn')
+        self.queues = [self._ctx.Queue() for _ in range(shards)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * shards
+
+    def _spawn(self, shard_id: int):
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(shard_id, self.shards, self.token, self.factory, self.queues[shard_id]),
+            name=f'shard-{shard_id}'
+        )
+        process.start()
+        self.processes[shard_id] = process
+        logger.info(f"Запущен воркер шарда {shard_id} (pid={process.pid})")
+
+    def start(self):
+        for shard_id in range(self.shards):
+            self._spawn(shard_id)
+
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Передача апдейта воркеру, владеющему чатом"""
+        chat = update.effective_chat
+        shard_id = shard_for(chat.id if chat else None, self.shards)
+        process = self.processes[shard_id]
+        if process is None or not process.is_alive():
+            logger.error(f"Воркер шарда {shard_id} не работает, перезапускаю")
+            self._spawn(shard_id)
+        self.queues[shard_id].put(update.to_dict())
+
+    def stop(self):
+        """Остановка воркеров после обработки отправленных им апдейтов"""
+        for queue in self.queues:
+            queue.put(None)
+        for shard_id, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(self.stop_timeout)
+            if process.is_alive():
+                logger.warning(f"Воркер шарда {shard_id} не остановился, завершаю принудительно")
+                process.terminate()
+        logger.info("Все воркеры остановлены")
+
+def build_router_application(token: str, shards: int, factory: Callable) -> Application:
+    """Фронтовое приложение: только принимает апдейты и раздает их воркерам"""
+    router = ShardRouter(token, shards, factory)
+
+    async def on_init(application: Application):
+        router.start()
+
+    async def on_shutdown(application: Application):
+        await asyncio.get_running_loop().run_in_executor(None, router.stop)
+
+    application = (
+        Application.builder()
+        .token(token)
+        .post_init(on_init)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, router.route))
+    return application
@@ -5,32 +5,34 @@ from typing import Optional, List
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.database import Database as MongoDatabase
+from .metrics import timed
 
 logger = logging.getLogger(__name__)
 
 class StickerStorage:
-    def __init__(self):
+    def __init__(self, client: Optional[MongoClient] = None):
         # Получаем URI из переменной окружения или используем значение по умолчанию
-        mongodb_uri = os.getenv('MONGODB_URI', 'mongodb://:27017/ebanez')
-        self.client = MongoClient(mongodb_uri)
+        mongodb_uri = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/ebanez')
+        self.client = client or MongoClient(mongodb_uri)
         self.db: MongoDatabase = self.client.get_database()
         self.stickers: Collection = self.db.stickers
-        self._init_storage()
-        logger.info("Инициализация StickerStorage с MongoDB")
 
-    def _init_storage(self):
+    def init_storage(self):
         """Инициализация хранилища"""
         try:
             # Создаем индекс для быстрого поиска по chat_id
             self.stickers.create_index('chat_id')
             
-            # Получаем количество стикеров
-            total_stickers = self.stickers.count_documents({})
-            logger.info(f"В базе {total_stickers} стикеров")
+            # Полный подсчет стикеров нужен только для отладки
+            if logger.isEnabledFor(logging.DEBUG):
+                total_stickers = self.stickers.estimated_document_count()
+                logger.debug(f"В базе ~{total_stickers} стикеров")
+            logger.info("Хранилище стикеров инициализировано")
             
         except Exception as e:
             logger.error(f"Ошибка при инициализации хранилища стикеров: {e}")
 
+    @timed('sticker_storage')
     def add_sticker(self, chat_id: int, sticker_id: str) -> bool:
         """Добавить стикер в хранилище"""
         try:
@@ -45,16 +47,16 @@ class StickerStorage:
                     'chat_id': chat_id,
                     'sticker_id': sticker_id
                 })
-                logger.info(f"Добавлен новый стикер: chat_id={chat_id}, sticker_id={sticker_id}")
+                logger.debug("Добавлен новый стикер: chat_id=%s, sticker_id=%s", chat_id, sticker_id)
                 return bool(result.inserted_id)
             else:
-                logger.info(f"Стикер уже существует: chat_id={chat_id}, sticker_id={sticker_id}")
                 return True
                 
         except Exception as e:
             logger.error(f"Ошибка при добавлении стикера: {e}")
             return False
 
+    @timed('sticker_storage')
     def get_random_sticker(self, chat_id: int) -> Optional[str]:
         """Получить случайный стикер из хранилища"""
         try:
@@ -64,28 +66,30 @@ class StickerStorage:
             if stickers:
                 # Выбираем случайный стикер
                 sticker = random.choice(stickers)
-                logger.info(f"Получен случайный стикер {sticker['sticker_id']} для chat_id={chat_id}")
+                logger.debug("Получен случайный стикер %s для chat_id=%s", sticker['sticker_id'], chat_id)
                 return sticker['sticker_id']
             else:
-                logger.info(f"Нет стикеров для chat_id={chat_id}")
+                logger.debug("Нет стикеров для chat_id=%s", chat_id)
                 return None
                 
         except Exception as e:
             logger.error(f"Ошибка при получении случайного стикера: {e}")
             return None
 
+    @timed('sticker_storage')
     def get_stickers(self, chat_id: int) -> List[str]:
         """Получить все стикеры чата"""
         try:
             stickers = list(self.stickers.find({'chat_id': chat_id}))
             sticker_ids = [s['sticker_id'] for s in stickers]
-            logger.info(f"Получено {len(sticker_ids)} стикеров для chat_id={chat_id}")
+            logger.debug("Получено %d стикеров для chat_id=%s", len(sticker_ids), chat_id)
             return sticker_ids
             
         except Exception as e:
             logger.error(f"Ошибка при получении списка стикеров: {e}")
             return []
 
+    @timed('sticker_storage')
     def clear_stickers(self, chat_id: int) -> bool:
         """Очистить все стикеры чата"""
         try:
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов разных чатов.
+    Апдейты одного чата обрабатываются строго по очереди.
+    """
+
+    def __init__(self, max_concurrent_updates: int, on_backlog: Optional[Callable[[int], None]] = None):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [lock, количество ожидающих]
+        self._chat_locks: Dict[int, List] = {}
+        # Апдейты, забранные из update_queue и еще не обработанные
+        self.backlog = 0
+        self.on_backlog = on_backlog
+
+    def _set_backlog(self, delta: int):
+        self.backlog += delta
+        if self.on_backlog is not None:
+            self.on_backlog(self.backlog)
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """
+        PTB сразу забирает все апдейты из update_queue в задачи, поэтому настоящая очередь -
+        это задачи, ждущие семафора и лока чата. Они учитываются здесь, от входа до конца обработчика
+        """
+        self._set_backlog(1)
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self._set_backlog(-1)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -1,71 +1,253 @@
+import os
+import time
+import asyncio
 import aiohttp
 import logging
-from typing import Dict, Tuple
-from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from datetime import datetime, timedelta
+from pymongo.collection import Collection
+from pymongo.database import Database as MongoDatabase
+from .chat_settings import ChatSettings
 
 logger = logging.getLogger(__name__)
 
+# Город по умолчанию для чатов, где он не выбран
+DEFAULT_LOCATION = {
+    'city': 'Иркутск',
+    'title': 'Иркутске',
+    'lat': 52.2978,
+    'lon': 104.2964,
+    'timezone': 'Asia/Irkutsk',
+}
+
+# Параметры текущей погоды, запрашиваемые у OpenMeteo
+CURRENT_FIELDS = "temperature_2m,relative_humidity_2m,apparent_temperature,wind_speed_10m,precipitation_probability"
+
 class WeatherService:
-    def __init__(self):
-        self.weather_base_url = "https://api.open-meteo.com/v1/forecast"
-        self.geocoding_url = "https://geocoding-api.open-meteo.com/v1/search"
-        
-        self.lat = 52.2978
-        self.lon = 104.2964
-        
-        self.weather_enabled_groups = [
-           -1002321513211
-        ]
+    def __init__(self, settings: ChatSettings, db: Optional[MongoDatabase] = None):
+        # Чаты с включенной рассылкой и выбранные города хранятся в настройках чатов
+        self.settings = settings
+        # Постоянный кэш геокодирования: город ищется во внешнем API один раз.
+        # "Не найдено" хранится ограниченное время: это может быть сбой поиска
+        self.geocoding_cache: Collection = (db if db is not None else settings.db).geocoding_cache
+        self.geocoding_negative_ttl = float(os.getenv('GEOCODING_NEGATIVE_TTL', '3600'))
+
+        # Адреса API можно переопределить, например, для локального тестового сервера
+        self.weather_base_url = os.getenv('WEATHER_API_URL', "https://api.open-meteo.com/v1/forecast")
+        self.geocoding_url = os.getenv('GEOCODING_API_URL', "https://geocoding-api.open-meteo.com/v1/search")
+
+        # Погода меняется медленно, поэтому данные по координатам кэшируются
+        self.cache_ttl = float(os.getenv('WEATHER_CACHE_TTL', '600'))
+        # Сколько точек запрашивать одним вызовом API
+        self.batch_size = int(os.getenv('WEATHER_BATCH_SIZE', '100'))
+        self.request_timeout = aiohttp.ClientTimeout(total=float(os.getenv('WEATHER_TIMEOUT', '10')))
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._cache: Dict[Tuple[float, float], Tuple[float, Dict]] = {}
+        self._inflight: Dict[Tuple[float, float], asyncio.Future] = {}
+        self.upstream_requests = 0
 
-    async def get_weather_and_traffic(self) -> str:
-        """Получает информацию о погоде в Иркутске"""
+    def init_storage(self):
+        """Создание индексов кэша геокодирования"""
         try:
-            weather_info = await self._get_weather()
-            recommendations = self._generate_recommendations(weather_info)
-            
-            weather_message = (
-                f"🌤 Погода в Иркутске:\n"
-                f"Температура: {weather_info['temp']}°C\n"
-                f"Ощущается как: {weather_info['feels_like']}°C\n"
-                f"Влажность: {weather_info['humidity']}%\n"
-                f"Скорость ветра: {weather_info['wind_speed']} км/ч\n"
-                f"Вероятность осадков: {weather_info['precipitation']}%\n\n"
-                f"👔 Рекомендации:\n{recommendations}\n\n"
-                f"🚗 Ситуация на дорогах:\n"
-                f"В будние дни с 8:00 до 10:00 и с 17:00 до 19:00 возможны затруднения "
-                f"на основных магистралях города (ул. Ленина, ул. Карла Маркса, "
-                f"Академический мост)"
-            )
-            
-            return weather_message
-            
+            self.geocoding_cache.create_index('query', unique=True)
+            # Отрицательные результаты удаляет сама MongoDB, у найденных городов expires_at нет
+            self.geocoding_cache.create_index('expires_at', expireAfterSeconds=0)
+        except Exception as e:
+            logger.error(f"Ошибка при создании индексов кэша геокодирования: {e}")
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Общая HTTP-сессия с пулом соединений, живет до close()"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.request_timeout)
+        return self._session
+
+    async def close(self):
+        """Закрытие HTTP-сессии при остановке бота"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @staticmethod
+    def _location_key(location: Dict) -> Tuple[float, float]:
+        return (round(location['lat'], 2), round(location['lon'], 2))
+
+    async def get_weather_and_traffic(self, location: Optional[Dict] = None) -> str:
+        """Получает информацию о погоде в городе чата (при ошибке - сообщение с извинением)"""
+        try:
+            return await self.fetch_weather_message(location)
         except Exception as e:
             logger.error(f"Ошибка при получении данных о погоде: {e}")
             return "Извините, не удалось получить информацию о погоде 😔"
 
-    async def _get_weather(self) -> Dict:
-        """Получает данные о погоде через OpenMeteo API"""
+    async def fetch_weather_message(self, location: Optional[Dict] = None) -> str:
+        """Сообщение о погоде для одного города; ошибки API пробрасываются вызывающему"""
+        location = location or DEFAULT_LOCATION
+        key = self._location_key(location)
+        weather = await self._get_weather([key])
+        return self._format_message(location, weather[key])
+
+    async def fetch_weather_messages(self, locations: Dict[int, Dict]) -> Dict[int, str]:
+        """
+        Сообщения о погоде для множества чатов.
+        Все различные координаты запрашиваются одним пакетным вызовом API,
+        а сообщение для каждого города форматируется один раз.
+
+        Args:
+            locations: Город каждого чата
+
+        Returns:
+            Dict[int, str]: Сообщение для каждого чата
+        """
+        by_key = {self._location_key(location): location for location in locations.values()}
+        weather = await self._get_weather(by_key)
+        messages = {key: self._format_message(location, weather[key]) for key, location in by_key.items()}
+        return {chat_id: messages[self._location_key(location)] for chat_id, location in locations.items()}
+
+    async def _get_weather(self, keys: Iterable[Tuple[float, float]]) -> Dict[Tuple[float, float], Dict]:
+        """
+        Данные о погоде по координатам.
+        Свежие берутся из кэша, недостающие запрашиваются одним пакетом,
+        а одновременные запросы тех же координат ждут уже идущий вызов API
+        """
+        now = time.monotonic()
+        result = {}
+        waiting = {}
+        missing = []
+        for key in set(keys):
+            cached = self._cache.get(key)
+            if cached and cached[0] > now:
+                result[key] = cached[1]
+            elif key in self._inflight:
+                waiting[key] = self._inflight[key]
+            else:
+                missing.append(key)
+
+        if missing:
+            batch = asyncio.ensure_future(self._fetch_batch(missing))
+            for key in missing:
+                self._inflight[key] = batch
+                waiting[key] = batch
+            batch.add_done_callback(lambda f: self._forget_inflight(missing, f))
+
+        for key, future in waiting.items():
+            # shield: отмена одного ожидающего не отменяет запрос для остальных
+            result[key] = (await asyncio.shield(future))[key]
+        return result
+
+    def _forget_inflight(self, keys: List[Tuple[float, float]], future: asyncio.Future):
+        for key in keys:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        # Ошибку забирают ожидающие; если все они отменены, она не должна попасть в лог asyncio
+        if not future.cancelled():
+            future.exception()
+
+    async def _fetch_batch(self, keys: List[Tuple[float, float]]) -> Dict[Tuple[float, float], Dict]:
+        """Запрос погоды сразу для нескольких точек (ошибки не кэшируются)"""
+        weather = {}
+        for start in range(0, len(keys), self.batch_size):
+            chunk = keys[start:start + self.batch_size]
+            for key, info in zip(chunk, await self._request_weather(chunk)):
+                weather[key] = info
+        expires = time.monotonic() + self.cache_ttl
+        for key, info in weather.items():
+            self._cache[key] = (expires, info)
+        return weather
+
+    async def _request_weather(self, keys: List[Tuple[float, float]]) -> List[Dict]:
+        """Получает данные о погоде через OpenMeteo API (несколько точек за один вызов)"""
         params = {
-            "latitude": self.lat,
-            "longitude": self.lon,
-            "current": ["temperature_2m", "relative_humidity_2m", "apparent_temperature", "wind_speed_10m", "precipitation_probability"],
-            "timezone": "Asia/Irkutsk"
+            "latitude": ",".join(str(lat) for lat, _ in keys),
+            "longitude": ",".join(str(lon) for _, lon in keys),
+            "current": CURRENT_FIELDS,
+            "timezone": "auto"
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.weather_base_url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    current = data["current"]
-                    return {
+        self.upstream_requests += 1
+        async with self._get_session().get(self.weather_base_url, params=params) as response:
+            if response.status == 200:
+                data = await response.json()
+                # Для нескольких точек API возвращает список в порядке координат
+                if isinstance(data, dict):
+                    data = [data]
+                result = []
+                for item in data:
+                    current = item["current"]
+                    result.append({
                         "temp": round(current["temperature_2m"]),
                         "feels_like": round(current["apparent_temperature"]),
                         "humidity": current["relative_humidity_2m"],
                         "wind_speed": round(current["wind_speed_10m"]),
                         "precipitation": current["precipitation_probability"]
-                    }
-                else:
-                    raise Exception(f"Weather API returned status code {response.status}")
+                    })
+                return result
+            else:
+                raise Exception(f"Weather API returned status code {response.status}")
+
+    def _format_message(self, location: Dict, weather_info: Dict) -> str:
+        """Текст сообщения о погоде для города"""
+        recommendations = self._generate_recommendations(weather_info)
+        weather_message = (
+            f"🌤 Погода в {location.get('title') or 'г. ' + location['city']}:\n"
+            f"Температура: {weather_info['temp']}°C\n"
+            f"Ощущается как: {weather_info['feels_like']}°C\n"
+            f"Влажность: {weather_info['humidity']}%\n"
+            f"Скорость ветра: {weather_info['wind_speed']} км/ч\n"
+            f"Вероятность осадков: {weather_info['precipitation']}%\n\n"
+            f"👔 Рекомендации:\n{recommendations}"
+        )
+        # Пробки известны только для города по умолчанию
+        if self._location_key(location) == self._location_key(DEFAULT_LOCATION):
+            weather_message += (
+                f"\n\n🚗 Ситуация на дорогах:\n"
+                f"В будние дни с 8:00 до 10:00 и с 17:00 до 19:00 возможны затруднения "
+                f"на основных магистралях города (ул. Ленина, ул. Карла Маркса, "
+                f"Академический мост)"
+            )
+        return weather_message
+
+    async def geocode(self, name: str) -> Optional[Dict]:
+        """
+        Поиск города по названию.
+        Результат сохраняется в MongoDB, поэтому внешний API вызывается один раз на город
+
+        Returns:
+            Optional[Dict]: Город с координатами и часовым поясом или None, если не найден
+        """
+        query = ' '.join(name.lower().split())
+        cached = await asyncio.to_thread(self.geocoding_cache.find_one, {'query': query}, {'_id': 0})
+        # TTL-монитор MongoDB удаляет документы с задержкой, поэтому срок проверяется и здесь
+        if cached and not (cached.get('expires_at') and cached['expires_at'] <= datetime.utcnow()):
+            return cached if cached.get('found', True) else None
+
+        params = {"name": name.strip(), "count": 1, "language": "ru", "format": "json"}
+        self.upstream_requests += 1
+        async with self._get_session().get(self.geocoding_url, params=params) as response:
+            if response.status != 200:
+                raise Exception(f"Geocoding API returned status code {response.status}")
+            data = await response.json()
+
+        results = data.get('results') or []
+        if results:
+            found = results[0]
+            location = {
+                'query': query,
+                'city': found['name'],
+                'lat': found['latitude'],
+                'lon': found['longitude'],
+                'timezone': found.get('timezone', 'auto'),
+                'found': True,
+            }
+        else:
+            location = {'query': query, 'found': False}
+        now = datetime.utcnow()
+        if results:
+            update = {'$set': dict(location, created_at=now), '$unset': {'expires_at': ''}}
+        else:
+            update = {'$set': dict(location, created_at=now,
+                                   expires_at=now + timedelta(seconds=self.geocoding_negative_ttl))}
+        await asyncio.to_thread(self.geocoding_cache.update_one, {'query': query}, update, upsert=True)
+        return location if results else None
 
     def _generate_recommendations(self, weather_data: Dict) -> str:
         """Генерирует рекомендации на основе погодных данных"""
@@ -101,4 +283,32 @@ class WeatherService:
 
     def is_weather_enabled(self, chat_id: int) -> bool:
         """Проверяет, включена ли функция погоды для данного чата"""
-        return chat_id in self.weather_enabled_groups
+        return bool(self.settings.get(chat_id).get('weather_enabled'))
+
+    def set_weather_enabled(self, chat_id: int, enabled: bool) -> bool:
+        """Включение или отключение рассылки погоды в чате"""
+        return self.settings.update(chat_id, weather_enabled=enabled)
+
+    @staticmethod
+    def _settings_location(doc: Dict) -> Dict:
+        if doc.get('lat') is None or doc.get('lon') is None:
+            return DEFAULT_LOCATION
+        return {key: doc[key] for key in ('city', 'lat', 'lon', 'timezone') if key in doc}
+
+    def get_location(self, chat_id: int) -> Dict:
+        """Город чата (по умолчанию - Иркутск)"""
+        return self._settings_location(self.settings.get(chat_id))
+
+    def set_location(self, chat_id: int, location: Dict) -> bool:
+        """Сохранение города чата"""
+        return self.settings.update(
+            chat_id,
+            city=location['city'],
+            lat=location['lat'],
+            lon=location['lon'],
+            timezone=location.get('timezone', 'auto')
+        )
+
+    def get_broadcast_targets(self) -> Dict[int, Dict]:
+        """Чаты, в которые нужно рассылать погоду, и их города"""
+        return {doc['chat_id']: self._settings_location(doc) for doc in self.settings.find(weather_enabled=True)}
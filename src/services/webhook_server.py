@@ -0,0 +1,126 @@
+import os
+import hmac
+import signal
+import asyncio
+import logging
+from typing import Optional
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+from .metrics import handle_metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class WebhookServer:
+    """Встроенный HTTP-сервер для приема апдейтов Telegram через webhook"""
+
+    def __init__(self, application: Application, secret_token: str,
+                 host: Optional[str] = None, port: Optional[int] = None,
+                 path: Optional[str] = None, webhook_url: Optional[str] = None):
+        self.application = application
+        self.secret_token = secret_token
+        self.host = host or os.getenv('WEBHOOK_HOST', '0.0.0.0')
+        self.port = port or int(os.getenv('WEBHOOK_PORT', '8080'))
+        self.path = path or os.getenv('WEBHOOK_PATH', '/webhook')
+        # Публичный адрес для setWebhook. Если не задан, webhook не регистрируется
+        # (удобно для локальной отладки и для реплик за балансировщиком)
+        self.webhook_url = webhook_url if webhook_url is not None else os.getenv('WEBHOOK_URL')
+        self.shutdown_timeout = float(os.getenv('WEBHOOK_SHUTDOWN_TIMEOUT', '30'))
+        self._stopping = False
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application()
+        self.app.router.add_post(self.path, self._handle_update)
+        self.app.router.add_get('/health', self._handle_health)
+        self.app.router.add_get('/metrics', handle_metrics)
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        """Прием апдейта и постановка в очередь приложения"""
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            logger.warning(f"Отклонен запрос с неверным секретом от {request.remote}")
+            return web.Response(status=403)
+
+        if self._stopping:
+            # Telegram повторит доставку позже или на другую реплику
+            return web.Response(status=503)
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            logger.error(f"Не удалось разобрать апдейт: {e}")
+            return web.Response(status=400)
+
+        await self.application.update_queue.put(update)
+        return web.Response(status=200)
+
+    async def _handle_health(self, request: web.Request) -> web.Response:
+        """Проверка состояния для балансировщика"""
+        healthy = self.application.running and not self._stopping
+        return web.json_response(
+            {
+                'status': 'ok' if healthy else 'stopping',
+                'update_queue': self.application.update_queue.qsize(),
+            },
+            status=200 if healthy else 503
+        )
+
+    async def start(self):
+        """Запуск HTTP-сервера и регистрация webhook"""
+        self._runner = web.AppRunner(self.app, shutdown_timeout=self.shutdown_timeout)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Webhook-сервер слушает {self.host}:{self.port}{self.path}")
+
+        if self.webhook_url:
+            await self.application.bot.set_webhook(
+                url=self.webhook_url,
+                secret_token=self.secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Webhook зарегистрирован: {self.webhook_url}")
+
+    async def stop(self):
+        """Прекращение приема новых апдейтов. Уже принятые запросы дорабатываются"""
+        self._stopping = True
+        if self._runner:
+            await self._runner.cleanup()
+        logger.info("Webhook-сервер остановлен")
+
+def run_webhook(application: Application):
+    """Запуск бота в режиме webhook с плавной остановкой по SIGINT/SIGTERM"""
+    secret_token = os.getenv('WEBHOOK_SECRET')
+    if not secret_token:
+        raise ValueError("Для режима webhook нужна переменная WEBHOOK_SECRET")
+
+    async def _run():
+        server = WebhookServer(application, secret_token)
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+
+        try:
+            await stop_event.wait()
+        finally:
+            logger.info("Останавливаю бота, дообрабатываю принятые апдейты...")
+            await server.stop()
+            # Application.stop() обрабатывает все апдейты, уже стоящие в очереди,
+            # и ждет завершения запущенных обработчиков
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+            logger.info("Бот остановлен")
+
+    asyncio.run(_run())
@@ -0,0 +1,191 @@
+import os
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from pymongo import UpdateOne, DESCENDING
+from pymongo.collection import Collection
+from pymongo.database import Database as MongoDatabase
+
+logger = logging.getLogger(__name__)
+
+class WordStats:
+    """Инкрементальный индекс частоты слов для команды /top"""
+
+    def __init__(self, db: MongoDatabase, min_word_length: int = 3):
+        self.min_word_length = min_word_length
+        # Сколько дней хранить дневные счетчики для окон "за день/неделю/месяц"
+        self.daily_retention_days = int(os.getenv('WORD_STATS_DAYS', '35'))
+        self.totals: Collection = db.word_totals
+        self.daily: Collection = db.word_daily
+        self.state: Collection = db.analytics_state
+        # Слова сообщений, пришедших во время пересчета чата: применяются после него
+        self._journals: Dict[int, List[Tuple[datetime, Counter]]] = {}
+        self._chat_locks: Dict[int, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def init_indexes(self):
+        """Создание индексов для счетчиков"""
+        try:
+            self.totals.create_index([('chat_id', 1), ('word', 1)], unique=True)
+            self.totals.create_index([('chat_id', 1), ('count', DESCENDING)])
+            self.daily.create_index([('chat_id', 1), ('day', 1), ('word', 1)], unique=True)
+            # Старые дневные счетчики удаляются самой MongoDB
+            self.daily.create_index(
+                'day', expireAfterSeconds=self.daily_retention_days * 86400)
+            self.state.create_index([('chat_id', 1), ('kind', 1)], unique=True)
+        except Exception as e:
+            logger.error(f"Ошибка при создании индексов WordStats: {e}")
+
+    def tokenize(self, text: str) -> List[str]:
+        """Разбиение сообщения на учитываемые слова"""
+        return [word for word in text.lower().split() if len(word) >= self.min_word_length]
+
+    @staticmethod
+    def _day_start(moment: datetime) -> datetime:
+        return datetime(moment.year, moment.month, moment.day)
+
+    def _chat_lock(self, chat_id: int) -> threading.Lock:
+        with self._lock:
+            return self._chat_locks.setdefault(chat_id, threading.Lock())
+
+    def add_message(self, chat_id: int, text: str, created_at: Optional[datetime] = None) -> bool:
+        """Учет слов нового сообщения"""
+        counts = Counter(self.tokenize(text))
+        if not counts:
+            return True
+
+        created_at = created_at or datetime.utcnow()
+        with self._chat_lock(chat_id):
+            journal = self._journals.get(chat_id)
+            if journal is not None:
+                journal.append((created_at, counts))
+                return True
+            return self._inc(chat_id, counts, created_at)
+
+    def _inc(self, chat_id: int, counts: Counter, created_at: datetime) -> bool:
+        day = self._day_start(created_at)
+        try:
+            self.totals.bulk_write([
+                UpdateOne({'chat_id': chat_id, 'word': word}, {'$inc': {'count': n}}, upsert=True)
+                for word, n in counts.items()
+            ], ordered=False)
+            self.daily.bulk_write([
+                UpdateOne({'chat_id': chat_id, 'day': day, 'word': word}, {'$inc': {'count': n}}, upsert=True)
+                for word, n in counts.items()
+            ], ordered=False)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении частоты слов: {e}")
+            return False
+
+    def get_top(self, chat_id: int, limit: int = 10, days: Optional[int] = None) -> List[Tuple[str, int]]:
+        """
+        Топ слов чата
+
+        Args:
+            chat_id: ID чата
+            limit: Количество слов
+            days: Окно в днях (None - за все время)
+        """
+        try:
+            if days is None:
+                cursor = self.totals.find(
+                    {'chat_id': chat_id}, {'_id': 0, 'word': 1, 'count': 1}
+                ).sort('count', DESCENDING).limit(limit)
+                return [(doc['word'], doc['count']) for doc in cursor]
+
+            since = self._day_start(datetime.utcnow()) - timedelta(days=days - 1)
+            pipeline = [
+                {'$match': {'chat_id': chat_id, 'day': {'$gte': since}}},
+                {'$group': {'_id': '$word', 'count': {'$sum': '$count'}}},
+                {'$sort': {'count': DESCENDING}},
+                {'$limit': limit}
+            ]
+            return [(doc['_id'], doc['count']) for doc in self.daily.aggregate(pipeline)]
+
+        except Exception as e:
+            logger.error(f"Ошибка при получении топа слов: {e}")
+            return []
+
+    def is_indexed(self, chat_id: int) -> bool:
+        """Построен ли индекс по истории чата"""
+        try:
+            return self.state.find_one({'chat_id': chat_id, 'kind': 'words'}) is not None
+        except Exception as e:
+            logger.error(f"Ошибка при проверке индекса слов: {e}")
+            return False
+
+    def rebuild(self, chat_id: int, messages: Iterable[dict]) -> bool:
+        """
+        Полное построение индекса по истории чата.
+        Счетчики перезаписываются, поэтому повторный вызов безопасен.
+        Сообщения, пришедшие во время пересчета, копятся в журнале и добавляются
+        после записи, если их не было в переданной истории
+
+        Args:
+            messages: Документы с полями text и created_at (от старых к новым)
+        """
+        with self._chat_lock(chat_id):
+            self._journals[chat_id] = []
+        try:
+            since = self._day_start(datetime.utcnow()) - timedelta(days=self.daily_retention_days)
+            totals = Counter()
+            daily = Counter()
+            last = None
+            for doc in messages:
+                words = self.tokenize(doc.get('text') or '')
+                totals.update(words)
+                created_at = doc.get('created_at')
+                if created_at:
+                    last = created_at
+                if created_at and created_at >= since:
+                    day = self._day_start(created_at)
+                    daily.update((day, word) for word in words)
+
+            self.totals.delete_many({'chat_id': chat_id})
+            self.daily.delete_many({'chat_id': chat_id})
+            if totals:
+                self.totals.bulk_write([
+                    UpdateOne({'chat_id': chat_id, 'word': word}, {'$set': {'count': n}}, upsert=True)
+                    for word, n in totals.items()
+                ], ordered=False)
+            if daily:
+                self.daily.bulk_write([
+                    UpdateOne({'chat_id': chat_id, 'day': day, 'word': word}, {'$set': {'count': n}}, upsert=True)
+                    for (day, word), n in daily.items()
+                ], ordered=False)
+
+            # История идет по порядку, поэтому сообщения не позже последнего в ней уже учтены
+            with self._chat_lock(chat_id):
+                journal = self._journals.pop(chat_id, [])
+            for created_at, counts in journal:
+                if last is None or created_at > last:
+                    self._inc(chat_id, counts, created_at)
+
+            self.state.update_one(
+                {'chat_id': chat_id, 'kind': 'words'},
+                {'$set': {'indexed_at': datetime.utcnow()}},
+                upsert=True
+            )
+            logger.info(f"Индекс слов для chat_id={chat_id} построен: {len(totals)} слов")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка при построении индекса слов: {e}")
+            return False
+        finally:
+            with self._chat_lock(chat_id):
+                self._journals.pop(chat_id, None)
+
+    def clear(self, chat_id: int) -> bool:
+        """Удаление счетчиков чата"""
+        try:
+            self.totals.delete_many({'chat_id': chat_id})
+            self.daily.delete_many({'chat_id': chat_id})
+            self.state.delete_one({'chat_id': chat_id, 'kind': 'words'})
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при очистке индекса слов: {e}")
+            return False
@@ -0,0 +1,57 @@
+"""
+Импорт истории чата из экспорта Telegram Desktop (JSON).
+
+    python -m src.tools.import_history path/to/result.json [--chat-id -1001234567890]
+
+Использует те же MONGODB_URI и директорию моделей, что и бот. Запущенный бот
+перед пересборкой модели сверяет время загрузки кэша корпуса с отметкой импорта
+в history_imports, поэтому при следующей пересборке чата перечитает историю
+вместе с импортированной и загрузит записанную здесь модель. До этой пересборки
+(или перезапуска) бот отвечает по старой модели.
+"""
+import sys
+import argparse
+import logging
+from dotenv import load_dotenv
+from src.log_config import setup_logging
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Импорт истории чата из result.json Telegram Desktop')
+    parser.add_argument('path', help='Путь к result.json')
+    parser.add_argument('--chat-id', type=int, help='Чат, в который импортировать (по умолчанию - чат из экспорта)')
+    parser.add_argument('--batch-size', type=int, help='Размер пакета вставки (IMPORT_BATCH_SIZE)')
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    setup_logging()
+
+    from src.services.database import Database
+    from src.services.markov_chain import MarkovChainGenerator
+    from src.services.history_import import HistoryImporter
+    from src.services.base_model import SharedBaseModel
+    from src.services.chat_settings import ChatSettings
+
+    generator = MarkovChainGenerator(db=Database())
+    generator.init_storage()
+    generator.base_model = SharedBaseModel(generator, ChatSettings(generator.db.client))
+    generator.base_model.init_storage()
+    importer = HistoryImporter(generator, batch_size=args.batch_size)
+    importer.init_storage()
+
+    def progress(stats: dict):
+        logging.info(f"Импортировано {stats['imported']} из {stats['read']} прочитанных сообщений")
+
+    stats = importer.import_file(args.path, chat_id=args.chat_id, progress=progress)
+    print(
+        f"Чат {stats['chat_id']}: импортировано {stats['imported']}, прочитано {stats['read']}, "
+        f"невалидных {stats['invalid']}, дубликатов {stats['duplicates']}, служебных {stats['skipped']}, "
+        f"уже импортированных {stats['already_imported']}, модель {'построена' if stats['model_built'] else 'не построена'} "
+        f"за {stats['seconds']}s"
+    )
+    if stats['error']:
+        print(f"Ошибка: {stats['error']}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+Пересборка моделей всех чатов в пуле процессов (например, после смены state_size
+или правил фильтрации).
+
+    python -m src.tools.rebuild_all [--workers 8] [--restart] [--chat-id ID ...]
+
+Чаты обрабатываются от самых больших к самым маленьким, чтобы длинные задачи
+не остались в конце. Прогресс сохраняется в файл состояния после каждого чата,
+поэтому прерванный прогон при повторном запуске продолжается с места остановки
+(--restart начинает заново); после завершенного прогона следующий запуск начинается
+с начала, а --retry-failed повторяет только чаты с ошибкой (чаты, в которых
+меньше минимума сообщений, отмечаются как пропущенные и не повторяются).
+Указанные в --chat-id чаты пересобираются всегда. Учитываются и чаты, все
+сообщения которых уже в архиве. Модели записываются атомарно (save_model).
+
+Запущенный бот держит в памяти старые модели до следующей пересборки чата,
+поэтому после полного прогона его стоит перезапустить.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+from src.log_config import setup_logging
+
+logger = logging.getLogger('rebuild_all')
+
+DEFAULT_STATE_PATH = Path(__file__).parent.parent.parent / 'data' / 'rebuild_all_state.json'
+
+# Генератор процесса-воркера (создается в инициализаторе пула)
+_generator = None
+
+def _init_worker():
+    global _generator
+    load_dotenv()
+    setup_logging()
+    # Воркер держит в кэше только текущий чат
+    os.environ.setdefault('CORPUS_CACHE_MB', '64')
+    from src.services.database import Database
+    from src.services.markov_chain import MarkovChainGenerator
+    from src.services.base_model import SharedBaseModel
+    from src.services.chat_settings import ChatSettings
+    _generator = MarkovChainGenerator(db=Database())
+    # Чаты с общей моделью учатся только на последних сообщениях, как и в боте
+    _generator.base_model = SharedBaseModel(_generator, ChatSettings(_generator.db.client))
+    _generator.base_model.init_storage()
+    _generator.models_dir.mkdir(parents=True, exist_ok=True)
+
+# Итоги по чату в файле состояния
+BUILT, SKIPPED, FAILED = 'built', 'skipped', 'failed'
+RESULT_NAMES = {BUILT: 'готово', SKIPPED: 'мало сообщений, пропущен', FAILED: 'модель не построена'}
+
+def _too_small(chat_id: int) -> bool:
+    """Модель не строится, потому что в чате меньше min_messages подходящих сообщений"""
+    messages = _generator.corpus.get_messages(chat_id)
+    base_model = _generator.base_model
+    if base_model is not None and base_model.is_enabled(chat_id):
+        messages = messages[-base_model.overlay_max_messages:]
+    return sum(1 for _ in _generator.prepare_training_lines(messages)) < _generator.min_messages
+
+def _rebuild_chat(chat_id: int) -> Tuple[int, str, float]:
+    """Пересборка одной модели в процессе-воркере"""
+    started = time.perf_counter()
+    try:
+        if _generator.rebuild_model(chat_id):
+            result = BUILT
+        else:
+            result = SKIPPED if _too_small(chat_id) else FAILED
+    finally:
+        # Освобождаем память перед следующим чатом
+        _generator.models.pop(chat_id, None)
+        _generator.corpus.invalidate(chat_id)
+    return chat_id, result, time.perf_counter() - started
+
+def load_state(path: Path) -> dict:
+    try:
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+        # Файлы прошлых версий хранили True/False
+        state['done'] = {int(chat_id): {True: BUILT, False: FAILED}.get(result, result)
+                         for chat_id, result in state.get('done', {}).items()}
+        return state
+    except FileNotFoundError:
+        return {'done': {}}
+
+def save_state(path: Path, state: dict):
+    """Атомарная запись состояния: прерывание не оставит поврежденный файл"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Пересборка моделей всех чатов')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Сколько моделей строить одновременно (по умолчанию - число ядер)')
+    parser.add_argument('--state', type=Path, default=DEFAULT_STATE_PATH, help='Файл состояния для продолжения')
+    parser.add_argument('--restart', action='store_true', help='Не продолжать прошлый прогон, начать заново')
+    parser.add_argument('--retry-failed', action='store_true', help='Повторить чаты, которые не удалось собрать')
+    parser.add_argument('--chat-id', type=int, action='append', help='Только указанные чаты')
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    setup_logging()
+
+    from src.services.database import Database
+
+    state = {'done': {}} if args.restart else load_state(args.state)
+    if state.get('finished_at') and not args.retry_failed and not args.chat_id:
+        # Прошлый прогон завершен: продолжать нечего, начинаем новый
+        logger.info(f"Прошлый прогон завершен {state['finished_at']}, начинаю заново")
+        state = {'done': {}}
+    state.setdefault('started_at', datetime.utcnow().isoformat(timespec='seconds'))
+
+    counts = Database().get_message_counts()
+    if args.chat_id:
+        counts = {chat_id: counts.get(chat_id, 0) for chat_id in args.chat_id}
+    pending = [
+        chat_id for chat_id, _ in sorted(counts.items(), key=lambda item: item[1], reverse=True)
+        if args.chat_id or chat_id not in state['done']
+        or (args.retry_failed and state['done'][chat_id] == FAILED)
+    ]
+    total = len(pending)
+    logger.info(f"Чатов с сообщениями: {len(counts)}, к пересборке: {total} "
+                f"(уже обработано: {len(counts) - total}), процессов: {args.workers}")
+    if not pending:
+        return 0
+
+    started = time.perf_counter()
+    summary = {BUILT: 0, SKIPPED: 0, FAILED: 0}
+    # spawn: воркеры не наследуют открытые соединения MongoDB родителя
+    executor = ProcessPoolExecutor(max_workers=max(1, args.workers),
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker)
+    try:
+        futures = {executor.submit(_rebuild_chat, chat_id): chat_id for chat_id in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            chat_id = futures[future]
+            try:
+                _, result, seconds = future.result()
+            except Exception as e:
+                logger.error(f"Ошибка воркера на чате {chat_id}: {e}")
+                result, seconds = FAILED, 0.0
+
+            summary[result] += 1
+            state['done'][chat_id] = result
+            save_state(args.state, state)
+
+            elapsed = time.perf_counter() - started
+            eta = elapsed / done * (total - done)
+            logger.info(f"[{done}/{total}] чат {chat_id}: {RESULT_NAMES[result]} "
+                        f"за {seconds:.1f}s, осталось ~{eta:.0f}s")
+    except KeyboardInterrupt:
+        logger.warning("Прервано, прогресс сохранен в файле состояния")
+        executor.shutdown(wait=False, cancel_futures=True)
+        return 130
+    executor.shutdown()
+
+    state['finished_at'] = datetime.utcnow().isoformat(timespec='seconds')
+    save_state(args.state, state)
+    logger.info(f"Готово за {time.perf_counter() - started:.1f}s: построено {summary[BUILT]}, "
+                f"пропущено (мало сообщений) {summary[SKIPPED]}, ошибок {summary[FAILED]}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())